@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Reading Squirrel sources from tar and zip bundles for the doxygen Squirrel filter.
+# Copyright (C) 2015, 2019  Jacob Boerema
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# -------------------------------------------------------------------------
+
+## @file doxygen_squirrel_archive.py Read the Squirrel files of tar and zip bundles without extracting them.
+
+## Usage:
+## + python doxygen_squirrel_filter.py batch -o output_dir superai-12.tar (filters all members into output_dir/superai-12/)
+## + doxygen_squirrel_filter.py superai-12.tar!superai/main.nut (filters one member to stdout)
+## + python doxygen_squirrel_filter.py archive superai-12.tar (lists the members the filter would read)
+##
+## A member of an archive is named by the path of the archive, "!" and the path of the member
+## inside the archive. Batch mode reads every archive once, from start to end, and filters each
+## member that matches the include patterns while reading it, so compressed tar files are
+## decompressed only once and nothing is written to disk but the filtered output.
+## Include patterns are matched against the file name of the member, exclude patterns against
+## its full name with the archive path.
+
+import os
+import sys
+import fnmatch
+import argparse
+import tarfile
+import zipfile
+
+## Separator between the path of an archive and the path of a member inside it.
+SEPARATOR = "!";
+
+## File name endings of the archives we read, longest first.
+ARCHIVE_SUFFIXES = (".tar.gz", ".tar.bz2", ".tar.xz", ".tar", ".tgz", ".tbz2", ".txz", ".zip");
+
+## Return the suffix of path if it's an archive we can read, None otherwise.
+def archive_suffix(path):
+	lower = path.lower();
+	for suffix in ARCHIVE_SUFFIXES:
+		if lower.endswith(suffix):
+			return suffix;
+	return None;
+
+## Check if path is the name of an archive we can read.
+def is_archive(path):
+	return archive_suffix(path) is not None;
+
+## Return the path of the archive without its suffix, used as directory for its members in the mirror tree.
+def strip_suffix(path):
+	suffix = archive_suffix(path);
+	return path[:-len(suffix)] if suffix else path;
+
+## Split the name of a member in (archive path, member path). Returns None if name is not in an archive.
+## The archive is the first part of name ending in an archive suffix, followed by the separator.
+def split_member(name):
+	start = 0;
+	while True:
+		pos = name.find(SEPARATOR, start);
+		if pos < 0:
+			return None;
+		if is_archive(name[:pos]):
+			return name[:pos], name[pos + len(SEPARATOR):];
+		start = pos + 1;
+
+## Return the name of member in the archive at path.
+def member_name(path, member):
+	return path + SEPARATOR + member;
+
+## Return the path of member relative to the directory of its archive in the mirror tree,
+## or None if it would end up outside that directory.
+def member_relpath(member):
+	parts = [part for part in member.split("/") if part not in ("", ".")];
+	if not parts or ".." in parts:
+		return None;
+	return os.path.join(*parts);
+
+## Iterate over the members of the archive at path that match include and none of exclude.
+## Yields (member path, data). The archive is read once from start to end: tar files as a stream,
+## zip files in the order of their entries in the file.
+def iter_members(path, include, exclude=()):
+	def wanted(member):
+		if not include or not any(fnmatch.fnmatch(member.rsplit("/", 1)[-1], pattern) for pattern in include):
+			return False;
+		name = member_name(path, member);
+		return not any(fnmatch.fnmatch(name, pattern) for pattern in exclude);
+
+	if archive_suffix(path) == ".zip":
+		with zipfile.ZipFile(path) as archive:
+			infos = sorted(archive.infolist(), key=lambda info: info.header_offset);
+			for info in infos:
+				if not info.filename.endswith("/") and wanted(info.filename):
+					yield info.filename, archive.read(info);
+	else:
+		# "r|*" reads the tar file as a stream with any compression, it never seeks back.
+		archive = tarfile.open(path, "r|*");
+		try:
+			for info in archive:
+				if info.isfile() and wanted(info.name):
+					member_file = archive.extractfile(info);
+					yield info.name, member_file.read();
+		finally:
+			archive.close();
+
+## Return the contents of member in the archive at path as bytes.
+def read_member(path, member):
+	if archive_suffix(path) == ".zip":
+		with zipfile.ZipFile(path) as archive:
+			return archive.read(member);
+	archive = tarfile.open(path, "r:*");
+	try:
+		member_file = archive.extractfile(member);
+		if member_file is None:
+			raise IOError("Not a file in " + path + ": " + member);
+		return member_file.read();
+	finally:
+		archive.close();
+
+## Return the contents of the file at name, which may be a member of an archive, as bytes.
+def read_source(name):
+	if not os.path.exists(name):
+		parts = split_member(name);
+		if parts is not None:
+			return read_member(*parts);
+	with open(name, "rb") as source_file:
+		return source_file.read();
+
+def main(args):
+	parser = argparse.ArgumentParser(prog="doxygen_squirrel_filter.py archive",
+		description="List the Squirrel files of archives by the names the filter accepts.");
+	parser.add_argument("archives", nargs="+", help="tar or zip files");
+	parser.add_argument("-i", "--include", action="append",
+		help="file name pattern to include, can be repeated (default: *.nut)");
+	options = parser.parse_args(args);
+	for path in options.archives:
+		for member, data in iter_members(path, options.include or ["*.nut"]):
+			sys.stdout.write("%9d %s\n" % (len(data), member_name(path, member)));
+	return 0;
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]));
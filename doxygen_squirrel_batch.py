@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Batch mode for the doxygen Squirrel filter.
+# Copyright (C) 2015, 2019  Jacob Boerema
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# -------------------------------------------------------------------------
+
+## @file doxygen_squirrel_batch.py Filter a whole source tree into a mirror directory using all cores.
+
+## Usage:
+## + python doxygen_squirrel_filter.py batch -o output_dir [options] source [source ...]
+##
+## Every file below the sources that matches one of the include patterns and none of the
+## exclude patterns is filtered and written to the same relative path below output_dir.
+## Point doxygen's INPUT at output_dir and leave FILTER_PATTERNS empty.
+## Include patterns work like doxygen's FILE_PATTERNS (matched against the file name),
+## exclude patterns like EXCLUDE_PATTERNS (matched against the full path).
+##
+## Tar and zip files among the sources are not extracted: every archive is read once and the
+## members matching the patterns are filtered while reading it, into a directory named after the
+## archive, e.g. output_dir/superai-12/ for superai-12.tar. See doxygen_squirrel_archive.py.
+
+import os
+import sys
+import time
+import fnmatch
+import itertools
+import collections
+import argparse
+import threading
+import traceback
+import multiprocessing
+
+import doxygen_squirrel_filter
+import doxygen_squirrel_cache
+import doxygen_squirrel_archive
+
+## Check if path is excluded by one of the exclude patterns.
+def is_excluded(path, exclude):
+	for pattern in exclude:
+		if fnmatch.fnmatch(path, pattern):
+			return True;
+	return False;
+
+## Check if the file name matches one of the include patterns.
+def is_included(filename, include):
+	for pattern in include:
+		if fnmatch.fnmatch(filename, pattern):
+			return True;
+	return False;
+
+## Determine the directory that the mirror tree is relative to.
+## A single source directory is mirrored directly, otherwise the common parent of all sources is used.
+def mirror_base(sources):
+	if len(sources) == 1 and os.path.isdir(sources[0]):
+		return sources[0];
+	dirs = [];
+	for source in sources:
+		if os.path.isdir(source):
+			dirs.append(os.path.dirname(source.rstrip(os.sep)));
+		else:
+			dirs.append(os.path.dirname(source));
+	parts = [d.split(os.sep) for d in dirs];
+	common = [];
+	for items in zip(*parts):
+		if items.count(items[0]) != len(items):
+			break;
+		common.append(items[0]);
+	return os.sep.join(common) or os.sep;
+
+## Find all files in sources that need filtering.
+## Returns a list of (size, source path, relative path) tuples, largest files first.
+## With archives set archives are returned instead of the files to filter, in the order found.
+def find_files(sources, include, exclude, archives=False):
+	sources = [os.path.abspath(source) for source in sources];
+	base = mirror_base(sources);
+	found = [];
+	for source in sources:
+		if os.path.isfile(source):
+			paths = [source] if doxygen_squirrel_archive.is_archive(source) == archives else [];
+		else:
+			paths = [];
+			for dirpath, dirnames, filenames in os.walk(source):
+				# Don't descend into excluded directories.
+				dirnames[:] = sorted(d for d in dirnames if not is_excluded(os.path.join(dirpath, d), exclude));
+				for filename in sorted(filenames):
+					if archives:
+						if doxygen_squirrel_archive.is_archive(filename):
+							paths.append(os.path.join(dirpath, filename));
+					elif is_included(filename, include) and not doxygen_squirrel_archive.is_archive(filename):
+						paths.append(os.path.join(dirpath, filename));
+		for path in paths:
+			if not is_excluded(path, exclude):
+				found.append((os.path.getsize(path), path, os.path.relpath(path, base)));
+	if not archives:
+		found.sort(key=lambda item: -item[0]);
+	return found;
+
+## Tasks for the members of archives, made while reading every archive once from start to end.
+## At most limit members are read but not filtered yet, so the memory used doesn't depend on the
+## size of the archives. Call done for every result, the pool reads the tasks in another thread.
+class ArchiveTasks:
+	## archives are found by find_files, options are the task items after the output path.
+	def __init__(self, archives, include, exclude, output, options, limit):
+		self.archives = archives;
+		self.include = include;
+		self.exclude = exclude;
+		self.output = output;
+		self.options = options;
+		self.slots = threading.Semaphore(limit);
+		## Number of tasks per member name that were read but not filtered yet. A tar can have a member
+		## name more than once, like after appending with tar -r.
+		self.pending = collections.Counter();
+		## Number of archives that could not be read, or not completely.
+		self.failed = 0;
+
+	def __iter__(self):
+		for size, path, relpath in self.archives:
+			output_dir = os.path.join(self.output, doxygen_squirrel_archive.strip_suffix(relpath));
+			try:
+				for member, data in doxygen_squirrel_archive.iter_members(path, self.include, self.exclude):
+					name = doxygen_squirrel_archive.member_name(path, member);
+					member_path = doxygen_squirrel_archive.member_relpath(member);
+					if member_path is None:
+						doxygen_squirrel_filter.alwaysprint("** Skipping " + name + ": path outside the archive.\n");
+						continue;
+					self.slots.acquire();
+					self.pending[name] += 1;
+					yield (len(data), name, os.path.join(output_dir, member_path)) + self.options + (data,);
+			except Exception as e:
+				self.failed += 1;
+				doxygen_squirrel_filter.alwaysprint("** Error reading archive " + path + ": " + str(e) + "\n");
+
+	## Tell that the task of path was filtered.
+	def done(self, path):
+		if self.pending[path] > 0:
+			self.pending[path] -= 1;
+			if not self.pending[path]:
+				del self.pending[path];
+			self.slots.release();
+
+## Write a file by renaming a temporary file so readers never see a partially written file.
+def replace_file(tmp_path, path):
+	try:
+		os.replace(tmp_path, path);
+	except AttributeError:
+		# python 2
+		if os.name == "nt" and os.path.exists(path):
+			os.remove(path);
+		os.rename(tmp_path, path);
+
+## Collects the messages the filter writes to stderr.
+class MessageBuffer:
+	def __init__(self):
+		self.messages = [];
+
+	def write(self, string):
+		self.messages.append(string);
+
+	def flush(self):
+		pass;
+
+	def getvalue(self):
+		return "".join(self.messages);
+
+## Project indexes loaded by this process, by path.
+loaded_indexes = {};
+
+## Return the project index at path, loading it only once per process. Returns None if path is None.
+def load_index(path):
+	if path is None:
+		return None;
+	if path not in loaded_indexes:
+		import doxygen_squirrel_index
+		loaded_indexes[path] = doxygen_squirrel_index.ProjectIndex(path);
+	return loaded_indexes[path];
+
+## Symbol databases opened by this process, by path.
+symbol_databases = {};
+
+## Store the symbols of the file at path in the symbol database or .jsonl file at destination.
+def store_symbols(destination, path, symbols):
+	import doxygen_squirrel_symbols
+	if destination.endswith(".jsonl"):
+		doxygen_squirrel_symbols.write_symbols(destination, path, symbols);
+		return;
+	if destination not in symbol_databases:
+		symbol_databases[destination] = doxygen_squirrel_symbols.SymbolDatabase(destination);
+	symbol_databases[destination].store([(os.path.abspath(path), symbols)]);
+
+## Filter one file to output_path. Runs in a worker process.
+## The contents of the file are in the task for members of archives, otherwise they are None.
+## Returns (source path, size, messages, error, diagnostics counts) where error is None if everything
+## went fine.
+def filter_one(task):
+	size, path, output_path, cache_options, index_path, symbols_path, settings, data = task;
+	# Collect the messages of the filter so the output of parallel workers doesn't get mixed.
+	messages = MessageBuffer();
+	filters = [];
+	def new_filter(path, index):
+		filters.append(doxygen_squirrel_filter.SquirrelFilter(path, index, settings, messages));
+		return filters[-1];
+	error = None;
+	tmp_path = None;
+	try:
+		output_dir = os.path.dirname(output_path);
+		if not os.path.isdir(output_dir):
+			try:
+				os.makedirs(output_dir);
+			except OSError:
+				# Another worker may have created it in the mean time.
+				if not os.path.isdir(output_dir):
+					raise;
+		tmp_path = output_path + ".tmp" + str(os.getpid());
+		cache = doxygen_squirrel_cache.open_cache(*cache_options);
+		index = load_index(index_path);
+		with open(tmp_path, "wb") as outfile:
+			if cache is not None and symbols_path is None:
+				cache.filter_file(path, outfile, index, new_filter, data);
+			else:
+				# The symbols are found while filtering, so we can't use cached output.
+				DoxygenFilter = new_filter(path, index);
+				DoxygenFilter.data = data;
+				if symbols_path is not None:
+					DoxygenFilter.symbols = [];
+				DoxygenFilter.filter(outfile);
+		replace_file(tmp_path, output_path);
+		if symbols_path is not None:
+			store_symbols(symbols_path, path, DoxygenFilter.symbols);
+	except Exception:
+		error = traceback.format_exc();
+		if tmp_path is not None and os.path.exists(tmp_path):
+			os.remove(tmp_path);
+	counts = filters[0].diagnostics.counts if filters else {};
+	return (path, size, messages.getvalue(), error, counts);
+
+## Filter all tasks, using a pool of jobs worker processes. Yields the results of filter_one.
+## tasks is a list or an iterable like ArchiveTasks, which the pool reads while filtering.
+def run_tasks(tasks, jobs):
+	if jobs == 1 or (isinstance(tasks, list) and len(tasks) <= 1):
+		for task in tasks:
+			yield filter_one(task);
+	else:
+		pool = multiprocessing.Pool(jobs);
+		try:
+			# chunksize 1 keeps the largest first order and balances the load best.
+			for result in pool.imap_unordered(filter_one, tasks, 1):
+				yield result;
+		finally:
+			pool.close();
+			pool.join();
+
+def main(args):
+	parser = argparse.ArgumentParser(prog="doxygen_squirrel_filter.py batch",
+		description="Filter all Squirrel files below the sources into a mirror directory.");
+	parser.add_argument("sources", nargs="+", help="source directories or files");
+	parser.add_argument("-o", "--output", required=True, help="output directory for the filtered files");
+	parser.add_argument("-i", "--include", action="append",
+		help="file name pattern to include, can be repeated (default: *.nut)");
+	parser.add_argument("-x", "--exclude", action="append", default=[],
+		help="path pattern to exclude, can be repeated");
+	parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(),
+		help="number of worker processes (default: number of cpus, %(default)s)");
+	parser.add_argument("--diagnostics", choices=sorted(doxygen_squirrel_filter.DIAGNOSTIC_LEVELS),
+		default=doxygen_squirrel_filter.diagnostics_level,
+		help="which diagnostics of the filter to show (default: $SQUIRREL_FILTER_DIAGNOSTICS or %(default)s)");
+	parser.add_argument("--diagnostics-format", choices=("text", "json"), default=doxygen_squirrel_filter.diagnostics_format,
+		help="format of the diagnostics (default: $SQUIRREL_FILTER_DIAGNOSTICS_FORMAT or %(default)s)");
+	parser.add_argument("-v", "--verbose", action="store_true", help="show all diagnostics, the same as --diagnostics info");
+	doxygen_squirrel_cache.add_arguments(parser);
+	parser.add_argument("--index", default=os.environ.get("SQUIRREL_FILTER_INDEX"),
+		help="project index made with the index subcommand (default: $SQUIRREL_FILTER_INDEX)");
+	parser.add_argument("--symbols", metavar="FILE",
+		help="store the symbols of all files in this database, or in a .jsonl file");
+	options = parser.parse_args(args);
+
+	start = time.time();
+	output = os.path.abspath(options.output);
+	include = options.include or ["*.nut"];
+	exclude = options.exclude + [os.path.join(output, "*")];
+	files = find_files(options.sources, include, exclude);
+	cache_options = (options.cache, options.cache_size, options.cache_ir);
+	index_path = options.index and os.path.abspath(options.index);
+	symbols_path = options.symbols and os.path.abspath(options.symbols);
+	settings = doxygen_squirrel_filter.FilterSettings(diagnostics_level="info" if options.verbose else options.diagnostics,
+		diagnostics_format=options.diagnostics_format);
+	task_options = (cache_options, index_path, symbols_path, settings);
+	tasks = [(size, path, os.path.join(output, relpath)) + task_options + (None,)
+		for size, path, relpath in files];
+	jobs = max(1, options.jobs);
+	archives = find_files(options.sources, include, exclude, archives=True);
+	if archives:
+		archive_tasks = ArchiveTasks(archives, include, exclude, output, task_options, 4 * jobs);
+		tasks = itertools.chain(tasks, archive_tasks);
+
+	failed = 0;
+	filtered = 0;
+	total_size = 0;
+	totals = {};
+	for path, size, messages, error, counts in run_tasks(tasks, jobs):
+		if archives:
+			archive_tasks.done(path);
+		filtered += 1;
+		total_size += size;
+		# The diagnostics of a file come in one piece.
+		if messages:
+			doxygen_squirrel_filter.alwaysprint(messages);
+		doxygen_squirrel_filter.add_counts(totals, counts);
+		if error is not None:
+			failed += 1;
+			doxygen_squirrel_filter.alwaysprint("** Error filtering " + path + ":\n" + error);
+
+	elapsed = max(time.time() - start, 1e-6);
+	doxygen_squirrel_filter.alwaysprint("Filtered %d files (%.2f MB) in %.2f s: %.1f files/s, %.2f MB/s.\n" %
+		(filtered, total_size / 1e6, elapsed, filtered / elapsed, total_size / 1e6 / elapsed));
+	cache = doxygen_squirrel_cache.open_cache(*cache_options);
+	if cache is not None:
+		hits, misses, size = cache.read_counters();
+		doxygen_squirrel_filter.alwaysprint("Cache: %d hits, %d misses in total.\n" % (hits, misses));
+	if totals:
+		doxygen_squirrel_filter.alwaysprint(doxygen_squirrel_filter.format_counts(totals, options.diagnostics_format));
+	unreadable = archive_tasks.failed if archives else 0;
+	if unreadable:
+		doxygen_squirrel_filter.alwaysprint("%d archives could not be read.\n" % unreadable);
+	if failed:
+		doxygen_squirrel_filter.alwaysprint("%d files failed.\n" % failed);
+	return 1 if failed or unreadable else 0;
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]));
@@ -0,0 +1,505 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Benchmarks for the doxygen Squirrel filter.
+# Copyright (C) 2015, 2019  Jacob Boerema
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# -------------------------------------------------------------------------
+
+## @file doxygen_squirrel_bench.py Benchmark the filter on generated Squirrel sources.
+
+## Usage:
+## + python doxygen_squirrel_filter.py bench [--size MB] [--save results.json] [--compare baseline.json]
+##
+## Generates an OpenTTD AI like corpus with many classes, functions defined outside their class,
+## private symbols, comments and strings, plus some pathological files: a minified file on
+## one line with thousands of braces, lines full of strings and comments and deeply nested
+## blocks close to the block level limit of parse_blocks. Every case is filtered in a separate
+## process so we can report its peak memory use. We report lines/s, MB/s, peak RSS and the time
+## spent in the main parts of the filter, measured with cProfile in a second run and scaled to
+## the time of the normal run.
+## With --compare the results are compared with a saved run and we exit with 1 when a case
+## or one of its parts got slower than the threshold.
+## With --verify nothing is timed: the test fixture is filtered and compared with the expected output
+## in test/*.nut.expected and diagnostics in test/*.nut.diagnostics, and the test fixture and the generated cases are filtered with and
+## without the line memo, and we exit with 1 when the output, rule hits or diagnostics differ.
+## It also checks that render_ir gives the same output as filtering with every combination of the render settings,
+## that the live preview gives the same output as filtering after random edits, and that --stats records
+## a second run with --cache as a cache hit with the same output.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+## Parts of the filter that we report the time for.
+PHASES = ("line_handler", "line_handler_cursor", "filter_part", "parse_blocks", "WriteBuf", "prescan");
+
+## Default allowed slowdown in percent before --compare reports a regression.
+DEFAULT_THRESHOLD = 10.0;
+
+## Differences smaller than this many seconds are noise, not regressions.
+MIN_DELTA = 0.005;
+
+# --------------------------------------------------------------------------------------------------
+# Corpus generators
+# --------------------------------------------------------------------------------------------------
+
+## Generate an OpenTTD AI like script of about size bytes.
+def generate_realistic(size, seed=1):
+	rnd = random.Random(seed);
+	parts = ['/**\n * @file generated.nut Generated benchmark script.\n */\n\nrequire("util.nut");\nimport("pathfinder.road", "RoadPathFinder", 4);\n\n'];
+	total = len(parts[0]);
+	index = 0;
+	while total < size:
+		index += 1;
+		name = "Class%d" % index;
+		if index % 7 == 0:
+			name = "Lib%d.%s" % (index % 5, name);
+		base = rnd.choice(("AIController", "Base", "Class%d" % max(1, index - 1)));
+		lines = [];
+		lines.append("/** The %s constant. */\nconst %s = %d;\n\n" % ("MAX_%d" % index, "MAX_%d" % index, index));
+		lines.append("/**\n * %s does things for the AI.\n * It has several members.\n */\n" % name);
+		lines.append("class %s extends %s\n{\n" % (name, base));
+		lines.append("\tdistance = 0;\t\t\t///< public member\n");
+		lines.append("\t_cache = null;\t\t\t///< private member\n");
+		lines.append("\tnames = [\"a\", \"b\", \"c\"];\t///< some strings\n");
+		if index % 3 == 0:
+			lines.append("\t/** Private enum. */\n\tenum _State {\n\t\tIDLE,\n\t\tBUSY\n\t}\n");
+		lines.append("\n\t/** Construct %s. */\n\tconstructor()\n\t{\n\t\tthis._cache = {};\n\t}\n" % name);
+		outside = [];
+		for f in range(rnd.randint(3, 12)):
+			fname = ("_helper%d" if f % 5 == 4 else "Do%d") % f;
+			params = ", ".join("p%d" % p for p in range(rnd.randint(0, 4)));
+			if rnd.random() < 0.3:
+				outside.append((fname, params));
+				lines.append("\t/** Declared here, defined outside the class. */\n\tfunction %s(%s);\n" % (fname, params));
+				continue;
+			lines.append("\n\t/**\n\t * %s of %s.\n\t * @param p0 First parameter.\n\t * @return Something.\n\t */\n" % (fname, name));
+			lines.append("\tfunction %s(%s)\n\t{\n" % (fname, params));
+			lines.append("\t\tlocal list = AITileList(); // tiles\n");
+			lines.append("\t\tforeach (tile, value in list) {\n");
+			lines.append("\t\t\tif (AITile.IsBuildable(tile)) { AILog.Info(\"buildable \" + tile); }\n");
+			lines.append("\t\t\t/* skip the rest */\n\t\t}\n");
+			lines.append("\t\treturn null;\n\t}\n");
+		lines.append("}\n\n");
+		for fname, params in outside:
+			lines.append("function %s::%s(%s)\n{\n\tAILog.Warning(\"outside: %s\");\n\treturn %s;\n}\n\n" % (name, fname, params, fname, params.split(", ")[0] or "0"));
+		if rnd.random() < 0.2:
+			lines.append("function %s::Extra%d(a,\n\tb)\n{\n\treturn a * b; // multiplied\n}\n\n" % (name, index));
+		text = "".join(lines);
+		parts.append(text);
+		total += len(text);
+	return "".join(parts);
+
+## Generate a minified script on a single line with about braces pairs of braces.
+def generate_minified(braces):
+	parts = ["class Mini{"];
+	count = 0;
+	index = 0;
+	while count < braces:
+		index += 1;
+		parts.append("function f%d(a){if(a){b();}else{c();}foreach(x in a){d(x);}}" % index);
+		count += 4;
+	parts.append("}");
+	return " ".join(parts) + "\n";
+
+## Generate lines that are full of strings and comments.
+def generate_dense(lines):
+	line = '\t\tlocal s = "a" + "b" /* c */ + "d\\"e" + "f" /* g */ + \'"\' + "h"; // end of line\n';
+	return "class Dense\n{\n\tfunction f()\n\t{\n" + line * lines + "\t}\n}\n";
+
+## Generate deeply nested blocks, depth must stay below the block level limit of 50.
+def generate_deep(depth, repeat):
+	block = [];
+	for level in range(depth):
+		block.append("\t" * level + "if (a%d) {\n" % level);
+	for level in reversed(range(depth)):
+		block.append("\t" * level + "}\n");
+	return "function Deep()\n{\n" + "".join(block) * repeat + "}\n";
+
+## Return a list of (case name, file contents) for all benchmark cases.
+def generate_cases(size_mb):
+	scale = max(size_mb, 0.1);
+	return [
+		("realistic", generate_realistic(int(size_mb * 1000000))),
+		("minified", generate_minified(int(20000 * scale))),
+		("dense", generate_dense(int(10000 * scale))),
+		("deep", generate_deep(48, int(200 * scale))),
+	];
+
+# --------------------------------------------------------------------------------------------------
+# Measuring
+# --------------------------------------------------------------------------------------------------
+
+## Output stream that only counts what is written.
+class CountingWriter:
+	def __init__(self):
+		self.size = 0;
+
+	def write(self, data):
+		self.size += len(data);
+
+	def flush(self):
+		pass;
+
+## Filter path once and return the elapsed time and the size of the output.
+def run_filter(path):
+	import doxygen_squirrel_filter
+	out = CountingWriter();
+	start = time.time();
+	doxygen_squirrel_filter.SquirrelFilter(path, messages=CountingWriter()).filter(out);
+	elapsed = time.time() - start;
+	return elapsed, out.size;
+
+## Measure one file. This runs in a separate process, so the peak RSS belongs to this case.
+def measure(path, repeat):
+	import cProfile
+	import pstats
+	import resource
+
+	best = None;
+	for run in range(repeat):
+		elapsed, output_size = run_filter(path);
+		if best is None or elapsed < best:
+			best = elapsed;
+	peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss;
+	if sys.platform == "darwin":
+		peak_rss //= 1024;
+
+	# Time per part of the filter, from a profiled run scaled to the normal run time.
+	profiler = cProfile.Profile();
+	profiler.enable();
+	profiled, output_size = run_filter(path);
+	profiler.disable();
+	phases = {};
+	for (filename, line, function), data in pstats.Stats(profiler).stats.items():
+		if function in PHASES and os.path.basename(filename) == "doxygen_squirrel_filter.py":
+			phases[function] = phases.get(function, 0.0) + data[3];
+	for function in phases:
+		phases[function] = phases[function] / max(profiled, 1e-9) * best;
+
+	size = os.path.getsize(path);
+	with open(path, "rb") as nut_file:
+		lines = nut_file.read().count(b"\n");
+	return {
+		"bytes": size,
+		"lines": lines,
+		"seconds": best,
+		"lines_per_s": lines / max(best, 1e-9),
+		"mb_per_s": size / 1e6 / max(best, 1e-9),
+		"peak_rss_kb": peak_rss,
+		"phases": phases,
+	};
+
+## Directory with the test fixtures.
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test");
+
+## Return the cases with the test fixtures in front.
+def with_fixtures(cases):
+	if os.path.isdir(FIXTURES):
+		for name in sorted(os.listdir(FIXTURES)):
+			if name.endswith(".nut"):
+				with open(os.path.join(FIXTURES, name), "rb") as nut_file:
+					cases = [(name, nut_file.read().decode("utf-8"))] + cases;
+	return cases;
+
+## Filter every test fixture that has a name.nut.expected file next to it with the module settings
+## and compare the output with that file, and the diagnostics of the info level with name.nut.diagnostics
+## if there is one. Returns a list of differences.
+def verify_expected():
+	import doxygen_squirrel_filter
+	import doxygen_squirrel_batch
+	found = [];
+	if not os.path.isdir(FIXTURES):
+		return found;
+	for name in sorted(os.listdir(FIXTURES)):
+		expected_path = os.path.join(FIXTURES, name + ".expected");
+		if not name.endswith(".nut") or not os.path.exists(expected_path):
+			continue;
+		with open(os.path.join(FIXTURES, name), "rb") as nut_file:
+			text = nut_file.read().decode("utf-8");
+		with open(expected_path, "rb") as expected_file:
+			expected = expected_file.read().decode("utf-8");
+		settings = doxygen_squirrel_filter.FilterSettings(diagnostics_level="info", diagnostics_format="text");
+		messages = doxygen_squirrel_batch.MessageBuffer();
+		output = doxygen_squirrel_filter.SquirrelFilter(name, settings=settings, messages=messages).filter_text(text);
+		same = output == expected;
+		diagnostics_path = os.path.join(FIXTURES, name + ".diagnostics");
+		if os.path.exists(diagnostics_path):
+			with open(diagnostics_path, "rb") as diagnostics_file:
+				same = same and messages.getvalue() == diagnostics_file.read().decode("utf-8");
+		if not same:
+			found.append(name);
+		sys.stdout.write("%-26s %-15s %s\n" % (name, "expected", "same" if same else "DIFFERENT"));
+	return found;
+
+## Filter every case with and without the line memo, with both lexers and with elide_bodies.
+## Returns a list of differences.
+def verify_memo(cases):
+	import doxygen_squirrel_filter
+	found = [];
+	for name, text in cases:
+		for engine, elide in (("cursor", False), ("legacy", False), ("cursor", True)):
+			results = [];
+			for size in (0, doxygen_squirrel_filter.line_memo_size or 4096):
+				settings = doxygen_squirrel_filter.FilterSettings(lexer_engine=engine, elide_bodies=elide, line_memo_size=size);
+				DoxygenFilter = doxygen_squirrel_filter.SquirrelFilter(name, settings=settings, messages=CountingWriter());
+				output = DoxygenFilter.filter_text(text);
+				results.append((output, DoxygenFilter.rule_hits, DoxygenFilter.functions_added, DoxygenFilter.diagnostics.counts));
+			memo = DoxygenFilter.memo.stats();
+			same = results[0] == results[1];
+			variant = engine + (", elided" if elide else "");
+			if not same:
+				found.append("%s (%s)" % (name, variant));
+			sys.stdout.write("%-26s %-15s %s  line memo hit rate %.1f%%\n" % (name, variant, "same" if same else "DIFFERENT",
+				memo["hit_rate"] * 100));
+	return found;
+
+## Render the IR of every case, made with the default settings and with elide_bodies, with every combination
+## of the render settings and compare that with filtering with those settings. Returns a list of differences.
+def verify_ir(cases):
+	import itertools
+	import doxygen_squirrel_filter
+	found = [];
+	for name, text in cases:
+		for elide in (False, True):
+			DoxygenFilter = doxygen_squirrel_filter.SquirrelFilter(name, messages=CountingWriter(),
+				settings=doxygen_squirrel_filter.FilterSettings(elide_bodies=elide));
+			DoxygenFilter.ir = True;
+			ir = DoxygenFilter.filter_text(text);
+			different = 0;
+			for values in itertools.product((True, False), repeat=len(doxygen_squirrel_filter.RENDER_SETTINGS)):
+				render = dict(zip(doxygen_squirrel_filter.RENDER_SETTINGS, values));
+				if elide and render["keep_function"] != DoxygenFilter.settings.keep_function:
+					# Part of the IR key when eliding.
+					continue;
+				settings = doxygen_squirrel_filter.FilterSettings(elide_bodies=elide, **render);
+				output = doxygen_squirrel_filter.SquirrelFilter(name, settings=settings, messages=CountingWriter()).filter_text(text);
+				if doxygen_squirrel_filter.render_ir(ir, settings) != output:
+					different += 1;
+					found.append("%s (%s)" % (name, ", ".join(setting + "=" + str(value) for setting, value in sorted(render.items()))));
+			variant = "IR, elided" if elide else "IR";
+			sys.stdout.write("%-26s %-15s %s\n" % (name, variant, "DIFFERENT" if different else "same"));
+	return found;
+
+## Number of lines of every case that verify_preview edits, filtering the whole text after every edit takes long.
+PREVIEW_LINES = 400;
+
+## Open the start of every case in a preview document, with and without elide_bodies, make random line edits
+## like typing, deleting and pasting, and compare the rendered preview with filtering the text after every edit.
+## Returns a list of differences and crashes of the filter.
+def verify_preview(cases, edits=40):
+	import traceback
+	import doxygen_squirrel_filter
+	import doxygen_squirrel_preview
+	found = [];
+	crashes = [];
+	for name, text in cases:
+		lines = doxygen_squirrel_preview.split_lines(text)[:PREVIEW_LINES];
+		for elide in (False, True):
+			settings = doxygen_squirrel_filter.FilterSettings(elide_bodies=elide);
+			document = doxygen_squirrel_preview.PreviewDocument(name, settings=settings);
+			current = [];
+			rng = random.Random(name);
+			different = 0;
+			for step in range(edits + 1):
+				if step == 0:
+					start, end, new_text = 0, 0, "".join(lines);
+				else:
+					start = rng.randrange(len(current) + 1);
+					end = min(len(current), start + rng.choice((0, 1, 1, 2)));
+					choice = rng.random();
+					if choice < 0.5 and start < len(current):
+						# Typing: part of a line.
+						line = current[start];
+						new_text = line[:rng.randrange(len(line) + 1)] + "\n";
+						end = start + 1;
+					elif choice < 0.8 and current:
+						# Pasting a line of elsewhere.
+						new_text = rng.choice(current);
+					else:
+						new_text = "";
+				current[start:end] = doxygen_squirrel_preview.split_lines(new_text);
+				try:
+					document.edit(start, end, new_text);
+					preview = document.render();
+				except doxygen_squirrel_preview.FilterError:
+					preview = None;
+				try:
+					output = doxygen_squirrel_filter.SquirrelFilter(name, settings=settings,
+						messages=CountingWriter()).filter_text("".join(current));
+				except ValueError:
+					# Broken code makes the filter give up on the block level, the preview gives a FilterError.
+					output = None;
+				except Exception:
+					# A crash of the filter is a failure itself, not a difference with the preview.
+					crashes.append("%s (%s, edit %d):\n%s" % (name, "elided" if elide else "not elided", step,
+						traceback.format_exc()));
+					output = None;
+				if preview != output:
+					different += 1;
+				# Continue from the text of the preview, it joins lines without a line ending.
+				current = list(document.lines);
+			variant = "preview" + (", elided" if elide else "");
+			if different:
+				found.append("%s (%s): %d of %d edits" % (name, variant, different, edits + 1));
+			sys.stdout.write("%-26s %-15s %s\n" % (name, variant, "DIFFERENT" if different else "same"));
+	return found + ["the filter crashed on " + crash for crash in crashes];
+
+## Filter every case twice from the command line with --cache and --stats in a new cache and check that the
+## first run is recorded as filtered and the second as a cache hit with the same output and diagnostics.
+## Returns a list of differences.
+def verify_cache_stats(cases):
+	filter_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "doxygen_squirrel_filter.py");
+	found = [];
+	directory = tempfile.mkdtemp(prefix="squirrel_verify");
+	try:
+		for name, text in cases:
+			path = os.path.join(directory, name + ".nut");
+			with open(path, "wb") as nut_file:
+				nut_file.write(text.encode("utf-8"));
+			cache_dir = os.path.join(directory, name + ".cache");
+			stats_path = os.path.join(directory, name + ".jsonl");
+			command = [sys.executable, filter_script, "--cache=" + cache_dir, "--stats=" + stats_path,
+				"--diagnostics=info", "--diagnostics-format=json", path];
+			runs = [subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate() for run in range(2)];
+			with open(stats_path, "r") as stats_file:
+				records = [json.loads(line) for line in stats_file];
+			problems = [];
+			if runs[0] != runs[1]:
+				problems.append("output or diagnostics");
+			if len(records) != 2 or records[0].get("cached") or not records[1].get("cached"):
+				problems.append("cached " + ", ".join(str(record.get("cached")) for record in records));
+			elif records[0].get("diagnostics") != records[1].get("diagnostics"):
+				problems.append("diagnostics counts");
+			if problems:
+				found.append("%s: %s" % (name, ", ".join(problems)));
+			sys.stdout.write("%-26s %-15s %s\n" % (name, "cache stats", ", ".join(problems) or "same"));
+	finally:
+		shutil.rmtree(directory);
+	return found;
+
+## Run every case in its own process and return the results by case name.
+def run_cases(directory, cases, repeat):
+	results = {};
+	for name, text in cases:
+		path = os.path.join(directory, name + ".nut");
+		with open(path, "wb") as nut_file:
+			nut_file.write(text.encode("utf-8"));
+		output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--measure", path, "--repeat", str(repeat)]);
+		results[name] = json.loads(output.decode("utf-8"));
+	return results;
+
+## Print the results, with the change relative to baseline if given.
+def report(results, baseline=None):
+	sys.stdout.write("%-10s %9s %10s %9s %12s %8s  %s\n" % ("case", "MB", "lines/s", "MB/s", "peak RSS MB", "change", "parts (s)"));
+	for name in sorted(results):
+		result = results[name];
+		change = "";
+		if baseline is not None and name in baseline:
+			change = "%+.1f%%" % ((result["seconds"] / max(baseline[name]["seconds"], 1e-9) - 1) * 100);
+		phases = ", ".join("%s %.3f" % (phase, result["phases"][phase]) for phase in PHASES if phase in result["phases"]);
+		sys.stdout.write("%-10s %9.2f %10.0f %9.2f %12.1f %8s  %s\n" % (name, result["bytes"] / 1e6, result["lines_per_s"],
+			result["mb_per_s"], result["peak_rss_kb"] / 1024.0, change, phases));
+
+## Return a list of regressions compared to baseline, where a case or part got slower than threshold percent.
+def regressions(results, baseline, threshold):
+	found = [];
+	limit = 1 + threshold / 100.0;
+	slower = lambda old, new: new > old * limit and new - old > MIN_DELTA;
+	for name in sorted(results):
+		if name not in baseline:
+			continue;
+		old = baseline[name];
+		new = results[name];
+		if slower(old["seconds"], new["seconds"]):
+			found.append("%s: %.3f s -> %.3f s" % (name, old["seconds"], new["seconds"]));
+		for phase in PHASES:
+			if phase in old["phases"] and phase in new["phases"] and slower(old["phases"][phase], new["phases"][phase]):
+				found.append("%s %s: %.3f s -> %.3f s" % (name, phase, old["phases"][phase], new["phases"][phase]));
+	return found;
+
+def main(args):
+	parser = argparse.ArgumentParser(prog="doxygen_squirrel_filter.py bench",
+		description="Benchmark the filter on generated Squirrel sources.");
+	parser.add_argument("--size", type=float, default=2.0, help="size of the realistic corpus in MB, scales the other cases too (default: %(default)s)");
+	parser.add_argument("--repeat", type=int, default=3, help="number of runs per case, the fastest counts (default: %(default)s)");
+	parser.add_argument("--corpus", metavar="DIR", help="keep the generated files in DIR");
+	parser.add_argument("--save", metavar="FILE", help="save the results as JSON");
+	parser.add_argument("--compare", metavar="FILE", help="compare with results saved before");
+	parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+		help="allowed slowdown in percent for --compare (default: %(default)s)");
+	parser.add_argument("--verify", action="store_true",
+		help="check that the line memo, render_ir, the preview and the cache give the same output as filtering, instead of timing");
+	parser.add_argument("--measure", metavar="FILE", help=argparse.SUPPRESS);
+	options = parser.parse_args(args);
+
+	if options.verify:
+		found_expected = verify_expected();
+		if found_expected:
+			sys.stdout.write("Different output than expected:\n" + "".join("  " + item + "\n" for item in found_expected));
+		cases = with_fixtures(generate_cases(options.size));
+		found = verify_memo(cases);
+		if found:
+			sys.stdout.write("Different output with the line memo:\n" + "".join("  " + item + "\n" for item in found));
+		found_ir = verify_ir(cases);
+		if found_ir:
+			sys.stdout.write("Different output from render_ir:\n" + "".join("  " + item + "\n" for item in found_ir));
+		found_preview = verify_preview(cases);
+		if found_preview:
+			sys.stdout.write("Different output from the preview:\n" + "".join("  " + item + "\n" for item in found_preview));
+		found_cache = verify_cache_stats(cases);
+		if found_cache:
+			sys.stdout.write("Different runs with the cache and --stats:\n" + "".join("  " + item + "\n" for item in found_cache));
+		return 1 if found_expected or found or found_ir or found_preview or found_cache else 0;
+
+	if options.measure:
+		# Child process: measure one file.
+		sys.stdout.write(json.dumps(measure(options.measure, options.repeat)));
+		return 0;
+
+	directory = options.corpus or tempfile.mkdtemp(prefix="squirrel_bench");
+	if not os.path.isdir(directory):
+		os.makedirs(directory);
+	try:
+		results = run_cases(directory, generate_cases(options.size), options.repeat);
+	finally:
+		if not options.corpus:
+			shutil.rmtree(directory);
+
+	baseline = None;
+	if options.compare:
+		with open(options.compare, "r") as baseline_file:
+			baseline = json.load(baseline_file);
+	report(results, baseline);
+	if options.save:
+		with open(options.save, "w") as results_file:
+			json.dump(results, results_file, indent=1, sort_keys=True);
+	if baseline is not None:
+		found = regressions(results, baseline, options.threshold);
+		if found:
+			sys.stdout.write("Regressions:\n" + "".join("  " + item + "\n" for item in found));
+			return 1;
+	return 0;
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]));
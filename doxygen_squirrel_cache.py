@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# On disk cache of filtered output for the doxygen Squirrel filter.
+# Copyright (C) 2015, 2019  Jacob Boerema
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# -------------------------------------------------------------------------
+
+## @file doxygen_squirrel_cache.py Content addressed cache of filtered output.
+
+## Filtered output is stored under a hash of the input file contents, the settings that
+## influence the output and the filter version. Unchanged files, files that are byte identical
+## to files in other projects and the second call doxygen makes with FILTER_SOURCE_FILES=YES
+## are then answered from the cache. The diagnostics are stored with the output and written again
+## when it's used, at the diagnostics level of the filter.
+##
+## Usage:
+## + python doxygen_squirrel_filter.py --cache=dir [--cache-size=MB] filename
+## + or set the environment variables SQUIRREL_FILTER_CACHE and SQUIRREL_FILTER_CACHE_SIZE.
+## + python doxygen_squirrel_filter.py cache [--clear] dir shows the hit/miss counters.
+##
+## Entries are written to a temporary file and renamed, so parallel filters never see a
+## partially written entry. The counters and the eviction are protected by a lock file.
+## The least recently used entries are removed when the cache grows over its maximum size.
+##
+## With --cache-ir (or SQUIRREL_FILTER_CACHE_IR=1) the cache also stores the output of the filter
+## before the render settings keep_function, keep_constructor and hide_private_symbols are applied
+## (see render_ir in doxygen_squirrel_filter.py). Documentation variants that only differ in these
+## settings then parse every file once; the other variants only replace the markers in the stored output.
+
+import os
+import io
+import sys
+import json
+import hashlib
+import argparse
+import threading
+
+try:
+	import fcntl
+except ImportError:
+	# Windows: no locking, the counters may be slightly off when filtering in parallel.
+	fcntl = None;
+
+import doxygen_squirrel_filter
+
+## Default maximum size of the cache in MB.
+DEFAULT_MAX_SIZE_MB = 256;
+
+## Version of the format of the entries, part of the key so entries in an older format are not read.
+ENTRY_FORMAT = "2";
+
+## When the cache is too large we remove entries until it's at this fraction of the maximum size.
+EVICT_TO = 0.9;
+
+## Exclusive lock on a file in the cache directory.
+class CacheLock:
+	def __init__(self, path):
+		self.path = path;
+		self.lockfile = None;
+
+	def __enter__(self):
+		self.lockfile = open(self.path, "a");
+		if fcntl is not None:
+			fcntl.flock(self.lockfile.fileno(), fcntl.LOCK_EX);
+		return self;
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if fcntl is not None:
+			fcntl.flock(self.lockfile.fileno(), fcntl.LOCK_UN);
+		self.lockfile.close();
+		return False;
+
+## FilterCache stores filtered output by the hash of its input.
+class FilterCache:
+	## With ir the output before the render settings are applied is cached too.
+	def __init__(self, directory, max_size_mb=DEFAULT_MAX_SIZE_MB, ir=False):
+		self.directory = directory;
+		self.max_size = int(max_size_mb * 1024 * 1024);
+		self.ir = ir;
+		self.objects = os.path.join(directory, "objects");
+		self.counters_path = os.path.join(directory, "counters");
+		## Counters of this process. The totals of all processes are kept in the counters file.
+		self.hits = 0;
+		self.misses = 0;
+		if not os.path.isdir(self.objects):
+			try:
+				os.makedirs(self.objects);
+			except OSError:
+				if not os.path.isdir(self.objects):
+					raise;
+
+	## Return the key for the input data with settings, or else the module settings, and the digest of the
+	## project index if one is used. With ir the key of the output before the render settings are applied.
+	def key(self, data, index_digest="", ir=False, settings=None):
+		if settings is None:
+			settings = doxygen_squirrel_filter.FilterSettings();
+		digest = hashlib.sha256();
+		digest.update((doxygen_squirrel_filter.FILTER_VERSION + "/" + ENTRY_FORMAT).encode("ascii"));
+		if ir:
+			digest.update(b"ir" + repr(settings.ir_key()).encode("ascii"));
+		else:
+			digest.update(repr(doxygen_squirrel_filter.output_settings(settings)).encode("ascii"));
+		digest.update(index_digest.encode("ascii"));
+		digest.update(b"\0");
+		digest.update(data);
+		return digest.hexdigest();
+
+	def entry_path(self, key):
+		return os.path.join(self.objects, key[:2], key[2:]);
+
+	## Return the cached output for key or None. With count False the lookup isn't counted, the caller
+	## counts it with count_lookup.
+	def get(self, key, count=True):
+		path = self.entry_path(key);
+		try:
+			with open(path, "rb") as entry:
+				output = entry.read();
+		except (IOError, OSError):
+			if count:
+				self.count_lookup(False);
+			return None;
+		# Mark as recently used.
+		try:
+			os.utime(path, None);
+		except OSError:
+			pass;
+		if count:
+			self.count_lookup(True);
+		return output;
+
+	## Count one lookup as a hit or a miss.
+	def count_lookup(self, hit):
+		if hit:
+			self.hits += 1;
+			self.update_counters(1, 0, 0);
+		else:
+			self.misses += 1;
+			self.update_counters(0, 1, 0);
+
+	## Store output for key.
+	def put(self, key, output):
+		path = self.entry_path(key);
+		if os.path.exists(path):
+			return;
+		entry_dir = os.path.dirname(path);
+		if not os.path.isdir(entry_dir):
+			try:
+				os.mkdir(entry_dir);
+			except OSError:
+				if not os.path.isdir(entry_dir):
+					raise;
+		# Unique per process and thread, the filter server stores entries from several threads.
+		tmp_path = "%s.tmp%d.%d" % (path, os.getpid(), threading.current_thread().ident);
+		with open(tmp_path, "wb") as entry:
+			entry.write(output);
+		try:
+			os.rename(tmp_path, path);
+		except OSError:
+			# Windows doesn't replace existing files; another process stored the same output.
+			try:
+				os.remove(tmp_path);
+			except OSError:
+				pass;
+			return;
+		size = self.update_counters(0, 0, len(output));
+		if size > self.max_size:
+			self.evict();
+
+	## Read the counters file: returns [hits, misses, size].
+	def read_counters(self):
+		try:
+			with open(self.counters_path, "r") as counters:
+				values = [int(value) for value in counters.read().split()];
+			if len(values) == 3:
+				return values;
+		except (IOError, OSError, ValueError):
+			pass;
+		return [0, 0, 0];
+
+	def write_counters(self, values):
+		with open(self.counters_path, "w") as counters:
+			counters.write(" ".join(str(value) for value in values) + "\n");
+
+	## Add to the shared counters. Returns the new total size of the cache.
+	def update_counters(self, hits, misses, size):
+		with CacheLock(self.counters_path + ".lock"):
+			values = self.read_counters();
+			values[0] += hits;
+			values[1] += misses;
+			values[2] += size;
+			self.write_counters(values);
+		return values[2];
+
+	## Return a list of (last used time, size, path) of all entries. With tmp also the temporary files of
+	## entries that are being stored, which evict leaves alone since their process still renames them.
+	def entries(self, tmp=False):
+		result = [];
+		for dirpath, dirnames, filenames in os.walk(self.objects):
+			for filename in filenames:
+				if not tmp and ".tmp" in filename:
+					continue;
+				path = os.path.join(dirpath, filename);
+				try:
+					info = os.stat(path);
+				except OSError:
+					continue;
+				result.append((info.st_mtime, info.st_size, path));
+		return result;
+
+	## Remove the least recently used entries until the cache is small enough.
+	def evict(self):
+		with CacheLock(self.counters_path + ".lock"):
+			entries = self.entries();
+			size = sum(entry[1] for entry in entries);
+			if size > self.max_size:
+				entries.sort();
+				for mtime, entry_size, path in entries:
+					if size <= self.max_size * EVICT_TO:
+						break;
+					try:
+						os.remove(path);
+					except OSError:
+						pass;
+					size -= entry_size;
+			values = self.read_counters();
+			values[2] = size;
+			self.write_counters(values);
+
+	## Remove all entries and reset the counters.
+	def clear(self):
+		with CacheLock(self.counters_path + ".lock"):
+			for mtime, size, path in self.entries(True):
+				try:
+					os.remove(path);
+				except OSError:
+					pass;
+			self.write_counters([0, 0, 0]);
+
+	## Filter filename to outfile, using the cached output if available.
+	## new_filter creates the SquirrelFilter, its settings are part of the key. When the output is cached
+	## it only writes the diagnostics that were stored with it.
+	## filename may be a member of an archive. data are the contents of the file if they were already read.
+	def filter_file(self, filename, outfile, index=None, new_filter=doxygen_squirrel_filter.SquirrelFilter, data=None):
+		if data is None:
+			if doxygen_squirrel_filter.ARCHIVE_SEPARATOR in filename and not os.path.exists(filename):
+				import doxygen_squirrel_archive
+				data = doxygen_squirrel_archive.read_source(filename);
+			else:
+				with open(filename, "rb") as nut_file:
+					data = nut_file.read();
+		DoxygenFilter = new_filter(filename, index);
+		settings = DoxygenFilter.settings;
+		index_digest = index.digest if index is not None else "";
+		key = self.key(data, index_digest, settings=settings);
+		# A lookup of the output and then of the IR is counted as one.
+		entry = self.get(key, False);
+		filtered = False;
+		if entry is not None:
+			output, kept = unpack_entry(entry);
+		else:
+			output = None;
+			# Files containing the markers of render_ir are filtered without.
+			use_ir = self.ir and doxygen_squirrel_filter.re_ir_marker.search(data) is None;
+			if use_ir:
+				ir_key = self.key(data, index_digest, True, settings);
+				ir_entry = self.get(ir_key, False);
+				if ir_entry is not None:
+					ir, kept = unpack_entry(ir_entry);
+					output = doxygen_squirrel_filter.render_ir(ir, settings);
+			if output is None:
+				buffer = io.BytesIO();
+				# Don't read the file again.
+				DoxygenFilter.data = data;
+				DoxygenFilter.ir = use_ir;
+				kept = DoxygenFilter.diagnostics.kept = [];
+				DoxygenFilter.filter(buffer);
+				filtered = True;
+				output = buffer.getvalue();
+				if use_ir:
+					self.put(ir_key, pack_entry(output, kept));
+					output = doxygen_squirrel_filter.render_ir(output, settings);
+			self.put(key, pack_entry(output, kept));
+		self.count_lookup(not filtered);
+		DoxygenFilter.from_cache = not filtered;
+		if not filtered:
+			# The diagnostics level and format of the filter decide what is written, and they are counted again.
+			for kind, line, message in kept:
+				DoxygenFilter.diagnostics.add(kind, line, message);
+		outfile.write(output);
+		if not filtered:
+			DoxygenFilter.flush_diagnostics();
+
+## Return an entry of filter_file: the diagnostics, (kind, line, message) of every one, as a JSON line
+## followed by the output.
+def pack_entry(output, diagnostics):
+	return json.dumps(diagnostics).encode("ascii") + b"\n" + output;
+
+## Return (output, diagnostics) of an entry of filter_file.
+def unpack_entry(entry):
+	end = entry.index(b"\n");
+	return entry[end + 1:], json.loads(entry[:end].decode("ascii"));
+
+## Return the cache that is configured by the options or environment, or None if no cache is used.
+def open_cache(directory=None, size_mb=None, ir=None):
+	if directory is None:
+		directory = os.environ.get("SQUIRREL_FILTER_CACHE");
+	if not directory:
+		return None;
+	if size_mb is None:
+		size_mb = float(os.environ.get("SQUIRREL_FILTER_CACHE_SIZE", DEFAULT_MAX_SIZE_MB));
+	if ir is None:
+		ir = os.environ.get("SQUIRREL_FILTER_CACHE_IR", "0") not in ("0", "");
+	return FilterCache(directory, size_mb, ir);
+
+## Add the cache options to an argparse parser.
+def add_arguments(parser):
+	parser.add_argument("--cache", metavar="DIR",
+		help="cache filtered output in DIR (default: $SQUIRREL_FILTER_CACHE)");
+	parser.add_argument("--cache-size", metavar="MB", type=float,
+		help="maximum size of the cache (default: $SQUIRREL_FILTER_CACHE_SIZE or %d)" % DEFAULT_MAX_SIZE_MB);
+	parser.add_argument("--cache-ir", action="store_true", default=None,
+		help="also cache the output before keep_function, keep_constructor and hide_private_symbols are applied, "
+		"for documentation variants that only differ in these (default: $SQUIRREL_FILTER_CACHE_IR)");
+
+def main(args):
+	parser = argparse.ArgumentParser(prog="doxygen_squirrel_filter.py cache",
+		description="Show the counters of a filter cache or clear it.");
+	parser.add_argument("directory", help="cache directory");
+	parser.add_argument("--clear", action="store_true", help="remove all cached output");
+	options = parser.parse_args(args);
+
+	cache = FilterCache(options.directory);
+	if options.clear:
+		cache.clear();
+	hits, misses, size = cache.read_counters();
+	entries = cache.entries();
+	total = hits + misses;
+	sys.stdout.write("entries: %d\nsize: %.2f MB\nhits: %d\nmisses: %d\nhit rate: %.1f%%\n" %
+		(len(entries), sum(entry[1] for entry in entries) / 1048576.0, hits, misses,
+		100.0 * hits / total if total else 0.0));
+	return 0;
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]));
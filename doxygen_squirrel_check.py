@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Checking Squirrel sources for things that confuse doxygen, without filtering them.
+# Copyright (C) 2015, 2019  Jacob Boerema
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# -------------------------------------------------------------------------
+
+## @file doxygen_squirrel_check.py Check Squirrel sources for things that confuse doxygen, without filtering them.
+
+## Usage:
+## + python doxygen_squirrel_filter.py check [-j N] [-x pattern] [--ignore kind] source_dir_or_file ...
+##
+## Reports every finding as file:line: severity: message [kind] and exits with 1 if there are any:
+## + const-semicolon: a global const that isn't ended by ";" on its line.
+## + enum-semicolon: no ";" after the "}" of a global enum.
+## + unknown-class: Class::function of a class that isn't defined in any of the checked files.
+## + block-level: a "}" too many, or a "{" that isn't closed at the end of the file.
+## + unterminated-string: a string constant without an end on its line.
+##
+## The check keeps track of comments, strings and the block level the same way as the filter and finds
+## classes and Class::function definitions with the regular expressions of the filter, but it walks the
+## whole file from token to token instead of line by line, and builds no output.
+
+import re
+import sys
+import argparse
+import multiprocessing
+
+import doxygen_squirrel_filter
+import doxygen_squirrel_batch
+
+SquirrelFilter = doxygen_squirrel_filter.SquirrelFilter;
+
+## Kinds of findings and their severity.
+CHECK_KINDS = {
+	"const-semicolon": "error",         # Global const not ended by ";", doxygen skips what follows.
+	"enum-semicolon": "error",          # Global enum not ended by ";", doxygen skips what follows.
+	"unknown-class": "error",           # Class::function of a class that isn't defined in any checked file.
+	"block-level": "error",             # "}" without "{" or "{" without "}".
+	"unterminated-string": "warning",   # String constant without an end on its line.
+};
+
+## The tokens that matter to the check. Comments, strings and character constants are matched completely
+## and skipped, the groups are a "{", a "}", a string without an end on its line, which is skipped up to the
+## end of the line like the filter does, and the keywords that start a class, enum, const or function.
+## The lookahead lets the search skip the characters that can't start a token without trying every alternative.
+re_check_token = re.compile("(?=[/@\"'{}cef])(?:/[*](?:[^*]*[*]+(?:[^*/][^*]*[*]+)*/|[\\s\\S]*)|//[^\\r\\n]*|@\"[^\"]*(?:\"\"[^\"]*)*(?:\"|[\\s\\S]*)|"
+	"\"[^\"\\\\\\r\\n]*(?:\\\\.[^\"\\\\\\r\\n]*)*\"|'(?:[^'\\\\\\r\\n]|\\\\.)'|"
+	"(\\{)|(\\})|(\"[^\\r\\n]*)|\\b(class|enum|const|function)\\b)");
+## Rest of the line of a const: anything up to a ";" or the end of the line, skipping strings and comments.
+re_const_rest = re.compile("(?:[^;\"/\\r\\n]|\"(?:[^\"\\\\\\r\\n]|\\\\.)*\"|/[*](?:[^*\\r\\n]|[*](?!/))*[*]/|/(?![/*]))*");
+## Name of an enum or const after the keyword.
+re_declared_name = re.compile("\\s+([a-zA-Z_][a-zA-Z_0-9]*)");
+
+## Called with a position in text returns the number of its line, counted like reading it with newline=''.
+## The positions must not go back, every call only counts the lines after the previous position.
+class LineCounter(object):
+	__slots__ = ("text", "pos", "line");
+
+	def __init__(self, text):
+		self.text = text;
+		self.pos = 0;
+		self.line = 1;
+
+	def __call__(self, pos):
+		text = self.text;
+		self.line += text.count("\n", self.pos, pos) + text.count("\r", self.pos, pos) - text.count("\r\n", self.pos, pos);
+		self.pos = pos;
+		return self.line;
+
+## Check the Squirrel source text. Returns (names of the classes defined in it, (class, function, line)
+## of the first Class::function per class, findings as (line, kind, message)).
+def check_text(text):
+	classes = [];
+	outside = {};
+	findings = [];
+	line_at = LineCounter(text);
+	block_level = 0;
+	want_class_start = False;
+	in_class = False;
+	## Name of the global enum that we are looking for the end of, or None.
+	enum_name = None;
+	enum_open = False;
+
+	for token in re_check_token.finditer(text):
+		group = token.lastindex;
+		if group is None:
+			# Comment, string or character constant.
+			continue;
+		if group == 1:
+			block_level += 1;
+			if block_level == 1:
+				if want_class_start:
+					want_class_start = False;
+					in_class = True;
+				elif enum_name is not None:
+					enum_open = True;
+			elif block_level > 50:
+				findings.append((line_at(token.start()), "block-level", "block level " + str(block_level) + ", too many '{'"));
+				break;
+		elif group == 2:
+			block_level -= 1;
+			if block_level < 0:
+				findings.append((line_at(token.start()), "block-level", "block level " + str(block_level) + ", too many '}'"));
+				block_level = 0;
+			elif block_level == 0:
+				if in_class:
+					in_class = False;
+				elif enum_open:
+					if SquirrelFilter.re_classend.match(text, token.end()) is None:
+						findings.append((line_at(token.start()), "enum-semicolon", "no ';' after the end of enum " + enum_name));
+					enum_name = None;
+					enum_open = False;
+		elif group == 3:
+			findings.append((line_at(token.start()), "unterminated-string", "didn't find end of string"));
+		elif block_level == 0:
+			keyword = token.group(4);
+			if keyword == "class":
+				classname = SquirrelFilter.re_classname.match(text, token.start());
+				if classname:
+					classes.append(classname.group(1));
+					want_class_start = True;
+			elif keyword == "enum":
+				name = re_declared_name.match(text, token.end());
+				enum_name = name.group(1) if name else "";
+			elif keyword == "const":
+				rest = re_const_rest.match(text, token.end());
+				if not text.startswith(";", rest.end()):
+					name = re_declared_name.match(text, token.end());
+					findings.append((line_at(token.start()), "const-semicolon",
+						"no ';' at the end of const " + (name.group(1) if name else "")));
+			else:
+				fn_name = SquirrelFilter.re_classfunctionname.match(text, token.start());
+				if fn_name and fn_name.group(2) not in outside:
+					outside[fn_name.group(2)] = (fn_name.group(3), line_at(token.start()));
+	if block_level > 0:
+		findings.append((line_at(len(text)), "block-level", "block level " + str(block_level) + " at the end of the file, too many '{'"));
+	return classes, [(cname, fname, line) for cname, (fname, line) in outside.items()], findings;
+
+## Check the file at path. Runs in a worker process. Returns (path, result of check_text, error).
+def check_file(path):
+	try:
+		with open(path, "rb") as nut_file:
+			# latin-1 never fails and keeps every byte, we only look at ASCII.
+			text = nut_file.read().decode("latin-1");
+		return path, check_text(text), None;
+	except (IOError, OSError) as e:
+		return path, None, str(e);
+
+## Check all files found in sources with jobs processes. Returns a list of (path, findings) sorted by path,
+## the findings of a file as (severity, kind, line, message) like the records of Diagnostics, and the
+## number of files that could not be read.
+def check_files(sources, include, exclude, jobs=1):
+	paths = [path for size, path, relpath in doxygen_squirrel_batch.find_files(sources, include, exclude)];
+	if jobs > 1 and len(paths) > 1:
+		pool = multiprocessing.Pool(jobs);
+		# Checking a file takes so little time that sending tasks one by one would cost more.
+		results = list(pool.imap_unordered(check_file, paths, max(1, len(paths) // (jobs * 8))));
+		pool.close();
+		pool.join();
+	else:
+		results = [check_file(path) for path in paths];
+
+	defined = set();
+	for path, result, error in results:
+		if result is not None:
+			defined.update(result[0]);
+	checked = [];
+	failed = 0;
+	for path, result, error in sorted(results):
+		if result is None:
+			doxygen_squirrel_filter.alwaysprint("** Error checking " + path + ": " + error + "\n");
+			failed += 1;
+			continue;
+		classes, outside, findings = result;
+		for cname, fname, line in outside:
+			if cname not in defined:
+				findings.append((line, "unknown-class", "class " + cname + " of " + cname + "::" + fname + " isn't defined in any checked file"));
+		checked.append((path, [(CHECK_KINDS[kind], kind, line, message) for line, kind, message in findings]));
+	return checked, failed;
+
+def main(args):
+	parser = argparse.ArgumentParser(prog="doxygen_squirrel_filter.py check",
+		description="Check Squirrel files for things that confuse doxygen, without filtering them.");
+	parser.add_argument("sources", nargs="+", help="source directories or files");
+	parser.add_argument("-i", "--include", action="append",
+		help="file name pattern to include, can be repeated (default: *.nut)");
+	parser.add_argument("-x", "--exclude", action="append", default=[],
+		help="path pattern to exclude, can be repeated");
+	parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(),
+		help="number of worker processes (default: number of cpus, %(default)s)");
+	parser.add_argument("--ignore", action="append", default=[], choices=sorted(CHECK_KINDS),
+		help="kind of finding to leave out, can be repeated");
+	parser.add_argument("--format", choices=("text", "json"), default=doxygen_squirrel_filter.diagnostics_format,
+		help="format of the findings (default: $SQUIRREL_FILTER_DIAGNOSTICS_FORMAT or %(default)s)");
+	options = parser.parse_args(args);
+
+	checked, failed = check_files(options.sources, options.include or ["*.nut"], options.exclude, max(1, options.jobs));
+	counts = {};
+	out = sys.stdout;
+	for path, findings in checked:
+		diagnostics = doxygen_squirrel_filter.Diagnostics(path, "info", options.format);
+		diagnostics.records = [record for record in findings if record[1] not in options.ignore];
+		for severity, kind, line, message in diagnostics.records:
+			counts[kind] = counts.get(kind, 0) + 1;
+		out.write(diagnostics.take());
+	if options.format == "json":
+		sys.stderr.write(doxygen_squirrel_filter.format_counts(counts, "json"));
+	else:
+		sys.stderr.write("Checked %d files, %d findings.\n" % (len(checked), sum(counts.values())));
+	return 1 if counts or failed else 0;
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]));
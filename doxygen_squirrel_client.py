@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Thin client for the doxygen Squirrel filter server.
+# Copyright (C) 2015, 2019  Jacob Boerema
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# -------------------------------------------------------------------------
+
+## @file doxygen_squirrel_client.py Minimal client to use as FILTER_PATTERNS target with the filter server.
+
+## Sends the filename to a running doxygen_squirrel_server.py and copies the filtered output
+## to stdout and the messages to stderr. When no server is running, or it uses another cache or
+## project index than our environment sets, the file is filtered in this process instead, so
+## doxygen always gets the same output.
+## We deliberately import as little as possible here since startup time is what we try to save.
+## That is also why we use _socket: the socket module pulls in enum and selectors which
+## take longer to import than filtering an average file.
+
+import os
+import sys
+import struct
+import _socket
+
+## Directory of the default socket. Keep in sync with doxygen_squirrel_server.py.
+def socket_directory():
+	runtime_dir = os.environ.get("XDG_RUNTIME_DIR");
+	if runtime_dir:
+		return runtime_dir;
+	uid = getattr(os, "getuid", lambda: 0)();
+	return "/tmp/doxygen_squirrel_filter-" + str(uid);
+
+## Error handler for paths with bytes that aren't UTF-8, which os gives us as surrogates.
+## Keep in sync with doxygen_squirrel_server.py.
+UNDECODABLE = "surrogateescape" if sys.version_info[0] >= 3 else "strict";
+
+## Default socket path. Keep in sync with doxygen_squirrel_server.py.
+def default_socket_path():
+	return os.environ.get("SQUIRREL_FILTER_SOCKET", os.path.join(socket_directory(), "doxygen_squirrel_filter.sock"));
+
+## Read exactly size bytes from sock, returns None if the connection was closed early.
+def recv_exact(sock, size):
+	chunks = [];
+	while size > 0:
+		data = sock.recv(size);
+		if not data:
+			return None;
+		chunks.append(data);
+		size -= len(data);
+	return b"".join(chunks);
+
+## Filter filename using the server, returns the exit code or None if no server could be reached
+## or the server would filter differently than we would.
+def filter_remote(filename):
+	if not hasattr(_socket, "AF_UNIX"):
+		return None;
+	socket_path = default_socket_path();
+	try:
+		owner = os.stat(socket_path).st_uid;
+	except OSError:
+		return None;
+	if owner != getattr(os, "getuid", lambda: owner)():
+		# Another user could answer with anything, filter the file ourselves.
+		sys.stderr.write("** Warning: " + socket_path + " belongs to another user, not using the filter server.\n");
+		return None;
+	# The server applies our diagnostics settings and refuses when we use another cache or index.
+	fields = [os.getcwd(), filename];
+	for name, value in os.environ.items():
+		if name.startswith("SQUIRREL_FILTER_") and name != "SQUIRREL_FILTER_SOCKET":
+			fields.append(name + "=" + value);
+	if "\n" in "".join(fields):
+		# Doesn't fit in a request.
+		return None;
+	sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM);
+	try:
+		sock.connect(socket_path);
+	except _socket.error:
+		sock.close();
+		return None;
+
+	if sys.version_info[0] < 3:
+		stdout = sys.stdout;
+		stderr = sys.stderr;
+	else:
+		stdout = sys.stdout.buffer;
+		stderr = sys.stderr.buffer;
+	request = "\0".join(fields) + "\n";
+	sock.sendall(request.encode("utf-8", UNDECODABLE));
+	while True:
+		header = recv_exact(sock, 5);
+		if header is None:
+			sys.stderr.write("** Error: filter server closed the connection.\n");
+			return 1;
+		tag = header[:1];
+		data = recv_exact(sock, struct.unpack(">I", header[1:])[0]);
+		if data is None:
+			sys.stderr.write("** Error: filter server closed the connection.\n");
+			return 1;
+		if tag == b"O":
+			stdout.write(data);
+		elif tag == b"E":
+			stderr.write(data);
+			stderr.flush();
+		elif tag == b"R":
+			# The server filters differently than we would.
+			sock.close();
+			return None;
+		elif tag == b"X":
+			sock.close();
+			stdout.flush();
+			return int(data);
+
+def main(argv):
+	exit_code = None;
+	if len(argv) == 2:
+		exit_code = filter_remote(argv[1]);
+	if exit_code is None:
+		# No server available (or wrong usage): do the work ourselves.
+		import doxygen_squirrel_filter
+		exit_code = doxygen_squirrel_filter.main(argv);
+	return exit_code;
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv));
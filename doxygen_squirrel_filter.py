@@ -47,8 +47,8 @@
 ## ---------------
 ## 1. Inline code in the file outside of any function can confuse doxygen too sometimes
 ## Example: AILib.List main.nut the code at the bottom.
-## 2. Multi line string constants not supported: (starting with @" ). Note multi line string
-## constants also support " inside them by writing ""
+## 2. Multi line string constants (starting with @" ) are only supported by the cursor lexer.
+## Note multi line string constants also support " inside them by writing ""
 ## 3. Doxygen can get confused by class names that have a "." in them.
 ## 4. Doxygen gets confused if global const or enum declarations don't get ended by a
 ## semicolon ";". If your documentation gets cut short then looking for missing semicolons
@@ -87,6 +87,40 @@ track_class_functions = True;
 ## @note Currently only marking private inside classes is supported.
 hide_private_symbols = True;
 
+## Which lexer splits the lines in code, comments and strings.
+## "cursor" walks every line once and also supports multi line strings (@"...") and
+## escaped quotes in strings. "legacy" is the original implementation.
+## Their output differs for strings with braces or keywords like class in them: the legacy lexer
+## sometimes filtered those as code, the cursor lexer leaves every string alone.
+lexer_engine = "cursor";
+
+## How filter() reads files. "text" decodes them as UTF-8. "bytes" reads them as latin-1, which maps
+## every byte to one character and back: the Squirrel syntax is all ASCII so it is found the same way,
+## while comments and strings are written back byte for byte, whatever their encoding.
+## The output for UTF-8 files is the same, files in other encodings only work in "bytes" mode.
+io_mode = "text";
+
+## Leave out the code that doxygen doesn't document: function bodies become "{}" and statements
+## outside functions and classes, like calls and if blocks after the last class, are left out.
+## Doc comments, declarations and line numbers stay the same, so doxygen has a lot less to parse.
+## @note This also sets check_end_of_class to True.
+elide_bodies = False;
+
+## Number of lines the line memo remembers, 0 turns it off. Lines like "}", "return null;" and
+## comment boilerplate repeat a lot: the memo replays the output and state changes of a line
+## that was filtered before in the same state instead of filtering it again.
+line_memo_size = 4096;
+
+## Which diagnostics the filter writes to stderr, once per file:
+## "quiet" only errors, "warning" also warnings like strings without an end and "info" also the
+## classes found, functions added to classes and missing ";" after classes.
+## The environment variable SQUIRREL_FILTER_DIAGNOSTICS overrides this.
+diagnostics_level = "quiet";
+
+## Format of the diagnostics: "text" (file:line: severity: message [kind]) or "json" (one object per line).
+## The environment variable SQUIRREL_FILTER_DIAGNOSTICS_FORMAT overrides this.
+diagnostics_format = "text";
+
 # --------------------------------------------------------------
 
 ## If track_class_functions is True the check_end_of_class needs to be True too.
@@ -98,7 +132,20 @@ import os
 import io
 import sys
 import re
+import json
+import collections
+
+## Settings of this file that the environment can change, as they are before it does. The filter server
+## uses them for a client that doesn't set the environment variable.
+FILE_SETTINGS = {"diagnostics_level": diagnostics_level, "diagnostics_format": diagnostics_format};
+
+## Environment variables that change a setting and the setting they change.
+ENVIRONMENT_SETTINGS = (("SQUIRREL_FILTER_DIAGNOSTICS", "diagnostics_level"),
+	("SQUIRREL_FILTER_DIAGNOSTICS_FORMAT", "diagnostics_format"));
 
+# The environment can change the diagnostics per run without changing this file.
+diagnostics_level = os.environ.get("SQUIRREL_FILTER_DIAGNOSTICS", diagnostics_level);
+diagnostics_format = os.environ.get("SQUIRREL_FILTER_DIAGNOSTICS_FORMAT", diagnostics_format);
 
 ## Turn debugging info printing on or off
 print_debug_info = False;
@@ -106,67 +153,304 @@ print_debug_info = False;
 # constants
 MAX_POS_ON_LINE = 999999;
 
+## Separator in archive.tar!dir/file.nut, the name of a member of a tar or zip file.
+## Keep in sync with doxygen_squirrel_archive.py.
+ARCHIVE_SEPARATOR = "!";
+
+## Version of the filter. Change this when the output changes, it is part of the key of cached output.
+FILTER_VERSION = "2.8";
+
+## Names of the settings, the ones that influence the output in the order of the settings key.
+SETTINGS = ("keep_function", "keep_constructor", "check_end_of_class", "track_class_functions",
+	"hide_private_symbols", "lexer_engine", "elide_bodies", "io_mode", "diagnostics_level", "diagnostics_format", "line_memo_size");
+
+## Settings that don't change the output, so they are not part of the settings key.
+SETTINGS_NOT_IN_KEY = ("io_mode", "diagnostics_level", "diagnostics_format", "line_memo_size");
+
+## Kinds of diagnostics and their severity.
+DIAGNOSTIC_KINDS = {
+	"block-level": "error",             # Block level below 0 or above 50, filtering stops.
+	"encoding": "error",                # Output that can't be encoded.
+	"unterminated-string": "warning",   # String constant without an end on its line.
+	"unknown-class": "info",            # Class::function of a class that isn't defined in the file.
+	"missing-semicolon": "info",        # No ";" after the "}" that ends a class or enum, the filter adds one.
+	"class": "info",                    # Class found.
+	"added-function": "info",           # Function defined outside its class added to the class.
+};
+
+## Severities that are written per diagnostics level.
+DIAGNOSTIC_LEVELS = {"quiet": ("error",), "warning": ("error", "warning"), "info": ("error", "warning", "info")};
+
+## FilterSettings holds the settings of one SquirrelFilter.
+## The defaults are the module settings at the top of this file, keyword arguments override them:
+## FilterSettings(keep_function=False, hide_private_symbols=False)
+class FilterSettings:
+	def __init__(self, **settings):
+		for name in SETTINGS:
+			setattr(self, name, globals()[name]);
+		for name, value in settings.items():
+			if name not in SETTINGS:
+				raise TypeError("Unknown Squirrel filter setting: " + name);
+			setattr(self, name, value);
+		if self.lexer_engine not in ("cursor", "legacy"):
+			raise ValueError("Unknown lexer engine: " + str(self.lexer_engine));
+		if self.io_mode not in ("text", "bytes"):
+			raise ValueError("Unknown io mode: " + str(self.io_mode));
+		if self.diagnostics_level not in DIAGNOSTIC_LEVELS:
+			raise ValueError("Unknown diagnostics level: " + str(self.diagnostics_level));
+		if self.diagnostics_format not in ("text", "json"):
+			raise ValueError("Unknown diagnostics format: " + str(self.diagnostics_format));
+		if not isinstance(self.line_memo_size, int) or self.line_memo_size < 0:
+			raise ValueError("Line memo size must be a number of lines: " + str(self.line_memo_size));
+		# If track_class_functions is True the check_end_of_class needs to be True too.
+		# Eliding bodies needs the block levels too.
+		if self.track_class_functions or self.elide_bodies:
+			self.check_end_of_class = True;
+
+	## Return the settings as a tuple, used as part of the key of cached output.
+	def key(self):
+		return tuple(getattr(self, name) for name in SETTINGS if name not in SETTINGS_NOT_IN_KEY);
+
+	## Return the settings that influence the output of a filter with ir set, used as part of the key of a cached IR.
+	## keep_function is needed while eliding: a statement ending in "function" isn't ended without it.
+	def ir_key(self):
+		return tuple(getattr(self, name) for name in SETTINGS if name not in SETTINGS_NOT_IN_KEY and
+			(name not in RENDER_SETTINGS or (name == "keep_function" and self.elide_bodies)));
+
+## Return the settings that influence the output, of settings or else of the module settings.
+def output_settings(settings=None):
+	if settings is None:
+		settings = FilterSettings();
+	return settings.key();
+
+## Settings that render_ir applies, they don't change how a file is parsed.
+RENDER_SETTINGS = ("keep_function", "keep_constructor", "hide_private_symbols");
+
+## Markers in the output of a filter with ir set, for the changes that depend on the render settings.
+## Control characters that Squirrel sources don't contain, they are the same in every encoding we write.
+IR_PRIVATE = "\x01";           # " /** @private */ " with hide_private_symbols
+IR_INTERNAL = "\x02";          # " /** @internal */ " with hide_private_symbols
+IR_CONSTRUCTOR = "\x03";       # "constructor " with keep_constructor, before the class name
+IR_FUNCTION = "\x04";          # "function" with keep_function
+IR_FUNCTION_DECL = "\x05";     # "function " with keep_function, before a function added to its class
+IR_PRIVATE_START = "\x06";     # Start and end of a private function added to its class, left out
+IR_PRIVATE_END = "\x07";       # with hide_private_symbols.
+
+## Any of the markers, to check that a file doesn't contain them.
+re_ir_marker = re.compile(b"[\x01-\x07]");
+
+## Return the output of the filter from ir, the output of a filter with ir set, for the render settings
+## of settings, or else of the module settings. ir can be text or bytes, the result is the same type.
+## The other settings must be the ones ir was made with.
+def render_ir(ir, settings=None):
+	if settings is None:
+		settings = FilterSettings();
+	hide = settings.hide_private_symbols;
+	replacements = (
+		(IR_PRIVATE, " /** @private */ " if hide else ""),
+		(IR_INTERNAL, " /** @internal */ " if hide else ""),
+		(IR_CONSTRUCTOR, "constructor " if settings.keep_constructor else ""),
+		(IR_FUNCTION, "function" if settings.keep_function else ""),
+		(IR_FUNCTION_DECL, "function " if settings.keep_function else ""),
+		(IR_PRIVATE_START, ""),
+		(IR_PRIVATE_END, ""));
+	binary = isinstance(ir, bytes);
+	if hide:
+		pattern = IR_PRIVATE_START + "[^" + IR_PRIVATE_END + "]*" + IR_PRIVATE_END;
+		ir = re.sub(pattern.encode("ascii") if binary else pattern, b"" if binary else "", ir);
+	for marker, text in replacements:
+		if binary:
+			marker = marker.encode("ascii");
+			text = text.encode("ascii");
+		ir = ir.replace(marker, text);
+	return ir;
+
+## Return stdout as a binary stream.
+def stdout_binary():
+	# To make it work in both python 2 and 3 we check the version here
+	if sys.version_info[0] < 3:
+		return sys.stdout;
+	return sys.stdout.buffer;
+
 
 ## Print a string to stderr
 def alwaysprint(string):
 	sys.stderr.write(string);
 
+## Diagnostics collects the messages of one filter with their kind and line, so they can be written
+## at once and read by programs. Every kind is counted, also when it isn't written.
+class Diagnostics(object):
+	__slots__ = ("filename", "shown", "format", "records", "counts", "kept");
+
+	def __init__(self, filename, level="quiet", format="text"):
+		self.filename = filename;
+		## Severities that are written.
+		self.shown = DIAGNOSTIC_LEVELS[level];
+		self.format = format;
+		## (severity, kind, line, message) of the diagnostics to write.
+		self.records = [];
+		## Number of diagnostics per kind.
+		self.counts = {};
+		## When a list, every diagnostic is added to it as (kind, line, message), also the ones that
+		## aren't written. The cache stores them with the output.
+		self.kept = None;
+
+	def add(self, kind, line, message):
+		self.counts[kind] = self.counts.get(kind, 0) + 1;
+		if self.kept is not None:
+			self.kept.append((kind, line, message));
+		severity = DIAGNOSTIC_KINDS[kind];
+		if severity in self.shown:
+			self.records.append((severity, kind, line, message));
+
+	## Return the diagnostics added since the last call as text in our format, ordered by line, "" if there are none.
+	def take(self):
+		filename = self.filename or "-";
+		self.records.sort(key=lambda record: record[2]);
+		if self.format == "json":
+			lines = [json.dumps({"file": filename, "line": line, "severity": severity, "kind": kind, "message": message},
+				sort_keys=True) + "\n" for severity, kind, line, message in self.records];
+		else:
+			lines = ["%s:%d: %s: %s [%s]\n" % (filename, line, severity, message, kind)
+				for severity, kind, line, message in self.records];
+		self.records = [];
+		return "".join(lines);
+
+## Add the counts per kind of diagnostics to totals, a dictionary that is returned.
+def add_counts(totals, counts):
+	for kind, count in counts.items():
+		totals[kind] = totals.get(kind, 0) + count;
+	return totals;
+
+## Return counts per kind of diagnostics as one line of text, or as a JSON line in the json format.
+def format_counts(counts, format="text"):
+	if format == "json":
+		return json.dumps({"kind": "summary", "counts": counts}, sort_keys=True) + "\n";
+	return "Diagnostics: " + ", ".join("%d %s" % (counts[kind], kind) for kind in sorted(counts)) + ".\n";
+
+## LineMemo remembers what filtering a line did, by the line and the state before it, and forgets
+## the least recently used lines when it's full.
+class LineMemo(object):
+	__slots__ = ("size", "entries", "hits", "misses", "evictions");
+
+	def __init__(self, size):
+		self.size = size;
+		## Key to (output chunks, state after the line, rule hits of the line), least recently used first.
+		self.entries = collections.OrderedDict();
+		self.hits = 0;
+		self.misses = 0;
+		self.evictions = 0;
+
+	## Return the entry of key or None, and count the lookup.
+	def get(self, key):
+		entry = self.entries.pop(key, None);
+		if entry is None:
+			self.misses += 1;
+			return None;
+		# Put it back as the most recently used.
+		self.entries[key] = entry;
+		self.hits += 1;
+		return entry;
+
+	def put(self, key, entry):
+		if len(self.entries) >= self.size:
+			self.entries.popitem(last=False);
+			self.evictions += 1;
+		self.entries[key] = entry;
+
+	## Return the statistics as a dictionary.
+	def stats(self):
+		lookups = self.hits + self.misses;
+		return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+			"hit_rate": float(self.hits) / lookups if lookups else 0.0};
+
 ## ClassData is our class to keep track of the functions used in a class.
-class ClassData:
-	def __init__(self, name):
+class ClassData(object):
+	__slots__ = ("classname", "line", "functions", "missing", "last_missing", "output_buffer", "written");
+
+	def __init__(self, name, line=0):
 		self.classname = name;
-		self.functions = [];
-		self.missing = [];
-		self.params = [];
-		self.output_buffer = "";
+		## Line where the class is defined, counted from 1.
+		self.line = line;
+		## Names of the functions defined inside the class.
+		self.functions = set();
+		## Functions defined outside the class that are missing inside it, in the order we found them:
+		## name to parameters. The parameters are None until we have found them.
+		self.missing = collections.OrderedDict();
+		## Name of the missing function that gets the parameters we find next.
+		self.last_missing = None;
+		## Output chunks up to the end of the class, None while we haven't seen the end of the class.
+		self.output_buffer = None;
+		## Set once the class and its missing functions have been written.
+		self.written = False;
 	
 	def AddClassMemberFunctionInside(self, name):
-		self.functions.append(name);
+		self.functions.add(name);
 
 	def AddClassMemberFunctionOutside(self, name):
-		self.missing.append(name);
+		self.missing[name] = None;
+		self.last_missing = name;
 
 	def AddMemberFunctionParams(self, parameters):
-		self.params.append(parameters);
+		# No missing function when a class was defined before the parameters ended.
+		if self.last_missing is not None:
+			self.missing[self.last_missing] = parameters;
+
+	## Return (name, parameters) of the missing functions of which we found the parameters.
+	def missing_functions(self):
+		return [(fn, params) for fn, params in self.missing.items() if params is not None];
 	
 	def SetBuffer(self, outbuf):
 		self.output_buffer = outbuf;
 
+## ClassRegistry keeps the classes of one file by their name, which may be dotted (SuperLib.Tile).
+class ClassRegistry(object):
+	__slots__ = ("classes", "by_name", "foreign");
+
+	def __init__(self):
+		## Classes defined in the file, in order.
+		self.classes = [];
+		## Classes defined in the file by name. The first one if a name is defined more than once.
+		self.by_name = {};
+		## Classes with functions defined outside the class in this file, that are not (yet) defined
+		## in this file. Their functions can be added when the class is defined later in this file,
+		## and the project index uses them to add them to the file that defines the class.
+		self.foreign = {};
+
+	def __len__(self):
+		return len(self.classes);
+
+	## Add a class that is defined in the file at line and return its ClassData.
+	def define(self, name, line=0):
+		classdata = ClassData(name, line);
+		self.classes.append(classdata);
+		self.by_name.setdefault(name, classdata);
+		return classdata;
+
+	## Return the ClassData of the class name defined in the file, or None if it isn't (yet) defined.
+	def get(self, name):
+		return self.by_name.get(name);
+
+	## Return the ClassData that collects the functions defined outside class name, which isn't defined in the file.
+	def foreign_class(self, name):
+		classdata = self.foreign.get(name);
+		if classdata is None:
+			classdata = self.foreign[name] = ClassData(name);
+		return classdata;
+
 
 ## SquirrelFilter is our class to convert Squirrel scripts to something doxygen can understand.
+## Filter one file with filter(), or text with filter_text() or filter_stream(). All state is kept
+## per instance, so one process can use many filters one after the other or in several threads.
 class SquirrelFilter:
 
 	# ----------------------------------
-	# Class Variables.
+	# Class Variables. These never change.
 	# ----------------------------------
 
-	## doxygen reads data from stdout so that's where we are going to send our filtered output.
-	outfile = sys.stdout;
-
-	## Keep track of being in a multi line comment or not
-	in_multiline_comment = False;
-
-	## Keep track of the last seen class name
-	current_class = "";
-
-	## Determines if we are looking for a class definition block: "{"
-	want_class_start = False;
-	
-	## Determines if we are looking for end of class "}"
-	want_class_end = False;
-
-	## Determines at what level we are in the code blocks hierarchy needed to find end of class.
-	block_level = 0;
-	
-	## Classes found in the currently processed file.
-	classes = [];
-	class_names = [];
-	
-	## We need an output buffer since we can only determine for sure after we have read the whole
-	## file whether we need to make come changes to certain classes.
-	## This buffer will contain the part of the output since the beginning of the file or since
-	## we encountered an end of class marker.
-	outbuf = "";
+	## Write the output buffer once it has this many chunks and we are not holding back classes.
+	## When we are holding back classes the chunks are joined into one block to save memory.
+	flush_chunks = 4096;
 
 	# ----------------------------------
 
@@ -184,6 +468,14 @@ class SquirrelFilter:
 	double_quote = '"';
 	re_string = re.compile(double_quote);
 
+	## Used by the cursor lexer: the start of a comment, string or character constant.
+	## Character constants are matched completely so that '"' doesn't start a string.
+	re_lex_token = re.compile("/[*]|//|@" + double_quote + "|" + double_quote + "|'(?:[^'\\\\\\r\\n]|\\\\.)'");
+	## Rest of a string constant including the closing quote, allowing escaped characters.
+	re_string_rest = re.compile("[^" + double_quote + "\\\\\\r\\n]*(?:\\\\.[^" + double_quote + "\\\\\\r\\n]*)*" + double_quote);
+	## Rest of a multi line string constant including the closing quote. A quote inside is written as "".
+	re_verbatim_rest = re.compile("[^" + double_quote + "]*(?:" + double_quote + double_quote + "[^" + double_quote + "]*)*" + double_quote + "(?!" + double_quote + ")");
+
 	# 2. Squirrel language constructs that need changing
 	re_assignment = re.compile("<-");
 	re_extends = re.compile("extends");
@@ -201,10 +493,16 @@ class SquirrelFilter:
 
 	# 3. Squirrel elements we need to find
 	re_blockstart = re.compile("\{");
-	re_blockend = re.compile("\}");
+	re_brace = re.compile("[{}]");
 	re_functionend = re.compile("\)");
 	re_classend = re.compile("\s*;");
 	re_classname = re.compile("\s*class\s+([a-zA-Z_]+[a-zA-Z_0-9.]*)");
+	# After the class name, "extends" is replaced by ":" already. Only used for the symbols.
+	re_classbase = re.compile(r"\s*:\s*([a-zA-Z_]+[a-zA-Z_0-9.]*)");
+	# Not a call like base.constructor().
+	re_constructordef = re.compile(r"(?<![.\w])constructor(?=\s*\()");
+	# The keyword function, not part of a name.
+	re_functionword = re.compile(r"\bfunction\b");
 	re_functionname = re.compile("\s*(function)\s+([a-zA-Z_]+[a-zA-Z_0-9]*)");
 	# WARNING: Params can be spread over multiple lines so we can't use it in regexp!
 	#re_classfunctionname = re.compile("\s*function\s+([a-zA-Z_]+[a-zA-Z_0-9]*)::([a-zA-Z_]+[a-zA-Z_0-9]*)(\s*\([^)]*)");
@@ -214,21 +512,150 @@ class SquirrelFilter:
 	#re_privatevar = re.compile("\s*(_[a-zA-Z_0-9]*)\s+=");
 	re_privatevar = re.compile("\s*([a-zA-Z_0-9]*)\s+=");
 	re_privateenum = re.compile("\s*(enum)\s+(_[a-zA-Z_0-9]*)");
-
-	def __init__(self, filename):
+	re_enumname = re.compile(r"(?<![.\w])enum\s+([a-zA-Z_][a-zA-Z_0-9]*)");
+
+	## Used when eliding: the start of a statement that is code instead of a declaration, a control
+	## statement or a call.
+	re_statement = re.compile(r"\s*(?:(?:if|else|while|for|foreach|do|switch|try|catch|return|throw|delete|yield|resume)\b|"
+		r"(?!(?:require|import|function|constructor)\b)[a-zA-Z_][a-zA-Z_0-9.]*\s*\()");
+	## Used when eliding: the characters that end a function body or statement.
+	re_elide = re.compile("[{}();]");
+
+	## Finds the keywords and characters that the rules of filter_part need, with one search.
+	## It's a lookahead so overlapping keywords like "requirextends" are all found.
+	re_trigger = re.compile("(?=(<-|=|extends|class|function|constructor|require|import|enum|[{}]))");
+
+	## Names of the rules of filter_part, counted in rule_hits.
+	RULES = ("assignment", "extends", "class", "class_start", "member_function", "class_function",
+		"private_variable", "private_enum", "constructor", "function", "require", "import", "blocks");
+
+	## Lines longer than this are not remembered by the line memo, they hardly ever repeat.
+	memo_max_line = 256;
+
+	## filename is the file to filter, it may be None when filtering text.
+	## settings is a FilterSettings, None means the module settings.
+	## messages is a text stream for the messages of the filter, None means sys.stderr.
+	def __init__(self, filename=None, index=None, settings=None, messages=None):
 		self.filename = filename;
-		self.outbuf = "";
+		## Contents of the file as bytes when they don't come from the file system, like a member of an archive.
+		self.data = None;
+		## Project index with the functions defined outside their class in other files, or None.
+		self.index = index;
+		if settings is None:
+			settings = FilterSettings();
+		self.settings = settings;
+		self.messages = messages;
+		## Diagnostics of this file, written to messages when filtering ends.
+		self.diagnostics = Diagnostics(filename, settings.diagnostics_level, settings.diagnostics_format);
+		## Encoding of the strings we filter: "latin-1" when filter() reads a file in "bytes" mode.
+		self.encoding = "utf-8";
+		## doxygen reads data from stdout so that's where filter() sends our filtered output by default.
+		self.outfile = None;
+		## Keep track of being in a multi line comment or not
+		self.in_multiline_comment = False;
+		## Keep track of being in a multi line string constant (@"...") or not
+		self.in_verbatim_string = False;
+		## Keep track of the last seen class name
+		self.current_class = "";
+		## Determines if we are looking for a class definition block: "{"
+		self.want_class_start = False;
+		## Determines if we are looking for end of class "}"
+		self.want_class_end = False;
+		## Determines at what level we are in the code blocks hierarchy needed to find end of class.
+		self.block_level = 0;
+		## We need an output buffer since we can only determine for sure after we have read the whole
+		## file whether we need to make come changes to certain classes.
+		## This buffer is a list of output chunks since the last part we could write or since
+		## we encountered an end of class marker. Chunks are only joined when writing.
+		self.outbuf = [];
+		## Output that can't change anymore and that filter_stream yields next.
+		self.ready = [];
+		## Number of joined blocks at the start of outbuf.
+		self.outbuf_blocks = 0;
+		## Classes whose end we have seen but that we can't write yet, in order.
+		self.pending = collections.deque();
+		## Index of the first class in the registry that may not have been written yet.
+		self.first_unwritten = 0;
+		## Last line number of a definition Class::function per class name, found by prescan.
+		## None means we don't know so all classes have to wait until the end of the file.
+		self.outside_last_line = None;
+		## Line number of the line being handled.
+		self.lineno = 0;
+		## Number of functions defined outside their class that we added to the class.
+		self.functions_added = 0;
+		## Number of times each rule of filter_part changed or registered something.
+		self.rule_hits = dict((name, 0) for name in self.RULES);
+		## Set to a list before filtering to collect the symbols of the file:
+		## [line, kind, visibility, class name, name, parameters] with kind "class", "function"
+		## (defined inside its class) or "outside_function" (Class::function).
+		self.symbols = None;
+		## Function symbol that we are collecting the parameters for.
+		self.symbol_params = None;
 		## Tells if we are looking for a functions parameters
 		self.need_function_params = False;
 		## The buffer to store the function parameters in
 		self.params_buf = "";
+		## Class that gets the function parameters.
+		self.params_class = None;
 		self.cur_class = None;
-
-	## Print a string to stderr if print_debug_info is True
+		## (block level, name) of the enum whose "}" we are looking for, or None.
+		self.enum_start = None;
+		## Classes found in this file.
+		self.registry = ClassRegistry();
+		## Line and function name of the first Class::function per class that wasn't defined yet, for the diagnostics.
+		self.foreign_lines = {};
+		## Lines filtered before and what they did, or None when the memo is turned off.
+		self.memo = LineMemo(settings.line_memo_size) if settings.line_memo_size else None;
+		## Block level where the code we are leaving out ends, None when we are not eliding.
+		self.elide_level = None;
+		## True when we are leaving out a statement, False for a function body.
+		self.elide_statement = False;
+		## Depth of "(" in the statement we are leaving out, a ";" inside doesn't end it.
+		self.elide_parens = 0;
+		## Output buffer while eliding, the left out code goes to elided instead.
+		self.elided_from = None;
+		self.elided = [];
+		## Rest of the part that filter_part didn't filter because it started eliding.
+		self.elide_rest = None;
+		self.select_filter_code();
+		## Set after a function name, the next "{" starts its body.
+		self.want_body = False;
+		## Set when the code so far ends a statement at the outermost level, so a new one can start.
+		self.statement_start = True;
+		## Set when the current line changed more than the state in the key of the line memo,
+		## like the classes or diagnostics, so replaying it wouldn't do the same.
+		self.memo_unsafe = False;
+		## Set before filtering to write markers instead of applying the render settings, see render_ir().
+		## The diagnostics and counters are still those of our settings.
+		self.ir = False;
+		## Set by the output cache when the output came from the cache instead of filtering.
+		self.from_cache = False;
+
+	## Print a message of the filter to the messages stream, stderr by default.
+	def message(self, string):
+		if self.messages is None:
+			alwaysprint(string);
+		else:
+			self.messages.write(string);
+
+	## Add a diagnostic of kind for the current line, or for line if given (counted from 1).
+	def diagnostic(self, kind, message, line=None):
+		self.memo_unsafe = True;
+		if line is None:
+			line = self.lineno + 1;
+		self.diagnostics.add(kind, line, message);
+
+	## Write the diagnostics collected so far to the messages stream, in one write.
+	def flush_diagnostics(self):
+		text = self.diagnostics.take();
+		if text:
+			self.message(text);
+
+	## Print a string to the messages stream if print_debug_info is True
 	def debugprint(self, string):
 		#global print_debug_info
 		if (print_debug_info):
-			sys.stderr.write(string);
+			self.message(string);
 
 	## Determine if the first match is a multi line comment, single line comment or string start
 	def first_match(self, ml_comment, sl_comment, str_start):
@@ -263,76 +690,172 @@ class SquirrelFilter:
 		else:
 			return str_start;
 
-	## Checks if a ";" follows end of block "}" and checks if this is the end of a class.
-	def check_end_of_class(self, part):
+	## Checks if a ";" follows end of block "}" at pos in part and checks if this is the end of a class.
+	## Returns the ";" that needs to be added after the "}" or "" if it's already there.
+	def check_end_of_class(self, part, pos=0):
 		# Check if a ";" follows, if not add it or doxygen can get somewhat confused.
-		block_end = self.re_classend.match(part);
-		if (block_end is None):
-			# No ";" so add it.
-			part = ";" + part;
+		if self.re_classend.match(part, pos) is None:
+			semicolon = ";";
+		else:
+			semicolon = "";
 		# Assuming for now that we don't encounter nested classes!
 		if (self.want_class_end == True and self.block_level == 0):
+			if semicolon:
+				self.diagnostic("missing-semicolon", "no ';' after the end of class " + self.cur_class.classname + ", added one");
 			self.want_class_end = False;
 			self.cur_class = None;
 			self.debugprint("<end of class>\n");
+		elif self.enum_start is not None and self.enum_start[0] == self.block_level:
+			if semicolon:
+				self.diagnostic("missing-semicolon", "no ';' after the end of enum " + self.enum_start[1] + ", added one");
+			self.enum_start = None;
 
-		return part;
+		return semicolon;
 	
-	## old_output is the already filtered part of the line; last_part is the part before "}"
-	def end_of_block(self, old_output, last_part):
+	## output is the list of already filtered parts of the line; last_part is the part before "}"
+	def end_of_block(self, output, last_part):
 		self.block_level -= 1;
 		self.debugprint("*** " + str(self.block_level) + " ***");
-		old_output += last_part;
+		output.append(last_part);
 		# For now we hardcode end of class level at level 0
 		if (self.block_level == 0 and self.want_class_end == True):
 			# End of Class. Add buffer to Class and set current buffer back to ""
-			self.outbuf += old_output;
-			self.cur_class.SetBuffer(self.outbuf);
+			self.memo_unsafe = True;
+			self.outbuf.append("".join(output));
+			self.cur_class.SetBuffer(["".join(self.outbuf)]);
 			# Rest buffer
-			self.outbuf = "";
-			# Add the closing "}" of the class back to output
-			old_output = "}";
-		else:
-			old_output += "}";
-		return old_output;
+			self.outbuf = [];
+			self.outbuf_blocks = 0;
+			self.pending.append(self.cur_class);
+			del output[:];
+		# Add the closing "}" (of the class) back to output
+		output.append("}");
 	
-	## Parse "{" and "}" to keep track of the code level.
+	## Parse "{" and "}" to keep track of the code level. Walks the part once from brace to brace.
 	def parse_blocks(self, part):
-		output = "";
-		while (True):
-			blockstart = self.re_blockstart.search(part);
-			blockend = self.re_blockend.search(part);
-			if blockstart and blockend:
-				# both available, determine which comes first
-				if (blockstart.start() < blockend.start()):
-					# block start comes first: increase level
-					self.block_level += 1;
-					self.debugprint("*** " + str(self.block_level) + " ***");
-					output += part[:blockstart.end()];
-					part = part[blockstart.end():];
-				else:
-					# block end comes first: decrease level
-					output = self.end_of_block(output, part[:blockend.start()]);
-					part = self.check_end_of_class(part[blockend.end():]);
-			elif blockstart:
-				# Only start of block available: increase block level
+		output = [];
+		pos = 0;
+		for brace in self.re_brace.finditer(part):
+			if brace.group() == "{":
+				# block start: increase level
 				self.block_level += 1;
 				self.debugprint("*** " + str(self.block_level) + " ***");
-				output += part[:blockstart.end()];
-				part = part[blockstart.end():];
-			elif blockend:
-				# Only end of block available: decrease block level
-				output = self.end_of_block(output, part[:blockend.start()]);
-				part = self.check_end_of_class(part[blockend.end():]);
+				output.append(part[pos:brace.end()]);
+				if self.want_body and self.block_level - 1 == (1 if self.want_class_end else 0):
+					# Start of a function body: leave out everything up to its "}".
+					self.want_body = False;
+					self.outbuf.append("".join(output));
+					self.start_elision(self.block_level - 1, False);
+					self.elide_rest = part[brace.end():];
+					return "";
 			else:
-				output += part;
-				break;
+				# block end: decrease level
+				self.end_of_block(output, part[pos:brace.start()]);
+				output.append(self.check_end_of_class(part, brace.end()));
+			pos = brace.end();
 			
 			# Make sure we don't get into an endless loop
 			if (self.block_level < 0 or self.block_level > 50):
+				self.diagnostic("block-level", "block level " + str(self.block_level) + ", too many '}' or '{'");
 				raise ValueError("Endless loop detected in parse_blocks! Block level is " + str(self.block_level));
 
-		return output;
+		output.append(part[pos:]);
+		return "".join(output);
+
+	## Start leaving out code until the block level gets back to level, for a statement also until a ";".
+	def start_elision(self, level, statement):
+		self.memo_unsafe = True;
+		self.elide_level = level;
+		self.elide_statement = statement;
+		self.elide_parens = 0;
+		self.elided_from = self.outbuf;
+		self.outbuf = self.elided;
+
+	## Walk part from pos while eliding, only keeping track of the block level. Returns the position
+	## after the end of the function body or statement, or -1 if it doesn't end in part.
+	def elide_part(self, part, pos=0):
+		for token in self.re_elide.finditer(part, pos):
+			char = token.group();
+			if char == "{":
+				self.block_level += 1;
+				if self.block_level > 50:
+					self.diagnostic("block-level", "block level " + str(self.block_level) + ", too many '{'");
+					raise ValueError("Endless loop detected in elide_part! Block level is " + str(self.block_level));
+				continue;
+			if char == "}":
+				if self.block_level == self.elide_level:
+					self.diagnostic("block-level", "block level " + str(self.block_level - 1) + ", too many '}'");
+					raise ValueError("Endless loop detected in elide_part! Block level is " + str(self.block_level - 1));
+				self.block_level -= 1;
+				if self.block_level != self.elide_level:
+					continue;
+			elif not self.elide_statement or self.block_level != self.elide_level:
+				continue;
+			elif char == "(":
+				self.elide_parens += 1;
+				continue;
+			elif char == ")":
+				self.elide_parens = max(0, self.elide_parens - 1);
+				continue;
+			elif self.elide_parens:
+				continue;
+			# End of the function body or statement.
+			self.memo_unsafe = True;
+			self.outbuf = self.elided_from;
+			self.elided_from = None;
+			self.elide_level = None;
+			del self.elided[:];
+			if not self.elide_statement:
+				self.outbuf.append("}" + self.check_end_of_class(part, token.end()));
+			self.statement_start = True;
+			return token.end();
+		return -1;
+
+	## Filter the string part when eliding: the code in it goes to filter_part, the code that is left
+	## out to elide_part. It is the filter_code when elide_bodies is set.
+	def filter_elided(self, part):
+		pos = 0;
+		end = len(part);
+		while pos < end:
+			if self.elide_level is not None:
+				pos = self.elide_part(part, pos);
+				if pos < 0:
+					return;
+				continue;
+			# Up to the next "{" only, where a function body may start. Filtering all of the rest
+			# of a minified line after every function body would take quadratic time.
+			brace = part.find("{", pos);
+			piece_end = end if brace < 0 else brace + 1;
+			self.filter_part(part[pos:piece_end]);
+			pos = piece_end;
+			if self.elide_rest is not None:
+				# filter_part started eliding, the rest of the piece is left out.
+				pos -= len(self.elide_rest);
+				self.elide_rest = None;
+
+	## Set filter_code, which gets the code between the comments and strings of a line: filter_elided when
+	## eliding, else filter_part. Called again when filtering starts, so it calls the methods as they are
+	## then, like the timed ones of the statistics.
+	def select_filter_code(self):
+		if self.settings.elide_bodies:
+			self.filter_code = self.filter_elided;
+		else:
+			self.filter_code = self.filter_part;
+
+	## Return a line handler that handles lines with line_handler, and puts back the line ending of the
+	## lines that end while eliding so the output has the same line numbers.
+	def eliding(self, line_handler):
+		def handle(line, lineno):
+			if self.elide_level is not None:
+				self.elided_from = self.outbuf;
+				self.outbuf = self.elided;
+			line_handler(line, lineno);
+			if self.elide_level is not None:
+				del self.elided[:];
+				self.outbuf = self.elided_from;
+				self.elided_from = None;
+				self.outbuf.append(line[len(line.rstrip("\r\n")):]);
+		return handle;
 
 	## Checks whether we have reached the end of a function's parameters.
 	def check_params_end(self, part):
@@ -341,137 +864,271 @@ class SquirrelFilter:
 			if temp:
 				# Found end of params
 				self.params_buf += part[:temp.end()];
-				self.cur_class.AddMemberFunctionParams(self.params_buf);
+				self.params_class.AddMemberFunctionParams(self.params_buf);
 				self.need_function_params = False;
 				self.params_buf = "";
 			else:
 				self.params_buf += part;
 
+	## Add a symbol to the list of symbols. For functions rest is the part after the name, which
+	## starts the parameters.
+	def add_symbol(self, kind, classname, name, rest=None):
+		if name.startswith("_"):
+			visibility = "private";
+		else:
+			visibility = "public";
+		symbol = [self.lineno + 1, kind, visibility, classname, name, None];
+		self.symbols.append(symbol);
+		if rest is not None:
+			symbol[5] = "";
+			self.symbol_params = symbol;
+			self.add_symbol_params(rest);
+
+	## Add part to the parameters of the function symbol, until the closing ")".
+	def add_symbol_params(self, part):
+		symbol = self.symbol_params;
+		end = part.find(")");
+		if end < 0:
+			symbol[5] += part;
+		else:
+			symbol[5] = " ".join((symbol[5] + part[:end+1]).split());
+			self.symbol_params = None;
+
+	## Insert doxy_cmd before every match of regex whose name_group starts with "_".
+	def mark_private(self, regex, name_group, output, doxy_cmd, rule):
+		pieces = [];
+		pos = 0;
+		for temp in regex.finditer(output):
+			if temp.group(name_group).startswith("_"):
+				if self.settings.hide_private_symbols:
+					self.rule_hits[rule] += 1;
+				pieces.append(output[pos:temp.start(1)]);
+				pieces.append(doxy_cmd);
+				pos = temp.start(1);
+		if not pieces:
+			return output;
+		pieces.append(output[pos:]);
+		return "".join(pieces);
+
 	## Filter the string part
-	## @note We currently only allow one of each element on a line.
+	## One search finds which keywords are in the part, and only the rules for those run.
+	## The rewrites are done for every occurrence in the part, constructor only where it is defined, not in
+	## calls like base.constructor(x). Only one class definition and one function defined outside its class
+	## are handled per part.
 	def filter_part(self, part):
+		if self.symbol_params is not None:
+			self.add_symbol_params(part);
+		if (self.settings.elide_bodies and self.statement_start and self.block_level == 0 and not self.want_class_end
+			and not self.want_class_start and not self.want_body and self.re_statement.match(part)):
+			# Code outside functions and classes.
+			self.start_elision(0, True);
+			self.elide_rest = part;
+			return;
+		triggers = self.re_trigger.findall(part);
+		if not triggers and not self.need_function_params:
+			# Nothing to change.
+			if self.settings.elide_bodies:
+				# A ";" still ends a function declaration without a body, the same as when
+				# the parameters of a Class::function are being looked for.
+				self.find_body(part, ());
+				self.end_statement(part);
+			self.outbuf.append(part);
+			return;
+		triggers = set(triggers);
+		settings = self.settings;
+		hits = self.rule_hits;
 		output = part;
 		start_pos = 0;
 		
 		# Replace <- with =
-		assignment = self.re_assignment.search(output);
-		if (assignment is not None):
-			output = output[:assignment.start()] + "=" + output[assignment.end():]
-		else:
-			output = part;
+		if "<-" in triggers:
+			hits["assignment"] += 1;
+			output = output.replace("<-", "=");
 
 		# Replace extends with :
-		extends = self.re_extends.search(output);
-		if (extends is not None):
-			output = output[:extends.start()] + ":" + output[extends.end():]
+		if "extends" in triggers:
+			hits["extends"] += 1;
+			output = output.replace("extends", ":");
 
 		# Get class name if a class is defined
-		classname = self.re_classname.search(output);
-		if classname:
-			self.want_class_start = True;
-			start_pos = classname.end();
-			self.current_class = classname.group(1);
-			self.cur_class = ClassData(self.current_class);
-			self.classes.append(self.cur_class);
-			self.class_names.append(self.current_class);
-			alwaysprint("class " + self.current_class + "\n");
+		if "class" in triggers:
+			classname = self.re_classname.search(output);
+			if classname:
+				hits["class"] += 1;
+				self.memo_unsafe = True;
+				self.want_class_start = True;
+				start_pos = classname.end();
+				self.current_class = classname.group(1);
+				self.cur_class = self.registry.define(self.current_class, self.lineno + 1);
+				self.diagnostic("class", "class " + self.current_class);
+				if self.symbols is not None:
+					self.add_symbol("class", None, self.current_class);
+					base = self.re_classbase.match(output, classname.end());
+					if base:
+						self.add_symbol("base", self.current_class, base.group(1));
 		
 		# Check if we can find a class start block
-		if self.want_class_start:
+		if self.want_class_start and "{" in triggers:
 			first_part = output[:start_pos];
 			last_part = output[start_pos:];
 			class_start = self.re_blockstart.search(last_part);
 			if class_start:
+				hits["class_start"] += 1;
 				self.want_class_start = False;
 				self.want_class_end = True;
 				output = first_part + last_part[:class_start.end()] + "public:" + last_part[class_start.end():];
 
 		# Check for a function and register it's name if tracking is on
-		if track_class_functions:
+		if settings.track_class_functions:
 			if self.need_function_params:
 				self.check_params_end(output);
-			if self.want_class_end:
+			if "function" not in triggers:
+				pass;
+			elif self.want_class_end:
 				# Inside a class we only need to register functions names
-				fn_name = self.re_functionname.search(output);
-				if fn_name:
+				self.memo_unsafe = True;
+				pieces = [];
+				pos = 0;
+				for fn_name in self.re_functionname.finditer(output):
+					hits["member_function"] += 1;
 					self.cur_class.AddClassMemberFunctionInside(fn_name.group(2));
+					if self.symbols is not None:
+						self.add_symbol("function", self.cur_class.classname, fn_name.group(2), output[fn_name.end(2):]);
 					# Check if function name starts with a "_" (private function)
-					if hide_private_symbols and fn_name.group(2).startswith("_"):
-						output = output[:fn_name.start(1)] + " /** @private */ " + output[fn_name.start(1):];
+					if (settings.hide_private_symbols or self.ir) and fn_name.group(2).startswith("_"):
+						pieces.append(output[pos:fn_name.start(1)]);
+						pieces.append(IR_PRIVATE if self.ir else " /** @private */ ");
+						pos = fn_name.start(1);
+				if pieces:
+					pieces.append(output[pos:]);
+					output = "".join(pieces);
 			elif (self.block_level == 0):
 				#Outside a class. Assuming we can only start class functions at the outermost level
 				fn_name = self.re_classfunctionname.search(output);
 				if fn_name:
+					hits["class_function"] += 1;
+					self.memo_unsafe = True;
+					if self.need_function_params:
+						# The parameters of the previous Class::function don't end, a new definition starts here.
+						self.need_function_params = False;
+						self.params_buf = "";
 					cname = fn_name.group(2);
 					fname = fn_name.group(3);
-					cidx = self.class_names.index(cname);
-					# Set current class to the class of this function.
-					self.cur_class = self.classes[cidx];
-					if (self.classes[cidx].functions.count(fname) == 0 and
-						not (hide_private_symbols and fn_name.group(3).startswith("_"))):
+					if self.symbols is not None:
+						self.add_symbol("outside_function", cname, fname, output[fn_name.end(3):]);
+					# Not cur_class: a class may be waiting for its "{" in broken code.
+					classdata = self.registry.get(cname);
+					if classdata is not None:
+						# With ir private functions are added too, render_ir leaves them out.
+						hide_private = settings.hide_private_symbols and not self.ir;
+					else:
+						# Class defined in another file or later in this file.
+						classdata = self.registry.foreign_class(cname);
+						self.foreign_lines.setdefault(cname, (self.lineno + 1, fname));
+						# Keep private functions too, they are hidden when they are added to their class.
+						hide_private = False;
+					if (fname not in classdata.functions and fname not in classdata.missing and
+						not (hide_private and fname.startswith("_"))):
 						# Not found in list of classes, add to missing
-						self.cur_class.AddClassMemberFunctionOutside(fname);
+						classdata.AddClassMemberFunctionOutside(fname);
 						# Looking for functions params now
 						self.need_function_params = True;
+						self.params_class = classdata;
 						self.check_params_end(output[fn_name.end(3):]);
 
 		# Hide private variables/enums if needed
 		# Only at global scope (level 0) or global class scope (level 1)
-		if (hide_private_symbols and (self.block_level == 0 or
+		if ((settings.hide_private_symbols or self.ir) and (self.block_level == 0 or
 			(self.want_class_end and self.block_level == 1))):
-			temp = self.re_privatevar.search(output);
-			if temp:
-				# Make sure it starts with _
-				if temp.group(1).startswith("_"):
-					# private variable: add private: marker
-					if self.block_level == 0:
-						## @bug This does not work. Maybe comment the whole source line?
-						## But then what if a variable ends on a different line.
-						doxy_cmd = " /** @internal */ ";
-					else:
-						doxy_cmd = " /** @private */ ";
-					output = output[:temp.start(1)] + doxy_cmd + output[temp.start(1):];
+			if self.block_level == 0:
+				## @bug This does not work. Maybe comment the whole source line?
+				## But then what if a variable or enum ends on a different line.
+				doxy_cmd = IR_INTERNAL if self.ir else " /** @internal */ ";
+			else:
+				doxy_cmd = IR_PRIVATE if self.ir else " /** @private */ ";
+			# private variable: add private: marker
+			if "=" in triggers or "<-" in triggers:
+				output = self.mark_private(self.re_privatevar, 1, output, doxy_cmd, "private_variable");
 			# Test for private enumerate
-			temp = self.re_privateenum.search(output);
-			if temp and temp.group(2).startswith("_"):
-				if self.block_level == 0:
-					## @bug This does not work. Maybe comment the whole source line?
-					## But then what if an enum ends on a different line, which is likely.
-					doxy_cmd = " /** @internal */ ";
-				else:
-					doxy_cmd = " /** @private */ ";
-				output = output[:temp.start(1)] + doxy_cmd + output[temp.start(1):];
+			if "enum" in triggers:
+				output = self.mark_private(self.re_privateenum, 2, output, doxy_cmd, "private_enum");
+
+		# Remember the enum, so a missing ";" after its "}" is reported.
+		if "enum" in triggers:
+			enum = self.re_enumname.search(output);
+			if enum:
+				self.enum_start = (self.block_level, enum.group(1));
 
 		# Replace constructor with the class name
-		constr = self.re_constructor.search(output);
-		if constr:
-			if (keep_constructor == False):
-				output = output[:constr.start()] + self.current_class + output[constr.end():];
+		if "constructor" in triggers:
+			hits["constructor"] += 1;
+			# The output depends on the current class.
+			self.memo_unsafe = True;
+			if self.symbols is not None and self.want_class_end:
+				constructor = self.re_constructordef.search(output);
+				if constructor:
+					# Named after its class, like the filter writes it.
+					self.add_symbol("constructor", self.current_class, self.current_class, output[constructor.end():]);
+			# Only definitions, not calls like base.constructor().
+			if self.ir:
+				replacement = IR_CONSTRUCTOR + self.current_class;
+			elif (settings.keep_constructor == False):
+				replacement = self.current_class;
 			else:
-				output = output[:constr.end()] + " " + self.current_class + output[constr.end():];
+				replacement = "constructor " + self.current_class;
+			output = self.re_constructordef.sub(lambda match: replacement, output);
 				
-		if (keep_function == False):
+		if "function" in triggers and (settings.keep_function == False or self.ir):
 			# Replace function with nothing
-			temp = self.re_function.search(output);
-			if temp:
-				output = output[:temp.start()] + output[temp.end():];
+			if settings.keep_function == False:
+				hits["function"] += 1;
+			output = self.re_functionword.sub(IR_FUNCTION if self.ir else "", output);
+
+		# Found require or import, replace by #include. We don't bother with the closing ")" since it seems doxygen doesn't care.
+		if "require" in triggers:
+			output, count = self.re_require.subn("#include ", output);
+			hits["require"] += count;
+		if "import" in triggers:
+			output, count = self.re_import.subn("#include ", output);
+			hits["import"] += count;
 
-		temp = self.re_require.search(output);
-		if temp:
-			# Found require, replace by #include. We don't bother with the closing ")" since it seems doxygen doesn't care.
-			output = output[:temp.start()] + "#include " + output[temp.end():];
-		temp = self.re_import.search(output);
-		if temp:
-			# Found import, replace by #include. We don't bother with the closing ")" since it seems doxygen doesn't care.
-			output = output[:temp.start()] + "#include " + output[temp.end():];
+		if settings.elide_bodies:
+			self.find_body(output, triggers);
 
 		# Check for reaching end of class brace.
 		# Also makes sure any "}" is always followed by a ";".
-		if check_end_of_class:
+		if settings.check_end_of_class and ("{" in triggers or "}" in triggers):
+			hits["blocks"] += 1;
 			output = self.parse_blocks(output);
+			if self.elide_level is not None:
+				# The rest of the part is in elide_rest.
+				return;
+		if settings.elide_bodies:
+			self.end_statement(output);
 
 		# Add output to buffer.
-		self.outbuf += output;
+		self.outbuf.append(output);
+
+	## Used when eliding: after a function name the next "{" starts its body, unless a ";" comes first
+	## because the function is only declared.
+	def find_body(self, output, triggers):
+		# The name may come after the "{" of its class, parse_blocks checks the level of the body.
+		if (("function" in triggers or "constructor" in triggers) and
+			self.block_level <= (1 if self.want_class_end else 0)):
+			self.want_body = True;
+		if self.want_body and ";" in output:
+			brace = output.find("{");
+			if brace < 0 or output.find(";") < brace:
+				self.want_body = False;
+
+	## Used when eliding: remember if the code at the outermost level ends a statement.
+	def end_statement(self, output):
+		if self.block_level == 0 and not self.want_class_end:
+			if self.ir and not self.settings.keep_function:
+				output = output.replace(IR_FUNCTION, "");
+			code = output.rstrip();
+			if code:
+				self.statement_start = code[-1] in ";}";
 
 	## Handle one line of text and send to buffer after filtering.
 	def line_handler(self, line, lineno):
@@ -483,12 +1140,12 @@ class SquirrelFilter:
 				ml_end = self.re_multiline_comment_end.search(temp_line);
 				if (ml_end is None):
 					# End of multi line comment not found on this line
-					self.outbuf += temp_line;
+					self.outbuf.append(temp_line);
 					break;
 				else:
 					# End of multi line comment found
 					self.in_multiline_comment = False;
-					self.outbuf += temp_line[:ml_end.end()];
+					self.outbuf.append(temp_line[:ml_end.end()]);
 					temp_line = temp_line[ml_end.end():];
 			else:
 				ml_start = self.re_multiline_comment_start.search(temp_line);
@@ -496,101 +1153,471 @@ class SquirrelFilter:
 				str_start = self.re_string.search(temp_line);
 				next_match = self.first_match(ml_start, sl_start, str_start);
 				if next_match is None:
-					self.filter_part(temp_line);
+					self.filter_code(temp_line);
 					break;
 				elif next_match == ml_start:
 					self.in_multiline_comment = True;
 					# Filter part before the multi line comment starts and add to output
-					self.filter_part(temp_line[:ml_start.end()]);
+					self.filter_code(temp_line[:ml_start.end()]);
 					temp_line = temp_line[ml_start.end():];
 				elif next_match == sl_start:
 					# First filter the part before the comment starts, then add the comment itself unfiltered
-					self.filter_part(temp_line[:sl_start.start()]);
-					self.outbuf += temp_line[sl_start.start():];
+					self.filter_code(temp_line[:sl_start.start()]);
+					self.outbuf.append(temp_line[sl_start.start():]);
 					break;
 				else:
 					# Filter the part before the string starts and add to output
-					self.filter_part(temp_line[:str_start.start()]);
+					self.filter_code(temp_line[:str_start.start()]);
 					# Then try to find the end of string
 					temp_line = temp_line[str_start.start():]
 					str_end = self.re_string.search(temp_line);
 					if (str_end is None):
 						#Error
-						alwaysprint("** Warning: didn't find end of string on line" + str(lineno+1));
+						self.diagnostic("unterminated-string", "didn't find end of string", lineno + 1);
 						# Add the string contents to output
-						self.outbuf += temp_line;
+						self.outbuf.append(temp_line);
 						break;
 					else:
 						# Add the string contents to output
-						self.outbuf += temp_line[:str_end.end()];
+						self.outbuf.append(temp_line[:str_end.end()]);
 						temp_line = temp_line[str_end.end():]
 
+	## Handle one line of text like line_handler, but walk the line once with a cursor
+	## instead of searching and slicing the rest of the line again after every token.
+	def line_handler_cursor(self, line, lineno):
+		pos = 0;
+		end = len(line);
+		while pos < end:
+			if self.in_multiline_comment:
+				ml_end = line.find("*/", pos);
+				if ml_end < 0:
+					# End of multi line comment not found on this line
+					self.outbuf.append(line[pos:]);
+					break;
+				self.in_multiline_comment = False;
+				self.outbuf.append(line[pos:ml_end+2]);
+				pos = ml_end + 2;
+				continue;
+			if self.in_verbatim_string:
+				str_end = self.re_verbatim_rest.match(line, pos);
+				if str_end is None:
+					# String continues on the next line
+					self.outbuf.append(line[pos:]);
+					break;
+				self.in_verbatim_string = False;
+				self.outbuf.append(line[pos:str_end.end()]);
+				pos = str_end.end();
+				continue;
+
+			token = self.re_lex_token.search(line, pos);
+			if token is None:
+				self.filter_code(line[pos:]);
+				break;
+			start = token.start();
+			kind = line[start];
+			if kind == "/":
+				if line[start+1] == "/":
+					# Filter the part before the comment, then add the comment itself unfiltered
+					if start > pos:
+						self.filter_code(line[pos:start]);
+					self.outbuf.append(line[start:]);
+					break;
+				# Start of multi line comment. Filter the part before it including the comment start.
+				self.in_multiline_comment = True;
+				self.filter_code(line[pos:token.end()]);
+				pos = token.end();
+			elif kind == "'":
+				# Character constant: add unfiltered
+				if start > pos:
+					self.filter_code(line[pos:start]);
+				self.outbuf.append(token.group());
+				pos = token.end();
+			else:
+				if start > pos:
+					self.filter_code(line[pos:start]);
+				if kind == "@":
+					self.in_verbatim_string = True;
+					self.outbuf.append(token.group());
+					pos = token.end();
+					continue;
+				str_end = self.re_string_rest.match(line, token.end());
+				if str_end is None:
+					self.diagnostic("unterminated-string", "didn't find end of string", lineno + 1);
+					# Add the string contents to output
+					self.outbuf.append(line[start:]);
+					break;
+				# Add the string contents to output
+				self.outbuf.append(line[start:str_end.end()]);
+				pos = str_end.end();
+
+	## Return a line handler that handles lines with line_handler, or replays what it did when
+	## the same line was handled before in the same state.
+	def memoized(self, line_handler):
+		memo = self.memo;
+		hits = self.rule_hits;
+		max_line = self.memo_max_line;
+		def handle(line, lineno):
+			if self.need_function_params or self.symbol_params is not None or len(line) > max_line:
+				# The line adds to the parameters of a function, which is more than the state.
+				line_handler(line, lineno);
+				return;
+			key = (line, self.in_multiline_comment, self.in_verbatim_string, self.want_class_start,
+				self.want_class_end, self.block_level, self.want_body, self.statement_start,
+				self.elide_level, self.elide_statement, self.elide_parens, self.enum_start);
+			entry = memo.get(key);
+			if entry is not None:
+				chunks, state, rules = entry;
+				self.outbuf.extend(chunks);
+				(self.in_multiline_comment, self.in_verbatim_string, self.want_class_start,
+					self.want_class_end, self.block_level, self.want_body, self.statement_start,
+					self.elide_level, self.elide_statement, self.elide_parens, self.enum_start) = state;
+				for rule, count in rules:
+					hits[rule] += count;
+				return;
+			outbuf = self.outbuf;
+			start = len(outbuf);
+			before = dict(hits);
+			self.memo_unsafe = False;
+			line_handler(line, lineno);
+			if (self.memo_unsafe or self.outbuf is not outbuf or self.need_function_params or
+				self.symbol_params is not None):
+				return;
+			state = (self.in_multiline_comment, self.in_verbatim_string, self.want_class_start,
+				self.want_class_end, self.block_level, self.want_body, self.statement_start,
+				self.elide_level, self.elide_statement, self.elide_parens, self.enum_start);
+			rules = tuple((rule, count - before[rule]) for rule, count in hits.items() if count != before[rule]);
+			memo.put(key, (tuple(outbuf[start:]), state, rules));
+		return handle;
+
 	## Write the data in buffer to outfile (stdout)
 	def WriteBuf(self, buffer):
 		try:
 			# Encode output because otherwise in e.g. TownManager.nut you get an encoding error (degree symbol)
-			# To make it work in both python 2 and 3 we check the version here
-			if sys.version_info[0] < 3:
-				self.outfile.write(buffer.encode("utf-8"));
-			else:
-				self.outfile.buffer.write(buffer.encode("utf-8"));
+			self.outfile.write(buffer.encode(self.encoding));
 		except UnicodeEncodeError as e:
-			alwaysprint("*** Unicode encoding error!\n");
+			self.diagnostic("encoding", "unicode encoding error: " + str(e));
+
+	## Add text to the output that is ready.
+	def emit(self, text):
+		self.ready.append(text);
+
+	## Open the file for reading with our encoding.
+	def open_file(self):
+		if self.data is None and ARCHIVE_SEPARATOR in self.filename and not os.path.exists(self.filename):
+			# A member of a tar or zip file, read it once since prescan opens the file too.
+			import doxygen_squirrel_archive
+			self.data = doxygen_squirrel_archive.read_source(self.filename);
+		if self.data is not None:
+			return io.TextIOWrapper(io.BytesIO(self.data), encoding=self.encoding, newline='');
+		return io.open(self.filename, "r", newline='', encoding=self.encoding);   # newline='' means don't convert line endings
+
+	## Return string, which was read from the file, as text.
+	def to_text(self, string):
+		if self.encoding == "utf-8":
+			return string;
+		return string.encode(self.encoding).decode("utf-8", "replace");
+
+	## Return the symbols with their class names, names and parameters as text.
+	def text_symbols(self):
+		for symbol in self.symbols:
+			for column in (3, 4, 5):
+				if symbol[column] is not None:
+					symbol[column] = self.to_text(symbol[column]);
+		return self.symbols;
+
+	## Return text in the encoding of the strings read from the file.
+	def from_text(self, text):
+		if self.encoding == "utf-8":
+			return text;
+		return text.encode("utf-8").decode(self.encoding);
 	
-	## Filter the file and output to stdout
-	def filter(self):
-		self.outfile = sys.stdout;
-
-		# Open file for reading
-		nut_file = io.open(self.filename, "r", newline='', encoding='utf-8')   # newline='' means don't convert line endings
-		lines = nut_file.readlines();
-		nut_file.seek(0);
+	## Find the last line with a Class::function definition for every class, so we know when a class
+	## can't get any more functions and can be written. Returns a dictionary of class name to line number.
+	## Scans lines if given, otherwise the file.
+	def prescan(self, lines=None):
+		last_line = {};
+		if lines is None:
+			nut_file = self.open_file();
+		else:
+			nut_file = lines;
+		for i, line in enumerate(nut_file):
+			if "::" in line:
+				for fn_name in self.re_classfunctionname.finditer(line):
+					last_line[fn_name.group(2)] = i;
+		if lines is None:
+			nut_file.close();
+		return last_line;
+
+	## Check if functions can still be added to a class after the current line.
+	def class_complete(self, classdata):
+		if not self.settings.track_class_functions:
+			return True;
+		if self.outside_last_line is None:
+			return False;
+		if self.need_function_params:
+			# The parameters of the last Class::function continue on the next line.
+			return False;
+		return self.outside_last_line.get(classdata.classname, -1) <= self.lineno;
 
-		# Parse all lines in file
-		for i, line in enumerate(lines):
-			self.line_handler(line, i);
+	## Write the buffered output of a class followed by the functions that were defined outside it.
+	def write_class(self, classdata):
+		if classdata.output_buffer is not None:
+			# Write buffer of everything before end of class block to output
+			self.emit("".join(classdata.output_buffer));
+			classdata.output_buffer = [];
+		classdata.written = True;
 
-		if keep_function:
+		if self.ir:
+			function_str = IR_FUNCTION_DECL;
+		elif self.settings.keep_function:
 			function_str = "function ";
 		else:
 			function_str = "";
-		# Write buffered data per class and add missing functions if needed.
-		for classdata in self.classes:
-			# Write buffer of everything before end of class block to output
-			self.WriteBuf(classdata.output_buffer);
-			
-			#alwaysprint("Class " + classdata.classname + "\n");
-			#alwaysprint("----- functions defined inside class -----\n");
-			#for idx, fn in enumerate(classdata.functions):
-			#	alwaysprint("function " + fn + "\n");
-			if len(classdata.missing) > 0:
-				alwaysprint("----- missing functions inside class " + classdata.classname + "-----\n");
-				for idx, fn in enumerate(classdata.missing):
-					alwaysprint("function " + fn + "\n");
-					self.WriteBuf(function_str + fn + classdata.params[idx] + ";\n");
-
-		# Write buffer of everything after the last class definition block.
-		self.WriteBuf(self.outbuf);
-
-		# Close our file
-		nut_file.close();
+		for fn, params in classdata.missing_functions() + self.other_missing(classdata):
+			declaration = function_str + fn + params + ";\n";
+			if self.ir and fn.startswith("_"):
+				declaration = IR_PRIVATE_START + declaration + IR_PRIVATE_END;
+				if self.settings.hide_private_symbols:
+					# Not added with our settings.
+					self.emit(declaration);
+					continue;
+			self.functions_added += 1;
+			self.diagnostic("added-function", "added function " + fn + " defined outside class " + classdata.classname, classdata.line);
+			self.emit(declaration);
+
+	## Return (name, parameters) of the functions of a class that are defined outside the class
+	## before the class itself in this file or in another file of the project index.
+	def other_missing(self, classdata):
+		candidates = [];
+		foreign = self.registry.foreign.get(classdata.classname);
+		if foreign is not None:
+			candidates.extend(foreign.missing_functions());
+		if self.index is not None:
+			# The index has text, make it the same as what we read from the file.
+			candidates.extend((fn, self.from_text(params))
+				for fn, params in self.index.outside_functions(classdata.classname, self.filename or ""));
+		result = [];
+		known = set(classdata.functions);
+		known.update(classdata.missing);
+		for fn, params in candidates:
+			if fn in known or (self.settings.hide_private_symbols and not self.ir and fn.startswith("_")):
+				continue;
+			known.add(fn);
+			result.append((fn, params));
+		return result;
+
+	## Add a diagnostic for every class with functions defined outside it in this file that isn't defined in this file.
+	def foreign_diagnostics(self):
+		for cname, (line, fname) in self.foreign_lines.items():
+			if self.registry.get(cname) is None:
+				self.diagnostic("unknown-class", "class " + cname + " of " + cname + "::" + fname + " isn't defined in this file", line);
+
+	## Return the first class in the registry that hasn't been written yet, or None.
+	def next_unwritten(self):
+		classes = self.registry.classes;
+		while self.first_unwritten < len(classes) and classes[self.first_unwritten].written:
+			self.first_unwritten += 1;
+		if self.first_unwritten < len(classes):
+			return classes[self.first_unwritten];
+		return None;
+
+	## Write everything that can't change anymore after handling the current line.
+	## Only classes that can still get functions defined outside the class, and everything after them, are held back.
+	## Classes are written in the order they are defined, so a class that isn't complete or whose end
+	## we haven't seen yet holds back the classes after it.
+	def write_complete(self):
+		while self.pending and self.pending[0] is self.next_unwritten() and self.class_complete(self.pending[0]):
+			self.write_class(self.pending.popleft());
+		if len(self.outbuf) - self.outbuf_blocks >= self.flush_chunks:
+			if self.next_unwritten() is not None:
+				# Small chunks take a lot more memory than their text, join the new ones.
+				block = "".join(self.outbuf[self.outbuf_blocks:]);
+				del self.outbuf[self.outbuf_blocks:];
+				self.outbuf.append(block);
+				self.outbuf_blocks += 1;
+			else:
+				self.emit("".join(self.outbuf));
+				self.outbuf = [];
+				self.outbuf_blocks = 0;
+
+	## Filter lines, an iterable of text lines including their line endings, and yield the
+	## output as text chunks as soon as it can't change anymore.
+	## Without outside_last_line from prescan() classes can't be written before the end.
+	def filter_stream(self, lines):
+		if self.settings.lexer_engine == "legacy":
+			line_handler = self.line_handler;
+		else:
+			line_handler = self.line_handler_cursor;
+		if self.settings.elide_bodies:
+			line_handler = self.eliding(line_handler);
+		self.select_filter_code();
+		if self.memo is not None:
+			# Outside eliding, which only changes the output buffer while handling the line.
+			line_handler = self.memoized(line_handler);
+		ready = self.ready;
+		try:
+			for i, line in enumerate(lines):
+				self.lineno = i;
+				line_handler(line, i);
+				self.write_complete();
+				if ready:
+					for chunk in ready:
+						yield chunk;
+					del ready[:];
+
+			# Write the classes we couldn't write yet and add missing functions if needed.
+			for classdata in self.registry.classes:
+				if not classdata.written:
+					self.write_class(classdata);
+			self.foreign_diagnostics();
+
+			# Write buffer of everything after the last class definition block.
+			self.emit("".join(self.outbuf));
+			self.outbuf = [];
+			for chunk in ready:
+				yield chunk;
+			del ready[:];
+		finally:
+			# The diagnostics of a file are written at once, also when filtering fails.
+			self.flush_diagnostics();
+
+	## Filter text and return the output as text.
+	def filter_text(self, text):
+		if isinstance(text, bytes):
+			text = text.decode("utf-8");
+		# Split the lines the same way as reading a file with newline=''.
+		lines = list(io.StringIO(text, newline=''));
+		if self.settings.track_class_functions:
+			self.outside_last_line = self.prescan(lines);
+		return "".join(self.filter_stream(lines));
+
+	## Filter the file and output to outfile, a binary stream that defaults to stdout.
+	def filter(self, outfile=None):
+		if outfile is None:
+			outfile = stdout_binary();
+		self.outfile = outfile;
+		if self.settings.io_mode == "bytes":
+			self.encoding = "latin-1";
+
+		if self.settings.track_class_functions:
+			self.outside_last_line = self.prescan();
+
+		# Open file for reading
+		with self.open_file() as nut_file:
+			for chunk in self.filter_stream(nut_file):
+				self.WriteBuf(chunk);
+		# Encoding errors of the last chunks.
+		self.flush_diagnostics();
+
+## Filter Squirrel source text and return the output as text.
+## settings, index and messages are the same as for SquirrelFilter.
+def filter_text(text, settings=None, index=None, messages=None, filename=None):
+	return SquirrelFilter(filename, index, settings, messages).filter_text(text);
+
+## Filter the Squirrel file at path and write the output to out, a binary stream that defaults to stdout.
+def filter_file(path, out=None, settings=None, index=None, messages=None):
+	SquirrelFilter(path, index, settings, messages).filter(out);
+
+## Filter an iterable of text lines and yield the output as text chunks.
+## Classes are held back until the end, since functions may still be defined outside them.
+def filter_stream(lines, settings=None, index=None, messages=None, filename=None):
+	return SquirrelFilter(filename, index, settings, messages).filter_stream(lines);
+
+## Sub commands that are handled by a separate module, which is only imported when needed.
+SUBCOMMANDS = {
+	"serve": "doxygen_squirrel_server",
+	"batch": "doxygen_squirrel_batch",
+	"cache": "doxygen_squirrel_cache",
+	"index": "doxygen_squirrel_index",
+	"bench": "doxygen_squirrel_bench",
+	"stats": "doxygen_squirrel_stats",
+	"watch": "doxygen_squirrel_watch",
+	"symbols": "doxygen_squirrel_symbols",
+	"preview": "doxygen_squirrel_preview",
+	"tagfile": "doxygen_squirrel_tagfile",
+	"archive": "doxygen_squirrel_archive",
+	"split": "doxygen_squirrel_split",
+	"check": "doxygen_squirrel_check",
+};
+
+## Options that can be given as --name=value before the filename.
+OPTIONS = ("cache", "cache-size", "cache-ir", "index", "stats", "profile", "tracemalloc", "symbols", "diagnostics", "diagnostics-format");
+
+## Split the command line arguments in a dictionary of --name=value options and the other arguments.
+## Returns None for the options if an unknown option is used.
+def parse_options(args):
+	options = {};
+	rest = [];
+	for arg in args:
+		if arg.startswith("--") and "=" in arg:
+			name, value = arg[2:].split("=", 1);
+			if name not in OPTIONS:
+				return None, rest;
+			options[name] = value;
+		else:
+			rest.append(arg);
+	return options, rest;
 
 # --------------------------------------------------------------------------------------------------
 ## This is our main function. We check for correct arguments here and then start our filter.
 # --------------------------------------------------------------------------------------------------
-alwaysprint("Starting doxygen Squirrel filter.\n")
-
-if len(sys.argv) != 2:
-	alwaysprint("usage: " + sys.argv[0] + " filename");
-	sys.exit(1);
-
-
-# Filter the specified file and print the result to stdout
-filename = sys.argv[1] ;
-
-alwaysprint("Filtering file " + filename + ".\n")
-
-DoxygenFilter = SquirrelFilter(filename);
-DoxygenFilter.filter();
-
-sys.exit(0);
+def main(argv):
+	if len(argv) > 1 and argv[1] in SUBCOMMANDS:
+		module = __import__(SUBCOMMANDS[argv[1]]);
+		return module.main(argv[2:]);
+
+	global diagnostics_level, diagnostics_format;
+	options, args = parse_options(argv[1:]);
+	if options is not None:
+		diagnostics_level = options.get("diagnostics", diagnostics_level);
+		diagnostics_format = options.get("diagnostics-format", diagnostics_format);
+	if (options is None or len(args) != 1 or diagnostics_level not in DIAGNOSTIC_LEVELS or
+		diagnostics_format not in ("text", "json")):
+		alwaysprint("usage: " + argv[0] + " [--cache=dir] [--cache-size=MB] [--cache-ir=1] [--index=file] [--stats=file|-] [--profile=dir] [--tracemalloc=1] [--symbols=file] [--diagnostics=quiet|warning|info] [--diagnostics-format=text|json] filename\n");
+		return 1;
+
+	# Filter the specified file and print the result to stdout
+	filename = args[0] ;
+
+	if diagnostics_level == "info":
+		alwaysprint("Starting doxygen Squirrel filter.\nFiltering file " + filename + ".\n");
+
+	index = None;
+	if "index" in options or os.environ.get("SQUIRREL_FILTER_INDEX"):
+		import doxygen_squirrel_index
+		index = doxygen_squirrel_index.open_index(options.get("index"));
+
+	cache = None;
+	if "cache" in options or os.environ.get("SQUIRREL_FILTER_CACHE"):
+		import doxygen_squirrel_cache
+		size = options.get("cache-size");
+		ir = options.get("cache-ir");
+		cache = doxygen_squirrel_cache.open_cache(options.get("cache"), size and float(size), ir and ir not in ("0", ""));
+
+	new_filter = SquirrelFilter;
+	stats = None;
+	if "stats" in options or "profile" in options or "tracemalloc" in options:
+		import doxygen_squirrel_stats
+		stats = doxygen_squirrel_stats.FileStats(filename, options);
+		new_filter = stats.new_filter;
+		stats.begin();
+
+	if cache is not None and "symbols" not in options:
+		cache.filter_file(filename, stdout_binary(), index, new_filter);
+	else:
+		# The symbols are found while filtering, so we can't use cached output.
+		DoxygenFilter = new_filter(filename, index);
+		if "symbols" in options:
+			DoxygenFilter.symbols = [];
+		DoxygenFilter.filter();
+		if "symbols" in options:
+			import doxygen_squirrel_symbols
+			doxygen_squirrel_symbols.write_symbols(options["symbols"], filename, DoxygenFilter.text_symbols());
+
+	if stats is not None:
+		stats.end();
+
+	return 0;
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv));
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Project wide index of Squirrel classes for the doxygen Squirrel filter.
+# Copyright (C) 2015, 2019  Jacob Boerema
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# -------------------------------------------------------------------------
+
+## @file doxygen_squirrel_index.py Project index of functions that are defined outside their class in another file.
+
+## Squirrel allows "class Foo" in one file and "function Foo::bar()" in another file. The filter
+## only sees one file at a time, so we first build an index of the whole project:
+## + python doxygen_squirrel_filter.py index -o project.idx [-i pattern] [-x pattern] source [source ...]
+##
+## and then let the filter use it so the missing prototypes are added to the file that defines the class:
+## + doxygen_squirrel_filter.py --index=project.idx filename (or set SQUIRREL_FILTER_INDEX)
+##
+## The index consists of two JSON files. project.idx maps class names to the functions that are
+## defined outside the class, which is all the filter needs to load. project.idx.state keeps what
+## we found in every file together with its modification time, size and hash, so running the
+## index command again only scans the files that changed.
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+
+import doxygen_squirrel_filter
+import doxygen_squirrel_batch
+
+## Version of the index files. Indexes with another version are rebuilt.
+INDEX_VERSION = 1;
+
+## Output stream that throws away everything.
+class NullWriter:
+	def write(self, data):
+		pass;
+
+	def flush(self):
+		pass;
+
+## Scan one file. Returns a dictionary with the classes defined in the file, their functions
+## defined inside the class and the functions defined outside their class with parameters.
+def scan_file(path):
+	# The filter writes class names etc. to stderr, we don't want that for every file.
+	DoxygenFilter = doxygen_squirrel_filter.SquirrelFilter(path, messages=NullWriter());
+	DoxygenFilter.filter(NullWriter());
+	classes = {};
+	outside = [];
+	for classdata in DoxygenFilter.registry.classes:
+		classes[classdata.classname] = sorted(classdata.functions);
+		for fn, params in classdata.missing_functions():
+			outside.append([classdata.classname, fn, DoxygenFilter.to_text(params)]);
+	for classdata in DoxygenFilter.registry.foreign.values():
+		for fn, params in classdata.missing_functions():
+			outside.append([classdata.classname, fn, DoxygenFilter.to_text(params)]);
+	return {"classes": classes, "outside": outside};
+
+## Return the sha1 of the contents of a file.
+def file_hash(path):
+	with open(path, "rb") as nut_file:
+		return hashlib.sha1(nut_file.read()).hexdigest();
+
+## Read a JSON file of the index, returns None if it doesn't exist or has another version.
+def read_json(path):
+	try:
+		with open(path, "r") as index_file:
+			data = json.load(index_file);
+	except (IOError, OSError, ValueError):
+		return None;
+	if data.get("version") != INDEX_VERSION:
+		return None;
+	return data;
+
+## Write a JSON file of the index through a temporary file, so filters never read half an index.
+def write_json(path, data):
+	tmp_path = path + ".tmp" + str(os.getpid());
+	with open(tmp_path, "w") as index_file:
+		json.dump(data, index_file, separators=(",", ":"), sort_keys=True);
+	doxygen_squirrel_batch.replace_file(tmp_path, path);
+
+## Scan one file for the index. Runs in a worker process.
+def scan_task(task):
+	path, mtime, size = task;
+	try:
+		digest = file_hash(path);
+		return path, [mtime, size, digest], scan_file(path), None;
+	except Exception as e:
+		return path, None, None, str(e);
+
+## Return the contents of the index file for the scan results of all files, a dictionary of path
+## to the result of scan_file: the functions defined outside their class per class name and their digest.
+def index_data(files):
+	outside = {};
+	for path in sorted(files):
+		for cname, fn, params in files[path]["outside"]:
+			outside.setdefault(cname, []).append([fn, params, path]);
+	digest = hashlib.sha1(json.dumps(outside, sort_keys=True).encode("utf-8")).hexdigest();
+	return {"version": INDEX_VERSION, "digest": digest, "outside": outside};
+
+## The index used by the filter.
+class ProjectIndex:
+	## Reads the index file at path, unless the data from index_data() is given.
+	def __init__(self, path, data=None):
+		if data is None:
+			data = read_json(path);
+		if data is None:
+			raise IOError("No valid Squirrel project index found: " + path);
+		self.outside = data["outside"];
+		## Digest of the outside functions, changes when the filter output may change.
+		self.digest = data["digest"];
+
+	## Return a list of (name, parameters) of the functions of classname that are defined
+	## outside the class in other files than filename.
+	def outside_functions(self, classname, filename):
+		functions = self.outside.get(classname);
+		if not functions:
+			return [];
+		path = os.path.abspath(filename);
+		return [(fn, params) for fn, params, fn_path in functions if fn_path != path];
+
+## Return the index configured by the option or environment, or None if no index is used.
+def open_index(path=None):
+	if path is None:
+		path = os.environ.get("SQUIRREL_FILTER_INDEX");
+	if not path:
+		return None;
+	return ProjectIndex(path);
+
+## Build or update the index at index_path for all files found in sources.
+## Returns (number of files scanned, number of unchanged files, number of removed files).
+def update_index(index_path, sources, include, exclude, jobs=1):
+	state = read_json(index_path + ".state");
+	if state is None:
+		state = {"version": INDEX_VERSION, "files": {}};
+	old_files = state["files"];
+	new_files = {};
+	tasks = [];
+	unchanged = 0;
+	for size, path, relpath in doxygen_squirrel_batch.find_files(sources, include, exclude):
+		mtime = os.path.getmtime(path);
+		old = old_files.get(path);
+		if old is not None and old["mtime"] == mtime and old["size"] == size:
+			new_files[path] = old;
+			unchanged += 1;
+		else:
+			tasks.append((path, mtime, size));
+
+	scanned = 0;
+	if jobs > 1 and len(tasks) > 1:
+		pool = doxygen_squirrel_batch.multiprocessing.Pool(jobs);
+		results = pool.imap_unordered(scan_task, tasks, 1);
+	else:
+		pool = None;
+		results = (scan_task(task) for task in tasks);
+	for path, info, found, error in results:
+		if error is not None:
+			doxygen_squirrel_filter.alwaysprint("** Error indexing " + path + ": " + error + "\n");
+			continue;
+		mtime, size, digest = info;
+		old = old_files.get(path);
+		if old is not None and old["hash"] == digest:
+			# Only touched: keep what we found before.
+			found = old;
+			unchanged += 1;
+		else:
+			scanned += 1;
+		found = dict(found, mtime=mtime, size=size, hash=digest);
+		new_files[path] = found;
+	if pool is not None:
+		pool.close();
+		pool.join();
+	removed = len(set(old_files) - set(new_files));
+
+	state["files"] = new_files;
+	write_json(index_path + ".state", state);
+	write_json(index_path, index_data(new_files));
+	return scanned, unchanged, removed;
+
+def main(args):
+	parser = argparse.ArgumentParser(prog="doxygen_squirrel_filter.py index",
+		description="Build or update the project index of functions defined outside their class.");
+	parser.add_argument("sources", nargs="+", help="source directories or files");
+	parser.add_argument("-o", "--output", required=True, help="index file to create or update");
+	parser.add_argument("-i", "--include", action="append",
+		help="file name pattern to include, can be repeated (default: *.nut)");
+	parser.add_argument("-x", "--exclude", action="append", default=[],
+		help="path pattern to exclude, can be repeated");
+	parser.add_argument("-j", "--jobs", type=int, default=1,
+		help="number of worker processes (default: %(default)s)");
+	options = parser.parse_args(args);
+
+	scanned, unchanged, removed = update_index(os.path.abspath(options.output), options.sources,
+		options.include or ["*.nut"], options.exclude, max(1, options.jobs));
+	doxygen_squirrel_filter.alwaysprint("Index " + options.output + ": %d files scanned, %d unchanged, %d removed.\n" %
+		(scanned, unchanged, removed));
+	return 0;
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]));
@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Live preview server for the doxygen Squirrel filter.
+# Copyright (C) 2015, 2019  Jacob Boerema
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# -------------------------------------------------------------------------
+
+## @file doxygen_squirrel_preview.py Live preview of the filtered output that only filters the edited lines again.
+
+## Usage:
+## + python doxygen_squirrel_filter.py preview [--socket path] [--index file]
+##
+## Editors connect to the Unix socket and talk JSON-RPC 2.0, one JSON object per line. The socket is kept
+## private to our user the same way as that of the filter server.
+## Methods, lines are counted from 0:
+## + open {"document": id, "text": text, "path": path (optional)}: start a preview of text.
+## + edit {"document": id, "start": line, "end": line, "text": text}: replace lines start up to
+##   but not including end by text, which should be whole lines.
+## + output {"document": id}: the filtered text.
+## + close {"document": id}
+## + stats {}: number of edits and the mean and maximum latency per document.
+##
+## open and edit answer with the filtered text ("output"), the number of lines that were filtered
+## again ("lines_filtered") and the time spent in milliseconds ("filter_ms" and "render_ms").
+##
+## The state of the lexer and parser is saved before every line: being in a comment or string,
+## the block level, looking for the start or end of a class, the current class and function
+## parameters that we are still collecting. An edit resumes filtering from the state before its first
+## line and stops at the first line after the edit where the state is the same as in the previous
+## run, since from there on the output will be the same. The output of a line doesn't depend on the
+## functions found in other lines, so those are saved per line and the functions that are defined
+## outside their class are added to the classes when rendering, like the filter does.
+
+import io
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import itertools
+import operator
+import traceback
+
+try:
+	import socketserver
+except ImportError:
+	# python 2
+	import SocketServer as socketserver
+
+import doxygen_squirrel_filter
+import doxygen_squirrel_index
+import doxygen_squirrel_server
+
+## Most precise clock available.
+clock = getattr(time, "perf_counter", time.time);
+
+## Default socket path, in the socket directory of the filter server that only our user can access.
+def default_socket_path():
+	return os.environ.get("SQUIRREL_PREVIEW_SOCKET",
+		os.path.join(doxygen_squirrel_server.socket_directory(), "doxygen_squirrel_preview.sock"));
+
+## Attributes of SquirrelFilter that are the state of the lexer and parser between lines.
+## The buffers of eliding are empty between lines, they are here so a line that leaves them otherwise
+## doesn't go unnoticed.
+CHECKPOINT_STATE = ("in_multiline_comment", "in_verbatim_string", "current_class", "want_class_start",
+	"want_class_end", "block_level", "need_function_params", "params_buf", "params_class", "cur_class",
+	"want_body", "statement_start", "elide_level", "elide_statement", "elide_parens", "elided_from", "elided",
+	"elide_rest", "enum_start");
+
+## Return the state of a filter as a tuple of the attributes in CHECKPOINT_STATE.
+get_state = operator.attrgetter(*CHECKPOINT_STATE);
+
+## Stands in for the ClassData of a class while filtering a line: it records what is added to the
+## class in the events of the line instead. It's also the marker of the end of its class in the output.
+class ClassRef(object):
+	__slots__ = ("classname", "recorder", "line");
+
+	## Always empty, so every function found is recorded. Duplicates are dropped when rendering.
+	functions = frozenset();
+	missing = frozenset();
+
+	## line is where the class is defined, or for a Class::function where it is.
+	def __init__(self, name, recorder, line=0):
+		self.classname = name;
+		self.recorder = recorder;
+		self.line = line;
+
+	def AddClassMemberFunctionInside(self, name):
+		self.recorder.events.append(("inside", self, name));
+
+	def AddClassMemberFunctionOutside(self, name):
+		self.recorder.events.append(("outside", self, name));
+
+	def AddMemberFunctionParams(self, parameters):
+		self.recorder.events.append(("params", self, parameters));
+
+## Registry of PreviewFilter: classes are only recorded, they are defined when rendering.
+class RecordingRegistry(object):
+	__slots__ = ("recorder",);
+
+	def __init__(self, recorder):
+		self.recorder = recorder;
+
+	def define(self, name, line=0):
+		ref = ClassRef(name, self.recorder, line);
+		self.recorder.events.append(("define", ref, name));
+		return ref;
+
+	## Whether a class is defined before a Class::function is only known when rendering. So the preview
+	## looks for the parameters of every Class::function, which must not change the output.
+	def get(self, name):
+		return None;
+
+	def foreign_class(self, name):
+		return ClassRef(name, self.recorder, self.recorder.lineno + 1);
+
+## SquirrelFilter that filters one line at a time and keeps the output and classes of every line apart.
+class PreviewFilter(doxygen_squirrel_filter.SquirrelFilter):
+	def __init__(self, filename=None, settings=None):
+		doxygen_squirrel_filter.SquirrelFilter.__init__(self, filename, settings=settings,
+			messages=doxygen_squirrel_index.NullWriter());
+		## Classes and functions found in the current line: (kind, ClassRef, name or parameters).
+		self.events = [];
+		self.registry = RecordingRegistry(self);
+		if self.settings.lexer_engine == "legacy":
+			self.handle = self.line_handler;
+		else:
+			self.handle = self.line_handler_cursor;
+		if self.settings.elide_bodies:
+			self.handle = self.eliding(self.handle);
+		if self.memo is not None:
+			self.handle = self.memoized(self.handle);
+
+	## Instead of buffering the class, put its ClassRef in the output where the class ends.
+	def end_of_block(self, output, last_part):
+		self.block_level -= 1;
+		output.append(last_part);
+		if (self.block_level == 0 and self.want_class_end == True):
+			self.memo_unsafe = True;
+			self.outbuf.append("".join(output));
+			self.outbuf.append(self.cur_class);
+			del output[:];
+		output.append("}");
+
+	def save_state(self):
+		return get_state(self);
+
+	def restore_state(self, state):
+		for name, value in zip(CHECKPOINT_STATE, state):
+			setattr(self, name, value);
+
+	## Filter one line. Returns (output chunks and ClassRefs of ended classes, events).
+	def filter_line(self, line, lineno):
+		self.lineno = lineno;
+		self.outbuf = [];
+		self.events = [];
+		self.handle(line, lineno);
+		return self.outbuf, self.events;
+
+## Define the classes and add the functions of events, (kind, ClassRef, name or parameters) in the order of
+## the lines, the same as filter_part does for Class::function. Returns the ClassRegistry, a dictionary of
+## ClassRef to the ClassData it stands for and, like SquirrelFilter.foreign_lines, the line and function name
+## of the first Class::function per class that wasn't defined yet.
+def replay(events, hide_private_symbols):
+	registry = doxygen_squirrel_filter.ClassRegistry();
+	targets = {};
+	foreign_lines = {};
+	# Refs of the Class::function definitions that added their function, only those get parameters.
+	added = set();
+	for kind, ref, value in events:
+		if kind == "define":
+			targets[ref] = registry.define(value, ref.line);
+		elif kind == "inside":
+			targets[ref].AddClassMemberFunctionInside(value);
+		elif kind == "outside":
+			classdata = registry.get(ref.classname);
+			hide_private = hide_private_symbols;
+			if classdata is None:
+				classdata = registry.foreign_class(ref.classname);
+				foreign_lines.setdefault(ref.classname, (ref.line, value));
+				hide_private = False;
+			targets[ref] = classdata;
+			if (value not in classdata.functions and value not in classdata.missing and
+				not (hide_private and value.startswith("_"))):
+				classdata.AddClassMemberFunctionOutside(value);
+				added.add(ref);
+		elif ref in added:
+			targets[ref].AddMemberFunctionParams(value);
+	return registry, targets, foreign_lines;
+
+## Return the filtered text of outputs, the output chunks and ClassRefs of ended classes per line, with the
+## functions defined outside their class added by render, a SquirrelFilter with the registry of replay.
+## targets is the dictionary of ClassRef to ClassData of replay.
+def render_outputs(render, outputs, targets):
+	chunks = [];
+	for output in outputs:
+		for chunk in output:
+			if isinstance(chunk, ClassRef):
+				targets[chunk].SetBuffer(["".join(chunks)]);
+				chunks = [];
+			else:
+				chunks.append(chunk);
+	# Classes are written in order, like the filter does at the end of the file.
+	for classdata in render.registry.classes:
+		render.write_class(classdata);
+	render.emit("".join(chunks));
+	return "".join(render.ready);
+
+## Return whether the lines left and right have to be joined, because left doesn't end with a line ending.
+def needs_join(left, right):
+	return left[-1:] not in ("\n", "\r") or (left.endswith("\r") and right.startswith("\n"));
+
+## Split text in lines the same way as reading a file with newline=''.
+def split_lines(text):
+	return list(io.StringIO(text, newline=''));
+
+## The filter failed on the text of a document, e.g. because of a "}" too many while typing.
+class FilterError(Exception):
+	pass;
+
+## The lines of one document with the output, events and the state before every line.
+## Start with an empty document and add the text with edit(0, 0, text).
+class PreviewDocument:
+	def __init__(self, filename=None, index=None, settings=None):
+		self.filename = filename;
+		self.index = index;
+		self.filter = PreviewFilter(filename, settings);
+		self.lines = [];
+		## Output chunks of every line.
+		self.outputs = [];
+		## Classes and functions found in every line.
+		self.events = [];
+		## State before every line, and after the last line.
+		self.states = [self.filter.save_state()];
+		## Line where filtering failed at the last edit, or None.
+		self.failed = None;
+
+	## Replace lines start up to end by text and filter what changed. Returns the number of lines filtered.
+	def edit(self, start, end, text):
+		lines = self.lines;
+		if not 0 <= start <= end <= len(lines):
+			raise ValueError("Invalid line range %d-%d, the document has %d lines" % (start, end, len(lines)));
+		# Edits have to be whole lines, take the lines they are part of into the edit.
+		following = text or (lines[end] if end < len(lines) else "");
+		if start > 0 and following and needs_join(lines[start - 1], following):
+			start -= 1;
+			text = lines[start] + text;
+		if end < len(lines) and text and needs_join(text, lines[end]):
+			text += lines[end];
+			end += 1;
+		new_lines = split_lines(text);
+		count = len(new_lines);
+		lines[start:end] = new_lines;
+		self.outputs[start:end] = [None] * count;
+		self.events[start:end] = [None] * count;
+
+		old_states = self.states;
+		# Line i after the edit was line i - shift before it.
+		shift = count - (end - start);
+		failed = self.failed;
+		begin = start;
+		if failed is not None and failed < start:
+			begin = failed;
+		self.failed = None;
+		states = old_states[:begin + 1];
+		filter_instance = self.filter;
+		filter_instance.restore_state(states[begin]);
+		i = begin;
+		stop = len(lines);
+		try:
+			while i < stop:
+				if i >= start + count and filter_instance.save_state() == old_states[i - shift]:
+					# Same state as before, the rest of the output doesn't change.
+					states.extend(old_states[i - shift + 1:]);
+					if failed is not None:
+						# The filter still fails further on.
+						self.failed = failed + shift;
+					break;
+				self.outputs[i], self.events[i] = filter_instance.filter_line(lines[i], i);
+				i += 1;
+				states.append(filter_instance.save_state());
+		except Exception as e:
+			# The states after this line are unknown, the next edit filters again from here.
+			self.failed = i;
+			states.extend([None] * (stop - i));
+			raise FilterError("line %d: %s" % (i + 1, e));
+		finally:
+			self.states = states;
+			# The preview doesn't show diagnostics, don't let them pile up.
+			del filter_instance.diagnostics.records[:];
+		return i - begin;
+
+	## Return the filtered text, the same as filtering the whole text.
+	def render(self):
+		if self.failed is not None:
+			raise FilterError("filtering failed at line %d" % (self.failed + 1));
+		registry, targets, foreign_lines = replay(itertools.chain.from_iterable(self.events),
+			self.filter.settings.hide_private_symbols);
+		render = doxygen_squirrel_filter.SquirrelFilter(self.filename, self.index, self.filter.settings,
+			doxygen_squirrel_index.NullWriter());
+		render.registry = registry;
+		return render_outputs(render, self.outputs, targets);
+
+## Handles the JSON-RPC requests of one editor connection.
+class PreviewRequestHandler(socketserver.StreamRequestHandler):
+
+	def handle(self):
+		uid = doxygen_squirrel_server.peer_uid(self.request);
+		if uid is not None and uid != os.getuid():
+			# Only for our user, like the filter server.
+			return;
+		## Open documents of this connection by id.
+		self.documents = {};
+		## Number of edits and their total and maximum latency in ms by document id.
+		self.latency = {};
+		while True:
+			line = self.rfile.readline();
+			if not line:
+				break;
+			if not line.strip():
+				continue;
+			response = self.respond(line.decode("utf-8"));
+			if response is not None:
+				self.wfile.write((json.dumps(response) + "\n").encode("utf-8"));
+				self.wfile.flush();
+
+	## Return the response to one request, None for a notification.
+	def respond(self, line):
+		try:
+			request = json.loads(line);
+		except ValueError:
+			return {"jsonrpc": "2.0", "id": None, "error": {"code": -32700, "message": "Parse error"}};
+		if not isinstance(request, dict):
+			return {"jsonrpc": "2.0", "id": None, "error": {"code": -32600, "message": "Invalid Request"}};
+		request_id = request.get("id");
+		try:
+			method = getattr(self, "rpc_" + str(request.get("method")), None);
+			if method is None:
+				error = {"code": -32601, "message": "Method not found"};
+			else:
+				return {"jsonrpc": "2.0", "id": request_id, "result": method(**request.get("params", {}))};
+		except FilterError as e:
+			error = {"code": -32000, "message": "Filter error: " + str(e)};
+		except (TypeError, ValueError, KeyError) as e:
+			error = {"code": -32602, "message": "Invalid params: " + str(e)};
+		except Exception:
+			error = {"code": -32603, "message": "Internal error", "data": traceback.format_exc()};
+		if "id" not in request:
+			return None;
+		return {"jsonrpc": "2.0", "id": request_id, "error": error};
+
+	## Filter, render and measure how long it took. update changes the document and returns the lines filtered.
+	def update(self, document_id, update):
+		start = clock();
+		filtered = update();
+		middle = clock();
+		output = self.documents[document_id].render();
+		end = clock();
+		count, total, maximum = self.latency.get(document_id, (0, 0.0, 0.0));
+		ms = (end - start) * 1000.0;
+		self.latency[document_id] = (count + 1, total + ms, max(maximum, ms));
+		return {"output": output, "lines_filtered": filtered,
+			"filter_ms": (middle - start) * 1000.0, "render_ms": (end - middle) * 1000.0};
+
+	def rpc_open(self, document, text, path=None):
+		self.documents[document] = PreviewDocument(path, self.server.get_index());
+		self.latency.pop(document, None);
+		return self.update(document, lambda: self.documents[document].edit(0, 0, text));
+
+	def rpc_edit(self, document, start, end, text):
+		return self.update(document, lambda: self.documents[document].edit(start, end, text));
+
+	def rpc_output(self, document):
+		return {"output": self.documents[document].render()};
+
+	def rpc_close(self, document):
+		del self.documents[document];
+		self.latency.pop(document, None);
+		return True;
+
+	def rpc_stats(self):
+		return dict((document, {"edits": count, "mean_ms": total / count, "max_ms": maximum})
+			for document, (count, total, maximum) in self.latency.items());
+
+## Unix socket server with a thread per editor connection.
+class PreviewServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True;
+	## Path of the project index or None.
+	index_path = None;
+	index = None;
+
+	## Return the project index, loaded once.
+	def get_index(self):
+		if self.index_path is not None and self.index is None:
+			self.index = doxygen_squirrel_index.ProjectIndex(self.index_path);
+		return self.index;
+
+## Start the preview server on socket_path and serve until interrupted. Returns 1 if another server
+## uses socket_path.
+def serve(socket_path, index_path=None):
+	directory = doxygen_squirrel_server.socket_directory();
+	if os.path.dirname(os.path.abspath(socket_path)) == directory and not doxygen_squirrel_server.private_directory(directory):
+		doxygen_squirrel_filter.alwaysprint("** Error: " + directory + " isn't a directory that only we can access.\n");
+		return 1;
+	if not doxygen_squirrel_server.remove_stale_socket(socket_path):
+		doxygen_squirrel_filter.alwaysprint("** Error: " + socket_path + " is in use by another server or isn't a socket.\n");
+		return 1;
+	server = doxygen_squirrel_server.bind_private(PreviewServer, socket_path, PreviewRequestHandler);
+	server.index_path = index_path;
+	doxygen_squirrel_filter.alwaysprint("Squirrel preview server listening on " + socket_path + "\n");
+	# Make sure the socket gets removed when we are terminated.
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0));
+	try:
+		server.serve_forever();
+	except KeyboardInterrupt:
+		pass;
+	finally:
+		server.server_close();
+		os.unlink(socket_path);
+	return 0;
+
+def main(args):
+	parser = argparse.ArgumentParser(prog="doxygen_squirrel_filter.py preview",
+		description="Serve a live preview of the filtered output to editors over a Unix socket (JSON-RPC).");
+	parser.add_argument("--socket", default=default_socket_path(),
+		help="path of the Unix socket (default: $SQUIRREL_PREVIEW_SOCKET or %(default)s)");
+	parser.add_argument("--index", default=os.environ.get("SQUIRREL_FILTER_INDEX"),
+		help="project index made with the index subcommand (default: $SQUIRREL_FILTER_INDEX)");
+	options = parser.parse_args(args);
+	return serve(options.socket, options.index);
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]));
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Persistent server for the doxygen Squirrel filter.
+# Copyright (C) 2015, 2019  Jacob Boerema
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# -------------------------------------------------------------------------
+
+## @file doxygen_squirrel_server.py Long running filter server that is used by doxygen_squirrel_client.py.
+
+## Doxygen starts the filter once for every file. Starting python and setting up the filter
+## costs more time than filtering an average .nut file, so this server loads the filter once
+## and filters files on request over a local Unix socket.
+## The server reads the files it is asked for with the permissions of its user, so only that user
+## can use it: the socket is in $XDG_RUNTIME_DIR or a directory in /tmp that only the user can access,
+## only the user can connect to it, and requests of other users are ignored where the system tells
+## who connected. The client doesn't use a socket that belongs to another user.
+##
+## Usage:
+## + python doxygen_squirrel_filter.py serve [--socket path]
+## + Set FILTER_PATTERNS to: *.nut=doxygen_squirrel_client.py
+##
+## Protocol: the client sends its working directory, the filename and its SQUIRREL_FILTER_*
+## environment variables as NAME=value, separated by NUL characters and ended by a newline.
+## The server answers with frames consisting of a one byte tag, a 4 byte big endian length
+## and the data. Tag "O" is data for stdout, "E" is data for stderr and "X" is the exit code,
+## which is always the last frame. Tag "R" refuses the request, with the reason as data: the
+## client uses another cache or project index than the server, so it filters the file itself.
+##
+## The diagnostics variables of the client apply to its request, like when it runs the filter.
+
+import os
+import sys
+import stat
+import errno
+import socket
+import struct
+import signal
+import argparse
+import threading
+import traceback
+
+try:
+	import socketserver
+except ImportError:
+	# python 2
+	import SocketServer as socketserver
+
+import doxygen_squirrel_filter
+import doxygen_squirrel_cache
+import doxygen_squirrel_index
+
+## Directory of the default socket: $XDG_RUNTIME_DIR, which only our user can access, or else a directory
+## in /tmp that the server creates for our user only. Keep in sync with doxygen_squirrel_client.py.
+def socket_directory():
+	runtime_dir = os.environ.get("XDG_RUNTIME_DIR");
+	if runtime_dir:
+		return runtime_dir;
+	uid = getattr(os, "getuid", lambda: 0)();
+	return "/tmp/doxygen_squirrel_filter-" + str(uid);
+
+## Error handler for paths with bytes that aren't UTF-8, they are kept as surrogates like os does.
+## Keep in sync with doxygen_squirrel_client.py.
+UNDECODABLE = "surrogateescape" if sys.version_info[0] >= 3 else "strict";
+
+## Default socket path. Keep in sync with doxygen_squirrel_client.py.
+def default_socket_path():
+	return os.environ.get("SQUIRREL_FILTER_SOCKET", os.path.join(socket_directory(), "doxygen_squirrel_filter.sock"));
+
+## Create directory for our user only if it doesn't exist. Returns False if it exists but isn't a directory
+## of our user that only we can access, then a socket in it isn't safe.
+def private_directory(directory):
+	try:
+		os.mkdir(directory, 0o700);
+	except OSError as e:
+		if e.errno != errno.EEXIST:
+			raise;
+	info = os.lstat(directory);
+	return (stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and
+		stat.S_IMODE(info.st_mode) & 0o077 == 0);
+
+## Return the uid of the process at the other end of a Unix socket, or None if the system doesn't tell.
+def peer_uid(sock):
+	if not hasattr(socket, "SO_PEERCRED"):
+		return None;
+	credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"));
+	return struct.unpack("3i", credentials)[1];
+
+## Create server_class listening on socket_path that only our user can connect to. The socket is made
+## with a umask that leaves out the group and others, so there is no moment another user can connect.
+def bind_private(server_class, socket_path, handler_class):
+	old_umask = os.umask(0o177);
+	try:
+		server = server_class(socket_path, handler_class);
+	finally:
+		os.umask(old_umask);
+	os.chmod(socket_path, 0o600);
+	return server;
+
+## Return what the environment of a client in cwd chooses for the run: the absolute path of the project
+## index and the absolute path, size in bytes and IR setting of the cache, None when not used.
+## Raises ValueError when a value can't be used.
+def client_run(cwd, environ):
+	index_path = environ.get("SQUIRREL_FILTER_INDEX");
+	cache_dir = environ.get("SQUIRREL_FILTER_CACHE");
+	cache = None;
+	if cache_dir:
+		size_mb = float(environ.get("SQUIRREL_FILTER_CACHE_SIZE", doxygen_squirrel_cache.DEFAULT_MAX_SIZE_MB));
+		cache = (os.path.abspath(os.path.join(cwd, cache_dir)), int(size_mb * 1024 * 1024),
+			environ.get("SQUIRREL_FILTER_CACHE_IR", "0") not in ("0", ""));
+	return (os.path.abspath(os.path.join(cwd, index_path)) if index_path else None, cache);
+
+## Return the FilterSettings of a client: the settings of the filter file, with the environment variables
+## of the client instead of ours. Raises ValueError for a wrong value.
+def client_settings(environ):
+	return doxygen_squirrel_filter.FilterSettings(**dict(
+		(name, environ.get(variable, doxygen_squirrel_filter.FILE_SETTINGS[name]))
+		for variable, name in doxygen_squirrel_filter.ENVIRONMENT_SETTINGS));
+
+## Buffered writer that sends everything written to it as frames with the given tag.
+class FrameWriter:
+	## Send a frame once this many bytes have been buffered.
+	flush_size = 65536;
+
+	def __init__(self, sock, tag):
+		self.sock = sock;
+		self.tag = tag;
+		self.chunks = [];
+		self.size = 0;
+
+	def write(self, data):
+		if not isinstance(data, bytes):
+			data = data.encode("utf-8", UNDECODABLE);
+		self.chunks.append(data);
+		self.size += len(data);
+		if self.size >= self.flush_size:
+			self.flush();
+
+	def flush(self):
+		if self.size > 0:
+			data = b"".join(self.chunks);
+			self.sock.sendall(self.tag + struct.pack(">I", len(data)) + data);
+		self.chunks = [];
+		self.size = 0;
+
+## Handles one filter request.
+class FilterRequestHandler(socketserver.StreamRequestHandler):
+
+	def handle(self):
+		uid = peer_uid(self.request);
+		if uid is not None and uid != os.getuid():
+			# The socket is only for our user, we read files with our permissions.
+			return;
+		request = self.rfile.readline();
+		if not request:
+			# A new server checking if we still listen, see remove_stale_socket.
+			return;
+		fields = request.rstrip(b"\n").decode("utf-8", UNDECODABLE).split("\0");
+		cwd, filename = fields[:2];
+		environ = dict(field.split("=", 1) for field in fields[2:] if "=" in field);
+		try:
+			same_run = client_run(cwd, environ) == self.server.run();
+		except ValueError:
+			same_run = False;
+		if not same_run:
+			reason = b"the client uses another cache or project index";
+			self.request.sendall(b"R" + struct.pack(">I", len(reason)) + reason);
+			return;
+		out = FrameWriter(self.request, b"O");
+		err = FrameWriter(self.request, b"E");
+		try:
+			settings = client_settings(environ);
+		except ValueError as e:
+			# Like the filter refuses a wrong setting in its environment.
+			err.write("** Error: " + str(e) + "\n");
+			self.send_exit(out, err, 1);
+			return;
+		# The messages of the filter go to this client, not to our stderr.
+		def new_filter(path, index):
+			DoxygenFilter = doxygen_squirrel_filter.SquirrelFilter(path, index, settings, messages=err);
+			# Diagnostics name the file like the client does.
+			DoxygenFilter.diagnostics.filename = filename;
+			return DoxygenFilter;
+		try:
+			if settings.diagnostics_level == "info":
+				err.write("Starting doxygen Squirrel filter.\nFiltering file " + filename + ".\n");
+			path = os.path.join(cwd, filename);
+			index = self.server.get_index();
+			if self.server.cache is not None:
+				self.server.cache.filter_file(path, out, index, new_filter);
+			else:
+				new_filter(path, index).filter(out);
+			exit_code = 0;
+		except Exception:
+			err.write(traceback.format_exc());
+			exit_code = 1;
+		self.send_exit(out, err, exit_code);
+
+	## Send what is left in out and err and the exit code, which ends the request.
+	def send_exit(self, out, err, exit_code):
+		out.flush();
+		err.flush();
+		code = str(exit_code).encode("ascii");
+		self.request.sendall(b"X" + struct.pack(">I", len(code)) + code);
+
+## Unix socket server that handles every request in its own thread, so doxygen runs with
+## NUM_PROC_THREADS > 1 don't have to wait for each other.
+class FilterServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	request_queue_size = 64;
+	daemon_threads = True;
+	## Cache of filtered output or None.
+	cache = None;
+	## Path of the project index or None.
+	index_path = None;
+	index = None;
+	index_mtime = None;
+	index_lock = threading.Lock();
+
+	## Return what the server uses for every run, like client_run().
+	def run(self):
+		cache = None;
+		if self.cache is not None:
+			cache = (os.path.abspath(self.cache.directory), self.cache.max_size, self.cache.ir);
+		return (os.path.abspath(self.index_path) if self.index_path else None, cache);
+
+	## Return the project index, reloading it when it has been updated since the last request.
+	def get_index(self):
+		if self.index_path is None:
+			return None;
+		with self.index_lock:
+			mtime = os.path.getmtime(self.index_path);
+			if mtime != self.index_mtime:
+				self.index = doxygen_squirrel_index.ProjectIndex(self.index_path);
+				self.index_mtime = mtime;
+			return self.index;
+
+## Remove the Unix socket at socket_path if it's left over from a server that didn't shut down cleanly.
+## Returns False if a server is still listening on it or the path isn't a socket, then it's left alone.
+def remove_stale_socket(socket_path):
+	try:
+		mode = os.lstat(socket_path).st_mode;
+	except OSError:
+		# Nothing there.
+		return True;
+	if not stat.S_ISSOCK(mode):
+		return False;
+	probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM);
+	try:
+		probe.connect(socket_path);
+	except socket.error as e:
+		if e.errno == errno.ENOENT:
+			return True;
+		if e.errno != errno.ECONNREFUSED:
+			return False;
+		# Nobody listens on it anymore.
+		try:
+			os.unlink(socket_path);
+		except OSError:
+			# Like a socket of another user in a directory we can't change.
+			return False;
+		return True;
+	finally:
+		probe.close();
+	return False;
+
+## Start the filter server on socket_path and serve until interrupted. Returns 1 if another server
+## uses socket_path.
+def serve(socket_path, cache=None, index_path=None):
+	if os.path.dirname(os.path.abspath(socket_path)) == socket_directory() and not private_directory(socket_directory()):
+		doxygen_squirrel_filter.alwaysprint("** Error: " + socket_directory() + " isn't a directory that only we can access.\n");
+		return 1;
+	if not remove_stale_socket(socket_path):
+		doxygen_squirrel_filter.alwaysprint("** Error: " + socket_path + " is in use by another server or isn't a socket.\n");
+		return 1;
+	server = bind_private(FilterServer, socket_path, FilterRequestHandler);
+	server.cache = cache;
+	server.index_path = index_path;
+	doxygen_squirrel_filter.alwaysprint("Squirrel filter server listening on " + socket_path + "\n");
+	# Make sure the socket gets removed when we are terminated.
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0));
+	try:
+		server.serve_forever();
+	except KeyboardInterrupt:
+		pass;
+	finally:
+		server.server_close();
+		os.unlink(socket_path);
+	return 0;
+
+def main(args):
+	parser = argparse.ArgumentParser(prog="doxygen_squirrel_filter.py serve",
+		description="Serve filter requests from doxygen_squirrel_client.py over a Unix socket.");
+	parser.add_argument("--socket", default=default_socket_path(),
+		help="path of the Unix socket (default: $SQUIRREL_FILTER_SOCKET or %(default)s)");
+	doxygen_squirrel_cache.add_arguments(parser);
+	parser.add_argument("--index", default=os.environ.get("SQUIRREL_FILTER_INDEX"),
+		help="project index made with the index subcommand (default: $SQUIRREL_FILTER_INDEX)");
+	options = parser.parse_args(args);
+	return serve(options.socket, doxygen_squirrel_cache.open_cache(options.cache, options.cache_size, options.cache_ir),
+		options.index);
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]));
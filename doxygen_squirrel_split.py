@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Filtering one huge file on several cores for the doxygen Squirrel filter.
+# Copyright (C) 2015, 2019  Jacob Boerema
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# -------------------------------------------------------------------------
+
+## @file doxygen_squirrel_split.py Filter one huge file on several cores by cutting it between top level classes.
+
+## Usage:
+## + python doxygen_squirrel_filter.py split [-j N] [-o output] filename
+## + python doxygen_squirrel_filter.py split --bench [-j N] filename shows the speedup per number of processes
+##
+## A quick search finds the lines starting with "class". The file is cut before some of them in about
+## SEGMENTS_PER_JOB segments per process, that are filtered in parallel the way the live preview filters
+## lines: the output of a segment is kept apart from the classes it defines and the functions it defines
+## outside their class. These are replayed in the order of the file afterwards, so the functions are added
+## to their class and the output is the same as when filtering the file in one go.
+##
+## Every segment has to start in the state of a new filter: outside comments, strings, blocks and classes,
+## and not looking for the parameters of a Class::function.
+## When the filter doesn't end a segment in that state, the cut wasn't between two top level definitions
+## and the file is filtered in one process instead.
+
+import io
+import re
+import sys
+import time
+import argparse
+import multiprocessing
+
+import doxygen_squirrel_filter
+import doxygen_squirrel_preview
+import doxygen_squirrel_archive
+import doxygen_squirrel_index
+
+## Number of segments per process, more balance the load better but replay more.
+SEGMENTS_PER_JOB = 4;
+
+## Files smaller than this are not split, starting the processes would take longer than filtering.
+MIN_SPLIT_SIZE = 256 * 1024;
+
+## Return the number of processes to use for jobs: not more than the number of cpus, since processes that
+## have to share a cpu are slower than filtering in one process.
+def usable_jobs(jobs):
+	try:
+		cpus = multiprocessing.cpu_count();
+	except NotImplementedError:
+		cpus = 1;
+	return max(1, min(jobs, cpus));
+
+## Lines that may start a top level class.
+re_class_line = re.compile(b"^class[ \t]", re.M);
+
+## State of the filter that has to be the same as that of a new filter where a segment starts.
+SEGMENT_STATE = ("in_multiline_comment", "in_verbatim_string", "want_class_start", "want_class_end", "block_level",
+	"elide_level", "need_function_params", "enum_start");
+
+## State that only matters with elide_bodies. statement_start has to be last, see starts_statement_free.
+ELIDE_STATE = ("want_body", "statement_start");
+
+## Return the state of filter_instance that has to be the same at the end of a segment as at the start of the next one.
+def segment_state(filter_instance):
+	names = SEGMENT_STATE;
+	if filter_instance.settings.elide_bodies:
+		names += ELIDE_STATE;
+	return tuple(getattr(filter_instance, name) for name in names);
+
+## Check if filtering line, the first line of a segment, doesn't depend on statement_start. A comment before
+## a class leaves statement_start False, while a new filter starts with True.
+def starts_statement_free(line, filename, settings):
+	results = [];
+	for statement_start in (True, False):
+		DoxygenFilter = doxygen_squirrel_preview.PreviewFilter(filename, settings);
+		DoxygenFilter.statement_start = statement_start;
+		output, events = DoxygenFilter.filter_line(line, 0);
+		results.append((output, [(kind, value) for kind, ref, value in events], segment_state(DoxygenFilter)));
+	return results[0] == results[1];
+
+## Return the positions in data where a segment starts, except the first one, for about count segments.
+def split_points(data, count):
+	points = [];
+	step = max(len(data) // count, 1);
+	match = re_class_line.search(data, step);
+	while match is not None:
+		points.append(match.start());
+		match = re_class_line.search(data, match.start() + step);
+	return points;
+
+## Return the number of lines in data, counted like reading it with newline=''.
+def count_lines(data):
+	return data.count(b"\n") + data.count(b"\r") - data.count(b"\r\n");
+
+## Filter one segment in a worker process. task is (data, number of lines before it, filename, settings).
+## Returns (output chunks, events, (name, line) of every ClassRef, diagnostics, diagnostic counts, rule hits,
+## whether the first line doesn't depend on statement_start, state at the end). ClassRefs are replaced by their number in the list of names in the chunks and events.
+def filter_segment(task):
+	data, first_line, filename, settings = task;
+	DoxygenFilter = doxygen_squirrel_preview.PreviewFilter(filename, settings);
+	if settings.io_mode == "bytes":
+		DoxygenFilter.encoding = "latin-1";
+	numbers = {};
+	refs = [];
+	def number(ref):
+		if ref not in numbers:
+			numbers[ref] = len(refs);
+			refs.append((ref.classname, ref.line + first_line));
+		return numbers[ref];
+
+	chunks = [];
+	text = [];
+	events = [];
+	lines = io.TextIOWrapper(io.BytesIO(data), encoding=DoxygenFilter.encoding, newline='');
+	for i, line in enumerate(lines):
+		output, line_events = DoxygenFilter.filter_line(line, i);
+		for chunk in output:
+			if isinstance(chunk, doxygen_squirrel_preview.ClassRef):
+				chunks.append("".join(text));
+				chunks.append(number(chunk));
+				text = [];
+			else:
+				text.append(chunk);
+		for kind, ref, value in line_events:
+			events.append((kind, number(ref), value));
+	chunks.append("".join(text));
+	statement_free = False;
+	if settings.elide_bodies:
+		statement_free = starts_statement_free(next(iter(io.TextIOWrapper(io.BytesIO(data),
+			encoding=DoxygenFilter.encoding, newline=''))), filename, settings);
+	diagnostics = [(severity, kind, line + first_line, message)
+		for severity, kind, line, message in DoxygenFilter.diagnostics.records];
+	return (chunks, events, refs, diagnostics, DoxygenFilter.diagnostics.counts, DoxygenFilter.rule_hits,
+		statement_free, segment_state(DoxygenFilter));
+
+## Return the SquirrelFilter that wrote the output of the segments in results to outfile, or None if the
+## segments can't be joined.
+def join_segments(results, filename, index, settings, messages, outfile):
+	fresh = segment_state(doxygen_squirrel_preview.PreviewFilter(filename, settings));
+	for result, next_result in zip(results, results[1:]):
+		state = result[-1];
+		if state != fresh and not (next_result[-2] and state[:-1] == fresh[:-1]):
+			return None;
+
+	render = doxygen_squirrel_filter.SquirrelFilter(filename, index, settings, messages);
+	if settings.io_mode == "bytes":
+		render.encoding = "latin-1";
+	outputs = [];
+	events = [];
+	for chunks, segment_events, refs, diagnostics, counts, rule_hits, statement_free, state in results:
+		classes = [doxygen_squirrel_preview.ClassRef(name, None, line) for name, line in refs];
+		outputs.append([classes[chunk] if isinstance(chunk, int) else chunk for chunk in chunks]);
+		events.extend((kind, classes[ref], value) for kind, ref, value in segment_events);
+		render.diagnostics.records.extend(diagnostics);
+		doxygen_squirrel_filter.add_counts(render.diagnostics.counts, counts);
+		doxygen_squirrel_filter.add_counts(render.rule_hits, rule_hits);
+	render.registry, targets, render.foreign_lines = doxygen_squirrel_preview.replay(events,
+		settings.hide_private_symbols);
+	text = doxygen_squirrel_preview.render_outputs(render, outputs, targets);
+	try:
+		output = text.encode(render.encoding);
+	except UnicodeEncodeError:
+		# The filter leaves out the chunk that can't be encoded, which depends on how the output was chunked.
+		return None;
+	render.foreign_diagnostics();
+	outfile.write(output);
+	render.flush_diagnostics();
+	return render;
+
+## Filter the file at path to outfile, a binary stream, with jobs processes. settings, index and messages are
+## the same as for SquirrelFilter. Returns (the SquirrelFilter that wrote the output, number of segments),
+## with 1 segment when the file was filtered in one process. That is also done with only one cpu or with files
+## smaller than MIN_SPLIT_SIZE.
+def filter_split(path, outfile, jobs, settings=None, index=None, messages=None):
+	if settings is None:
+		settings = doxygen_squirrel_filter.FilterSettings();
+	data = doxygen_squirrel_archive.read_source(path);
+	points = [];
+	jobs = usable_jobs(jobs);
+	if jobs > 1 and len(data) >= MIN_SPLIT_SIZE:
+		points = split_points(data, jobs * SEGMENTS_PER_JOB);
+	if points:
+		tasks = [];
+		line = 0;
+		for start, end in zip([0] + points, points + [len(data)]):
+			tasks.append((data[start:end], line, path, settings));
+			line += count_lines(data[start:end]);
+		pool = multiprocessing.Pool(jobs);
+		try:
+			results = pool.map(filter_segment, tasks, 1);
+		finally:
+			pool.close();
+			pool.join();
+		render = join_segments(results, path, index, settings, messages, outfile);
+		if render is not None:
+			return render, len(tasks);
+	DoxygenFilter = doxygen_squirrel_filter.SquirrelFilter(path, index, settings, messages);
+	DoxygenFilter.data = data;
+	DoxygenFilter.filter(outfile);
+	return DoxygenFilter, 1;
+
+## Filter path with 1, 2, 4, ... up to jobs processes, but not more than the number of cpus, and report
+## the time and speedup of each.
+## Returns 1 if the output of one of them differs from filtering in one process.
+def bench(path, jobs):
+	out = sys.stdout;
+	out.write("%9s %9s %8s %8s  %s\n" % ("processes", "seconds", "speedup", "segments", "output"));
+	jobs = usable_jobs(jobs);
+	counts = [1];
+	while counts[-1] * 2 <= jobs:
+		counts.append(counts[-1] * 2);
+	if counts[-1] != jobs:
+		counts.append(jobs);
+	serial = None;
+	different = 0;
+	for count in counts:
+		output = io.BytesIO();
+		start = time.time();
+		render, segments = filter_split(path, output, count, messages=doxygen_squirrel_index.NullWriter());
+		elapsed = max(time.time() - start, 1e-6);
+		if serial is None:
+			serial = (elapsed, output.getvalue());
+		same = output.getvalue() == serial[1];
+		if not same:
+			different += 1;
+		out.write("%9d %9.3f %7.2fx %8d  %s\n" % (count, elapsed, serial[0] / elapsed, segments,
+			"same" if same else "DIFFERENT"));
+	return 1 if different else 0;
+
+def main(args):
+	parser = argparse.ArgumentParser(prog="doxygen_squirrel_filter.py split",
+		description="Filter one huge Squirrel file using several processes.");
+	parser.add_argument("filename", help="file to filter");
+	parser.add_argument("-o", "--output", help="file to write the output to (default: stdout)");
+	parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(),
+		help="number of worker processes (default: number of cpus, %(default)s)");
+	parser.add_argument("--index", default=None, help="project index made with the index subcommand");
+	parser.add_argument("--bench", action="store_true",
+		help="show the time and speedup with 1, 2, 4, ... up to --jobs processes instead of writing the output");
+	options = parser.parse_args(args);
+
+	jobs = max(1, options.jobs);
+	if options.bench:
+		return bench(options.filename, jobs);
+	index = None;
+	if options.index:
+		index = doxygen_squirrel_index.open_index(options.index);
+	if options.output:
+		with open(options.output, "wb") as outfile:
+			filter_split(options.filename, outfile, jobs, index=index);
+	else:
+		filter_split(options.filename, doxygen_squirrel_filter.stdout_binary(), jobs, index=index);
+	return 0;
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]));
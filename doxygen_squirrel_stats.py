@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Statistics and profiling for the doxygen Squirrel filter.
+# Copyright (C) 2015, 2019  Jacob Boerema
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# -------------------------------------------------------------------------
+
+## @file doxygen_squirrel_stats.py Per file statistics of the filter and a report of a whole doxygen run.
+
+## Usage:
+## + doxygen_squirrel_filter.py --stats=stats.jsonl filename (use --stats=- for stderr)
+## + doxygen_squirrel_filter.py --profile=dir filename writes a cProfile file per filtered file
+## + doxygen_squirrel_filter.py --tracemalloc=1 --stats=stats.jsonl filename adds the peak of traced memory
+## + python doxygen_squirrel_filter.py stats [--top N] stats.jsonl shows the totals and the slowest files
+##
+## The statistics are one JSON object per line: file name, time, lines, bytes, number of
+## regular expression searches per pattern, time spent in line_handler, filter_part,
+## parse_blocks and WriteBuf, hits per rule of filter_part, classes found, functions added to classes
+## the number of diagnostics per kind, also the ones below the diagnostics level, and the hits of the line memo.
+## The times per part are inclusive: the time of filter_part includes parse_blocks.
+## Nothing of this is loaded unless one of the options is used, so normally there is no overhead.
+
+import os
+import sys
+import json
+import time
+import argparse
+
+import doxygen_squirrel_filter
+
+## Parts of the filter that we time.
+TIMED_METHODS = ("line_handler", "line_handler_cursor", "filter_part", "parse_blocks", "WriteBuf");
+
+## Most precise clock available.
+clock = getattr(time, "perf_counter", time.time);
+
+## Compiled regular expression that counts how often it is used.
+class CountingPattern:
+	def __init__(self, pattern, counts, name):
+		self.pattern = pattern;
+		self.counts = counts;
+		self.name = name;
+		counts[name] = 0;
+
+	def search(self, *args):
+		self.counts[self.name] += 1;
+		return self.pattern.search(*args);
+
+	def match(self, *args):
+		self.counts[self.name] += 1;
+		return self.pattern.match(*args);
+
+	def finditer(self, *args):
+		self.counts[self.name] += 1;
+		return self.pattern.finditer(*args);
+
+	def findall(self, *args):
+		self.counts[self.name] += 1;
+		return self.pattern.findall(*args);
+
+	def sub(self, *args):
+		self.counts[self.name] += 1;
+		return self.pattern.sub(*args);
+
+	def subn(self, *args):
+		self.counts[self.name] += 1;
+		return self.pattern.subn(*args);
+
+## Collects the statistics of one SquirrelFilter.
+class FilterStats:
+	def __init__(self):
+		self.regex = {};
+		self.times = {};
+		self.lines = 0;
+
+	## Replace the methods and regular expressions of filter_instance by counting and timing versions.
+	## Only that instance is changed.
+	def attach(self, filter_instance):
+		for name in dir(filter_instance):
+			if name.startswith("re_"):
+				setattr(filter_instance, name, CountingPattern(getattr(filter_instance, name), self.regex, name));
+		for name in TIMED_METHODS:
+			setattr(filter_instance, name, self.timed(getattr(filter_instance, name), name));
+		for name in ("line_handler", "line_handler_cursor"):
+			setattr(filter_instance, name, self.counted(getattr(filter_instance, name)));
+		return filter_instance;
+
+	def timed(self, method, name):
+		times = self.times;
+		times[name] = 0.0;
+		def wrapper(*args):
+			start = clock();
+			try:
+				return method(*args);
+			finally:
+				times[name] += clock() - start;
+		return wrapper;
+
+	def counted(self, method):
+		def wrapper(*args):
+			self.lines += 1;
+			return method(*args);
+		return wrapper;
+
+## Statistics of filtering one file from the command line.
+class FileStats:
+	def __init__(self, filename, options):
+		self.filename = filename;
+		self.destination = options.get("stats");
+		self.profile_dir = options.get("profile");
+		self.trace_memory = options.get("tracemalloc", "0") not in ("0", "");
+		self.filter_stats = None;
+		self.filter_instance = None;
+		self.profiler = None;
+		self.start = None;
+
+	## Create the SquirrelFilter for filename with statistics attached. Used as new_filter for the cache.
+	def new_filter(self, filename, index=None):
+		self.filter_stats = FilterStats();
+		self.filter_instance = self.filter_stats.attach(doxygen_squirrel_filter.SquirrelFilter(filename, index));
+		return self.filter_instance;
+
+	def begin(self):
+		if self.trace_memory:
+			import tracemalloc
+			tracemalloc.start();
+		if self.profile_dir:
+			import cProfile
+			self.profiler = cProfile.Profile();
+			self.profiler.enable();
+		self.start = clock();
+
+	## Stop measuring and write the statistics.
+	def end(self):
+		elapsed = clock() - self.start;
+		record = {"file": self.filename, "seconds": elapsed, "pid": os.getpid()};
+		try:
+			record["bytes"] = os.path.getsize(self.filename);
+		except OSError:
+			pass;
+		if self.filter_instance is None or self.filter_instance.from_cache:
+			# Output came from the cache.
+			record["cached"] = True;
+			if self.filter_instance is not None:
+				# The diagnostics stored with the output are counted again.
+				record["diagnostics"] = self.filter_instance.diagnostics.counts;
+		else:
+			record["cached"] = False;
+			memo = self.filter_instance.memo;
+			# Lines replayed by the line memo don't go through line_handler.
+			record["lines"] = self.filter_stats.lines + (memo.hits if memo is not None else 0);
+			if memo is not None:
+				record["line_memo"] = memo.stats();
+			record["regex"] = self.filter_stats.regex;
+			record["time"] = self.filter_stats.times;
+			record["rules"] = self.filter_instance.rule_hits;
+			record["classes"] = len(self.filter_instance.registry);
+			record["functions_added"] = self.filter_instance.functions_added;
+			record["diagnostics"] = self.filter_instance.diagnostics.counts;
+		if self.profiler is not None:
+			self.profiler.disable();
+			if not os.path.isdir(self.profile_dir):
+				os.makedirs(self.profile_dir);
+			profile_path = os.path.join(self.profile_dir, "%s.%d.prof" % (os.path.basename(self.filename), os.getpid()));
+			self.profiler.dump_stats(profile_path);
+			record["profile"] = profile_path;
+		if self.trace_memory:
+			import tracemalloc
+			record["tracemalloc_peak"] = tracemalloc.get_traced_memory()[1];
+			tracemalloc.stop();
+		if self.destination:
+			write_record(self.destination, record);
+
+## Append a record as one JSON line to destination, "-" means stderr.
+def write_record(destination, record):
+	line = json.dumps(record, sort_keys=True) + "\n";
+	if destination == "-":
+		sys.stderr.write(line);
+	else:
+		# One write in append mode, so records of parallel filters don't get mixed.
+		with open(destination, "a") as stats_file:
+			stats_file.write(line);
+
+## Read all records from the given files.
+def read_records(paths):
+	records = [];
+	for path in paths:
+		with open(path, "r") as stats_file:
+			for line in stats_file:
+				line = line.strip();
+				if line.startswith("{"):
+					records.append(json.loads(line));
+	return records;
+
+## Print a report of a whole run: totals and the top slowest files.
+def report(records, top):
+	out = sys.stdout;
+	total_time = sum(record["seconds"] for record in records);
+	total_bytes = sum(record.get("bytes", 0) for record in records);
+	total_lines = sum(record.get("lines", 0) for record in records);
+	cached = sum(1 for record in records if record.get("cached"));
+	memo_hits = sum(record.get("line_memo", {}).get("hits", 0) for record in records);
+	out.write("files: %d (%d from cache)\nlines: %d\nMB: %.2f\nfilter time: %.3f s\n" %
+		(len(records), cached, total_lines, total_bytes / 1e6, total_time));
+	if memo_hits:
+		out.write("lines from the line memo: %d (%.1f%%)\n" % (memo_hits, 100.0 * memo_hits / max(total_lines, 1)));
+	if total_time > 0:
+		out.write("throughput: %.2f MB/s, %.0f lines/s\n" % (total_bytes / 1e6 / total_time, total_lines / total_time));
+
+	parts = {};
+	regex = {};
+	rules = {};
+	diagnostics = {};
+	for record in records:
+		doxygen_squirrel_filter.add_counts(diagnostics, record.get("diagnostics", {}));
+		for name, value in record.get("time", {}).items():
+			parts[name] = parts.get(name, 0.0) + value;
+		for name, value in record.get("regex", {}).items():
+			regex[name] = regex.get(name, 0) + value;
+		for name, value in record.get("rules", {}).items():
+			rules[name] = rules.get(name, 0) + value;
+	if parts:
+		out.write("\ntime per part (inclusive):\n");
+		for name in sorted(parts, key=lambda name: -parts[name]):
+			if parts[name]:
+				out.write("  %-22s %9.3f s\n" % (name, parts[name]));
+	if regex:
+		out.write("\nregular expression searches:\n");
+		for name in sorted(regex, key=lambda name: -regex[name]):
+			if regex[name]:
+				out.write("  %-28s %10d\n" % (name, regex[name]));
+	if rules:
+		out.write("\nrule hits:\n");
+		for name in sorted(rules, key=lambda name: -rules[name]):
+			if rules[name]:
+				out.write("  %-28s %10d\n" % (name, rules[name]));
+
+	if diagnostics:
+		out.write("\ndiagnostics:\n");
+		for kind in sorted(diagnostics, key=lambda kind: -diagnostics[kind]):
+			out.write("  %-28s %10d\n" % (kind, diagnostics[kind]));
+
+	out.write("\n%d slowest files:\n" % top);
+	out.write("  %9s %9s %8s %7s  %s\n" % ("seconds", "KB", "lines", "classes", "file"));
+	for record in sorted(records, key=lambda record: -record["seconds"])[:top]:
+		out.write("  %9.4f %9.1f %8s %7s  %s\n" % (record["seconds"], record.get("bytes", 0) / 1024.0,
+			record.get("lines", "-"), record.get("classes", "-"), record["file"]));
+
+def main(args):
+	parser = argparse.ArgumentParser(prog="doxygen_squirrel_filter.py stats",
+		description="Report on the statistics written by --stats during a doxygen run.");
+	parser.add_argument("files", nargs="+", help="statistics files");
+	parser.add_argument("--top", type=int, default=20, help="number of slowest files to show (default: %(default)s)");
+	options = parser.parse_args(args);
+	report(read_records(options.files), options.top);
+	return 0;
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]));
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Symbol database written by the doxygen Squirrel filter.
+# Copyright (C) 2015, 2019  Jacob Boerema
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# -------------------------------------------------------------------------
+
+## @file doxygen_squirrel_symbols.py Database of the classes and functions the filter finds.
+
+## While filtering, the filter can store every class, its base class and constructor, function defined
+## inside its class and function defined outside its class (Class::function) with its file, line,
+## visibility and parameters. A base class is stored as kind "base" with the name of the base class, a
+## constructor as kind "constructor" named after its class, like the filter writes it:
+## + doxygen_squirrel_filter.py --symbols=symbols.db filename
+## + python doxygen_squirrel_filter.py batch --symbols symbols.db -o output_dir sources
+## + python doxygen_squirrel_filter.py symbols dump symbols.db [--class name] [--name name] shows them as JSON lines
+## + python doxygen_squirrel_filter.py symbols merge symbols.db other.db [more.db or .jsonl ...]
+##
+## A name ending in .jsonl appends one JSON line per file instead, otherwise it's an SQLite database.
+## The symbols of a file are replaced in one transaction, so parallel filters can share a database.
+## Separate databases, e.g. of runs on several machines, can be merged into one.
+## Visibility is "private" for names starting with an underscore, like hide_private_symbols.
+
+import os
+import sys
+import json
+import argparse
+
+## Columns of a symbol, in the order the filter collects them.
+COLUMNS = ("line", "kind", "visibility", "class", "name", "params");
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+	id INTEGER PRIMARY KEY,
+	path TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS symbols (
+	file_id INTEGER NOT NULL REFERENCES files(id),
+	line INTEGER NOT NULL,
+	kind TEXT NOT NULL,
+	visibility TEXT NOT NULL,
+	class TEXT,
+	name TEXT NOT NULL,
+	params TEXT
+);
+CREATE INDEX IF NOT EXISTS symbols_name ON symbols(name);
+CREATE INDEX IF NOT EXISTS symbols_class ON symbols(class, name);
+CREATE INDEX IF NOT EXISTS symbols_file ON symbols(file_id);
+""";
+
+## Seconds to wait for another process that is writing to the database.
+BUSY_TIMEOUT = 60;
+
+## SQLite database of symbols.
+class SymbolDatabase:
+	def __init__(self, path):
+		import sqlite3
+		self.path = path;
+		self.connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT);
+		# Readers don't block the writer and the other way around.
+		self.connection.execute("PRAGMA journal_mode=WAL");
+		self.connection.executescript(SCHEMA);
+
+	def close(self):
+		self.connection.close();
+
+	## Replace the symbols of a file by symbols, in the current transaction.
+	def replace_symbols(self, path, symbols):
+		cursor = self.connection.cursor();
+		cursor.execute("INSERT OR IGNORE INTO files (path) VALUES (?)", (path,));
+		cursor.execute("SELECT id FROM files WHERE path = ?", (path,));
+		file_id = cursor.fetchone()[0];
+		cursor.execute("DELETE FROM symbols WHERE file_id = ?", (file_id,));
+		cursor.executemany("INSERT INTO symbols (file_id, line, kind, visibility, class, name, params) VALUES (?, ?, ?, ?, ?, ?, ?)",
+			[[file_id] + list(symbol) for symbol in symbols]);
+
+	## Store the symbols of many files, a list of (path, symbols), in one transaction.
+	def store(self, files):
+		with self.connection:
+			for path, symbols in files:
+				self.replace_symbols(path, symbols);
+
+	## Merge another SQLite database into this one, in one transaction. Files in other replace ours.
+	def merge_database(self, other_path):
+		self.connection.execute("ATTACH DATABASE ? AS other", (other_path,));
+		try:
+			with self.connection:
+				self.connection.execute("INSERT OR IGNORE INTO files (path) SELECT path FROM other.files");
+				self.connection.execute("DELETE FROM symbols WHERE file_id IN "
+					"(SELECT files.id FROM files JOIN other.files AS o ON files.path = o.path)");
+				self.connection.execute("INSERT INTO symbols (file_id, line, kind, visibility, class, name, params) "
+					"SELECT files.id, s.line, s.kind, s.visibility, s.class, s.name, s.params "
+					"FROM other.symbols AS s JOIN other.files AS o ON s.file_id = o.id JOIN files ON files.path = o.path");
+		finally:
+			self.connection.execute("DETACH DATABASE other");
+
+	## Yield every symbol as a dictionary, optionally only of one class and/or name.
+	def query(self, classname=None, name=None):
+		sql = ("SELECT files.path, " + ", ".join("s." + column for column in COLUMNS) +
+			" FROM symbols AS s JOIN files ON s.file_id = files.id");
+		conditions = [];
+		values = [];
+		if classname is not None:
+			conditions.append("s.class = ?");
+			values.append(classname);
+		if name is not None:
+			conditions.append("s.name = ?");
+			values.append(name);
+		if conditions:
+			sql += " WHERE " + " AND ".join(conditions);
+		sql += " ORDER BY files.path, s.line";
+		for row in self.connection.execute(sql, values):
+			symbol = dict(zip(COLUMNS, row[1:]));
+			symbol["file"] = row[0];
+			yield symbol;
+
+## Read the files and symbols of a JSON lines file. Returns a list of (path, symbols).
+def read_json_lines(path):
+	files = [];
+	with open(path, "r") as symbols_file:
+		for line in symbols_file:
+			line = line.strip();
+			if line.startswith("{"):
+				record = json.loads(line);
+				files.append((record["file"], record["symbols"]));
+	return files;
+
+## Store the symbols found in the file at path in destination, an SQLite database or a .jsonl file.
+def write_symbols(destination, path, symbols):
+	path = os.path.abspath(path);
+	if destination.endswith(".jsonl"):
+		# One write in append mode, so the lines of parallel filters don't get mixed.
+		line = json.dumps({"file": path, "symbols": symbols}, sort_keys=True) + "\n";
+		with open(destination, "a") as symbols_file:
+			symbols_file.write(line);
+		return;
+	database = SymbolDatabase(destination);
+	try:
+		database.store([(path, symbols)]);
+	finally:
+		database.close();
+
+def main(args):
+	parser = argparse.ArgumentParser(prog="doxygen_squirrel_filter.py symbols",
+		description="Show or merge the symbols stored by --symbols.");
+	commands = parser.add_subparsers(dest="command");
+	dump = commands.add_parser("dump", help="write the symbols as JSON lines to stdout");
+	dump.add_argument("database", help="symbol database");
+	dump.add_argument("--class", dest="classname", help="only symbols of this class");
+	dump.add_argument("--name", help="only symbols with this name");
+	merge = commands.add_parser("merge", help="merge databases or .jsonl files into the first database");
+	merge.add_argument("database", help="symbol database to merge into, created if needed");
+	merge.add_argument("sources", nargs="+", help="symbol databases or .jsonl files to merge");
+	options = parser.parse_args(args);
+
+	if options.command is None:
+		parser.print_usage(sys.stderr);
+		return 1;
+	database = SymbolDatabase(options.database);
+	try:
+		if options.command == "dump":
+			for symbol in database.query(options.classname, options.name):
+				sys.stdout.write(json.dumps(symbol, sort_keys=True) + "\n");
+		else:
+			for source in options.sources:
+				if source.endswith(".jsonl"):
+					database.store(read_json_lines(source));
+				else:
+					database.merge_database(source);
+	finally:
+		database.close();
+	return 0;
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]));
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Doxygen tag files of Squirrel libraries for the doxygen Squirrel filter.
+# Copyright (C) 2015, 2019  Jacob Boerema
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# -------------------------------------------------------------------------
+
+## @file doxygen_squirrel_tagfile.py Doxygen tag file of a Squirrel library, so projects using it don't filter it again.
+
+## Usage:
+## + python doxygen_squirrel_filter.py tagfile -o superlib.tag [--cache dir] [-i pattern] [-x pattern] library_dir
+##
+## and in the doxygen config of the projects that use the library:
+## + TAGFILES = superlib.tag=path/to/superlib/html
+## + EXCLUDE = path/to/superlib
+##
+## The tag file has a compound for every class of the library with its base class, constructor and
+## functions, including the functions defined outside the class in any file of the library, which the
+## filter adds to the class. Private functions are left out when hide_private_symbols is set, like doxygen does.
+## Links go to the class pages of the documentation of the library, so use the same
+## --html-extension and --case-insensitive-names as its HTML_FILE_EXTENSION and CASE_SENSE_NAMES.
+##
+## The tag file is stored in the filter cache (--cache or SQUIRREL_FILTER_CACHE) under the hash of
+## the contents of the library files, so it's only made again when the library or the filter changes.
+
+import os
+import sys
+import hashlib
+import argparse
+import collections
+from xml.sax.saxutils import escape
+
+import doxygen_squirrel_filter
+import doxygen_squirrel_batch
+import doxygen_squirrel_cache
+import doxygen_squirrel_index
+
+## Version of the contents of the tag file, part of its key in the cache.
+TAGFILE_VERSION = "2";
+
+## Characters that doxygen replaces in the names of its HTML files.
+ESCAPED_CHARS = {"_": "__", ":": "_1", "/": "_2", "<": "_3", ">": "_4", "*": "_5", "&": "_6", "|": "_7",
+	".": "_8", "!": "_9", ",": "_00", " ": "_01", "{": "_02", "}": "_03", "?": "_04", "^": "_05",
+	"%": "_06", "(": "_07", ")": "_08", "+": "_09", "=": "_0a", "$": "_0b", "\\": "_0c", "@": "_0d",
+	"]": "_0e", "[": "_0f", "#": "_0g"};
+
+## Return the name of the HTML file doxygen writes for class name.
+def class_filename(name, extension=".html", case_sense_names=True):
+	result = [];
+	for char in name:
+		if char in ESCAPED_CHARS:
+			result.append(ESCAPED_CHARS[char]);
+		elif not case_sense_names and char.isupper():
+			result.append("_" + char.lower());
+		else:
+			result.append(char);
+	return "class" + "".join(result) + extension;
+
+## Filter one library file and return (path, symbols, error). Runs in a worker process.
+def symbols_task(path):
+	try:
+		DoxygenFilter = doxygen_squirrel_filter.SquirrelFilter(path, messages=doxygen_squirrel_index.NullWriter());
+		DoxygenFilter.symbols = [];
+		DoxygenFilter.filter(doxygen_squirrel_index.NullWriter());
+		return path, DoxygenFilter.text_symbols(), None;
+	except Exception as e:
+		return path, None, str(e);
+
+## Return the anchor doxygen gives a member of classname in its class page: "a" followed by the md5 of
+## its definition (type and qualified name), its name and its argument list.
+def member_anchor(member_type, classname, name, arglist):
+	definition = classname + "::" + name;
+	if member_type:
+		definition = member_type + " " + definition;
+	return "a" + hashlib.md5((definition + name + arglist).encode("utf-8")).hexdigest();
+
+## The symbols of one class of the library.
+class LibraryClass(object):
+	__slots__ = ("base", "constructor", "functions");
+
+	def __init__(self):
+		## Name of the class it extends, or None.
+		self.base = None;
+		## Parameters of the constructor, or None if it has none.
+		self.constructor = None;
+		## Ordered dictionary of function name to parameters.
+		self.functions = collections.OrderedDict();
+
+## Return the classes of the library from the symbols of its files, a list of (path, symbols) in
+## a fixed order: an ordered dictionary of class name to LibraryClass.
+def library_classes(files):
+	classes = collections.OrderedDict();
+	# Functions defined inside the class first, like the filter the first definition of a name is used.
+	for path, symbols in files:
+		for line, kind, visibility, classname, name, params in symbols:
+			if kind == "class":
+				if name not in classes:
+					classes[name] = LibraryClass();
+				continue;
+			if kind not in ("base", "constructor", "function"):
+				continue;
+			if classname not in classes:
+				classes[classname] = LibraryClass();
+			library_class = classes[classname];
+			if kind == "base":
+				if library_class.base is None:
+					library_class.base = name;
+			elif kind == "constructor":
+				if library_class.constructor is None:
+					library_class.constructor = params;
+			elif name not in library_class.functions:
+				library_class.functions[name] = params;
+	# Then the functions defined outside their class, in any file.
+	for path, symbols in files:
+		for line, kind, visibility, classname, name, params in symbols:
+			if kind == "outside_function" and classname in classes and params is not None:
+				functions = classes[classname].functions;
+				if name not in functions:
+					functions[name] = params;
+	return classes;
+
+## Return the text of the tag file for classes.
+def tagfile_text(classes, extension=".html", case_sense_names=True, hide_private_symbols=True, keep_function=True,
+	keep_constructor=True):
+	lines = ["<?xml version='1.0' encoding='UTF-8' standalone='yes' ?>", "<tagfile>"];
+	function_type = "function" if keep_function else "";
+	for classname, library_class in classes.items():
+		filename = escape(class_filename(classname, extension, case_sense_names));
+		lines.append('  <compound kind="class">');
+		lines.append("    <name>" + escape(classname) + "</name>");
+		lines.append("    <filename>" + filename + "</filename>");
+		if library_class.base is not None:
+			lines.append("    <base>" + escape(library_class.base) + "</base>");
+		# (type, name, parameters), the filter writes the constructor with the name of its class.
+		members = [];
+		if library_class.constructor is not None:
+			members.append(("constructor" if keep_constructor else "", classname, library_class.constructor));
+		for name, params in library_class.functions.items():
+			if hide_private_symbols and name.startswith("_"):
+				continue;
+			members.append((function_type, name, params));
+		for member_type, name, params in members:
+			arglist = params or "()";
+			lines.append('    <member kind="function">');
+			lines.append("      <type>" + member_type + "</type>");
+			lines.append("      <name>" + escape(name) + "</name>");
+			lines.append("      <anchorfile>" + filename + "</anchorfile>");
+			lines.append("      <anchor>" + member_anchor(member_type, classname, name, arglist) + "</anchor>");
+			lines.append("      <arglist>" + escape(arglist) + "</arglist>");
+			lines.append("    </member>");
+		lines.append("  </compound>");
+	lines.append("</tagfile>");
+	return "\n".join(lines) + "\n";
+
+## Return what the tag file of the library found depends on besides the filter version and settings:
+## the options and the relative path and hash of every file.
+def library_manifest(found, extension, case_sense_names):
+	parts = ["tagfile", TAGFILE_VERSION, extension, str(case_sense_names)];
+	for size, path, relpath in sorted(found, key=lambda item: item[2]):
+		parts.append(relpath.replace(os.sep, "/"));
+		parts.append(doxygen_squirrel_index.file_hash(path));
+	return "\0".join(parts).encode("utf-8");
+
+## Make the tag file of the library in sources. Returns (tag file text, number of files filtered or
+## None when it came from the cache, number of files that failed).
+def make_tagfile(sources, include, exclude, extension=".html", case_sense_names=True, cache=None, jobs=1):
+	found = doxygen_squirrel_batch.find_files(sources, include, exclude);
+	key = None;
+	if cache is not None:
+		key = cache.key(library_manifest(found, extension, case_sense_names));
+		data = cache.get(key);
+		if data is not None:
+			return data.decode("utf-8"), None, 0;
+
+	paths = [path for size, path, relpath in found];
+	if jobs > 1 and len(paths) > 1:
+		pool = doxygen_squirrel_batch.multiprocessing.Pool(jobs);
+		try:
+			results = pool.map(symbols_task, paths, 1);
+		finally:
+			pool.close();
+			pool.join();
+	else:
+		results = [symbols_task(path) for path in paths];
+	relpaths = dict((path, relpath) for size, path, relpath in found);
+	files = [];
+	failed = 0;
+	for path, symbols, error in results:
+		if error is not None:
+			failed += 1;
+			doxygen_squirrel_filter.alwaysprint("** Error filtering " + path + ": " + error + "\n");
+		else:
+			files.append((relpaths[path], symbols));
+	files.sort(key=lambda item: item[0]);
+
+	settings = doxygen_squirrel_filter.FilterSettings();
+	classes = library_classes(files);
+	text = tagfile_text(classes, extension, case_sense_names, settings.hide_private_symbols, settings.keep_function,
+		settings.keep_constructor);
+	if cache is not None and not failed:
+		cache.put(key, text.encode("utf-8"));
+	return text, len(paths), failed;
+
+def main(args):
+	parser = argparse.ArgumentParser(prog="doxygen_squirrel_filter.py tagfile",
+		description="Make a doxygen tag file of the classes of a Squirrel library, for TAGFILES of projects using it.");
+	parser.add_argument("sources", nargs="+", help="library directories or files");
+	parser.add_argument("-o", "--output", required=True, help="tag file to write");
+	parser.add_argument("-i", "--include", action="append",
+		help="file name pattern to include, can be repeated (default: *.nut)");
+	parser.add_argument("-x", "--exclude", action="append", default=[],
+		help="path pattern to exclude, can be repeated");
+	parser.add_argument("-j", "--jobs", type=int, default=1,
+		help="number of worker processes (default: %(default)s)");
+	parser.add_argument("--html-extension", default=".html",
+		help="HTML_FILE_EXTENSION of the library documentation (default: %(default)s)");
+	parser.add_argument("--case-insensitive-names", action="store_true",
+		help="the library documentation uses CASE_SENSE_NAMES = NO");
+	doxygen_squirrel_cache.add_arguments(parser);
+	options = parser.parse_args(args);
+
+	cache = doxygen_squirrel_cache.open_cache(options.cache, options.cache_size, options.cache_ir);
+	text, filtered, failed = make_tagfile(options.sources, options.include or ["*.nut"], options.exclude,
+		options.html_extension, not options.case_insensitive_names, cache, max(1, options.jobs));
+	tmp_path = options.output + ".tmp" + str(os.getpid());
+	with open(tmp_path, "wb") as tag_file:
+		tag_file.write(text.encode("utf-8"));
+	doxygen_squirrel_batch.replace_file(tmp_path, options.output);
+	if filtered is None:
+		doxygen_squirrel_filter.alwaysprint("Tag file " + options.output + ": library unchanged, taken from the cache.\n");
+	else:
+		doxygen_squirrel_filter.alwaysprint("Tag file " + options.output + ": %d files filtered, %d failed.\n" % (filtered, failed));
+	return 1 if failed else 0;
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]));
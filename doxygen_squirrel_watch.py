@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Watch mode for the doxygen Squirrel filter.
+# Copyright (C) 2015, 2019  Jacob Boerema
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# -------------------------------------------------------------------------
+
+## @file doxygen_squirrel_watch.py Keep a filtered mirror tree up to date, re-filtering only what changed.
+
+## Usage:
+## + python doxygen_squirrel_filter.py watch -o output_dir [options] source [source ...]
+## + add --once to update the mirror tree once and exit, e.g. from a makefile.
+##
+## Like batch mode the files below the sources are filtered into output_dir, but a manifest
+## (output_dir/.squirrel_manifest) remembers the modification time, size and hash of every input,
+## the classes it defines and the functions it defines outside their class. The sources are
+## polled every --interval seconds and only these files are filtered again:
+## + files that were added or whose contents changed,
+## + files defining a class that gets functions from a changed, added or removed file.
+##
+## The project index needed for the functions that are defined in another file is kept up to
+## date next to the manifest (output_dir/.squirrel.idx), doxygen can use it too.
+## Polling uses nothing but os.stat, so it works everywhere without inotify.
+
+import os
+import sys
+import time
+import argparse
+
+import doxygen_squirrel_filter
+import doxygen_squirrel_batch
+import doxygen_squirrel_index
+
+## Name of the manifest in the output directory.
+MANIFEST_NAME = ".squirrel_manifest";
+
+## Name of the project index in the output directory.
+INDEX_NAME = ".squirrel.idx";
+
+## Return what the filtered output depends on besides the input files: when this changes everything is filtered again.
+def filter_signature():
+	return [doxygen_squirrel_filter.FILTER_VERSION, repr(doxygen_squirrel_filter.output_settings())];
+
+## Return the names of the classes that get functions from the file described by info.
+def contributed_classes(info):
+	if info is None:
+		return set();
+	return set(cname for cname, fn, params in info["outside"]);
+
+## Keeps the mirror tree in output up to date with the sources.
+class Watcher:
+	def __init__(self, sources, output, include, exclude, jobs=1):
+		self.sources = sources;
+		self.output = os.path.abspath(output);
+		self.include = include;
+		self.exclude = exclude + [os.path.join(self.output, "*")];
+		self.jobs = jobs;
+		self.manifest_path = os.path.join(self.output, MANIFEST_NAME);
+		self.index_path = os.path.join(self.output, INDEX_NAME);
+		manifest = doxygen_squirrel_index.read_json(self.manifest_path);
+		if manifest is None or manifest.get("filter") != filter_signature():
+			# No manifest yet, or another filter version or settings: all output has to be made again.
+			manifest = {"version": doxygen_squirrel_index.INDEX_VERSION, "filter": filter_signature(), "files": {}};
+		self.manifest = manifest;
+
+	## Scan the sources once, filter what is needed and update the manifest.
+	## Returns (list of filtered paths, list of removed paths, number of failed files).
+	def update(self):
+		old_files = self.manifest["files"];
+		new_files = {};
+		outputs = {};
+		tasks = [];
+		for size, path, relpath in doxygen_squirrel_batch.find_files(self.sources, self.include, self.exclude):
+			output_path = os.path.join(self.output, relpath);
+			outputs[path] = output_path;
+			mtime = os.path.getmtime(path);
+			old = old_files.get(path);
+			if (old is not None and old["mtime"] == mtime and old["size"] == size and
+				old["output"] == output_path and os.path.exists(output_path)):
+				new_files[path] = old;
+			else:
+				tasks.append((path, mtime, size));
+
+		# Find out what changed in the files that were touched.
+		changed = set();
+		for path, info, found, error in self.scan(tasks):
+			old = old_files.get(path);
+			if error is not None:
+				doxygen_squirrel_filter.alwaysprint("** Error scanning " + path + ": " + error + "\n");
+				# Try again next time.
+				if old is not None:
+					new_files[path] = dict(old, mtime=None);
+				continue;
+			mtime, size, digest = info;
+			new_files[path] = dict(found, mtime=mtime, size=size, hash=digest, output=outputs[path]);
+			if old is None or old["hash"] != digest or old["output"] != outputs[path] or not os.path.exists(outputs[path]):
+				changed.add(path);
+		removed = [path for path in old_files if path not in new_files];
+
+		# Classes that get functions from the changed and removed files, before and after the change.
+		classes = set();
+		for path in changed:
+			classes |= contributed_classes(old_files.get(path)) | contributed_classes(new_files[path]);
+		for path in removed:
+			classes |= contributed_classes(old_files[path]);
+		affected = set(changed);
+		if classes:
+			for path, info in new_files.items():
+				if classes.intersection(info["classes"]):
+					affected.add(path);
+
+		for path in removed:
+			try:
+				os.remove(old_files[path]["output"]);
+			except OSError:
+				pass;
+
+		failed = 0;
+		if affected or removed or not os.path.exists(self.index_path):
+			doxygen_squirrel_index.write_json(self.index_path, doxygen_squirrel_index.index_data(new_files));
+			failed = self.filter(sorted(affected), new_files);
+
+		self.manifest["files"] = new_files;
+		doxygen_squirrel_index.write_json(self.manifest_path, self.manifest);
+		return sorted(affected), removed, failed;
+
+	## Scan the files of tasks for the classes and functions they define.
+	def scan(self, tasks):
+		if self.jobs > 1 and len(tasks) > 1:
+			pool = doxygen_squirrel_batch.multiprocessing.Pool(self.jobs);
+			try:
+				return list(pool.imap_unordered(doxygen_squirrel_index.scan_task, tasks, 1));
+			finally:
+				pool.close();
+				pool.join();
+		return [doxygen_squirrel_index.scan_task(task) for task in tasks];
+
+	## Filter paths into the mirror tree. Returns the number of files that failed.
+	def filter(self, paths, files):
+		# The index file was just rewritten, don't use one loaded by an earlier update.
+		doxygen_squirrel_batch.loaded_indexes.clear();
+		settings = doxygen_squirrel_filter.FilterSettings();
+		tasks = [(files[path]["size"], path, files[path]["output"], (None, None), self.index_path, None, settings, None)
+			for path in paths];
+		failed = 0;
+		for path, size, messages, error, counts in doxygen_squirrel_batch.run_tasks(tasks, self.jobs):
+			if messages:
+				doxygen_squirrel_filter.alwaysprint(messages);
+			if error is not None:
+				failed += 1;
+				doxygen_squirrel_filter.alwaysprint("** Error filtering " + path + ":\n" + error);
+				# Make sure it's filtered again next time.
+				files[path]["mtime"] = None;
+				files[path]["hash"] = None;
+		return failed;
+
+def main(args):
+	parser = argparse.ArgumentParser(prog="doxygen_squirrel_filter.py watch",
+		description="Keep a filtered mirror of the sources up to date, re-filtering only the files that need it.");
+	parser.add_argument("sources", nargs="+", help="source directories or files");
+	parser.add_argument("-o", "--output", required=True, help="output directory for the filtered files");
+	parser.add_argument("-i", "--include", action="append",
+		help="file name pattern to include, can be repeated (default: *.nut)");
+	parser.add_argument("-x", "--exclude", action="append", default=[],
+		help="path pattern to exclude, can be repeated");
+	parser.add_argument("-j", "--jobs", type=int, default=1,
+		help="number of worker processes (default: %(default)s)");
+	parser.add_argument("--interval", type=float, default=1.0,
+		help="seconds between polls of the sources (default: %(default)s)");
+	parser.add_argument("--once", action="store_true", help="update the output once and exit");
+	options = parser.parse_args(args);
+
+	if not os.path.isdir(options.output):
+		os.makedirs(options.output);
+	watcher = Watcher(options.sources, options.output, options.include or ["*.nut"], options.exclude, max(1, options.jobs));
+	try:
+		while True:
+			start = time.time();
+			filtered, removed, failed = watcher.update();
+			if filtered or removed or failed:
+				doxygen_squirrel_filter.alwaysprint("Filtered %d files, removed %d, %d failed in %.2f s.\n" %
+					(len(filtered), len(removed), failed, time.time() - start));
+			if options.once:
+				return 1 if failed else 0;
+			time.sleep(options.interval);
+	except KeyboardInterrupt:
+		pass;
+	return 0;
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]));
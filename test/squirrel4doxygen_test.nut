@@ -54,6 +54,9 @@ _private_start_of_line = true;	///< Another private that should be hidden!
 
 class DotTest.Test extends Test
 {
+	/** Construct DotTest.Test, which calls the constructor of Test. */
+	constructor(x) { base.constructor(); }
+
 	/** Override default dummy. */
 	function dummy(x, y) {}
 	
@@ -121,4 +124,12 @@ function Test::AnotherFunc()
 /** This is a private function part of our Test class. */
 function Test::_PrivateFuncDeclaredOutsideClass()
 {
-}
\ No newline at end of file
+}
+
+/** Two slots made on one line. */
+first_slot <- 1; second_slot <- 2;
+
+/** A global enum without a ';' after it. */
+enum GlobalEnum {
+	First, Second
+}